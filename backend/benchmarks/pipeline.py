@@ -0,0 +1,246 @@
+"""
+End-to-end benchmark of process_email and summary_email with the offline LLM.
+
+Run from backend/:  python -m benchmarks.pipeline --repeat 3 --concurrency 4 --token-ms 15
+
+Emails come from the customer messages in services/data/kb.txt. LLM answers are
+replayed from LLM_RECORDINGS_PATH when available (record them once with
+LLM_BACKEND=record) and synthesized otherwise, with the simulated latency given on
+the command line. The run happens in a temporary working directory, so caches,
+checkpoints and the classifier training data of the real app are left untouched.
+"""
+import os
+import re
+import sys
+import json
+import time
+import argparse
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+BACKEND_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+KB_PATH = os.path.join(BACKEND_DIR, "services", "data", "kb.txt")
+QUANTILES = (0.5, 0.95, 0.99)
+
+
+def build_corpus(path=KB_PATH):
+    """Customer messages of the knowledge base as benchmark emails."""
+    with open(path, 'r', encoding='utf-8') as f:
+        text = f.read()
+    corpus = []
+    for part in re.split(r'Customer:\s*', text)[1:]:
+        message = re.split(r'\s+Support:', part, maxsplit=1)[0].strip()
+        lines = message.splitlines()
+        # L'ultima riga è la firma del cliente
+        name = lines[-1].strip() if len(lines) > 1 and len(lines[-1].split()) <= 3 else "Customer"
+        corpus.append({
+            "subject": " ".join(message.split()[:8]),
+            "username": name,
+            "destination_email": f"{name.lower().replace(' ', '.')}@example.com",
+            "email_content": message,
+        })
+    return corpus
+
+
+def percentiles(values):
+    from services.metrics import quantile
+    values = sorted(values)
+    return {f"p{int(q * 100)}_ms": quantile(values, q) * 1000 for q in QUANTILES}
+
+
+def prepare_workdir(workdir, recordings):
+    """Point the app at an isolated working directory sharing the FAISS index of backend/."""
+    index_path = os.path.join(BACKEND_DIR, "faiss_index")
+    if os.path.isdir(index_path):
+        os.symlink(index_path, os.path.join(workdir, "faiss_index"))
+    else:
+        from langchain.vectorstores import FAISS
+        from langchain.embeddings import HuggingFaceEmbeddings
+        from langchain.text_splitter import RecursiveCharacterTextSplitter
+
+        # Nessun indice costruito con index_all.py: ne serve uno temporaneo sulla stessa KB
+        with open(KB_PATH, 'r', encoding='utf-8') as f:
+            chunks = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=200).split_text(f.read())
+        FAISS.from_texts(chunks, HuggingFaceEmbeddings(model_name="all-MiniLM-L6-v2")).save_local(
+            os.path.join(workdir, "faiss_index")
+        )
+    os.environ.update({
+        "LLM_BACKEND": "replay",
+        "LLM_RECORDINGS_PATH": os.path.abspath(recordings),
+        # Senza cache, bozze riusate e classificatore locale si misura sempre il grafo completo
+        "LLM_CACHE_ENABLED": "false",
+        "DRAFT_CACHE_THRESHOLD": "2",
+        "CLASSIFIER_MIN_EXAMPLES": str(sys.maxsize),
+        "METRICS_WINDOW": "1000000",
+    })
+    os.chdir(workdir)
+
+
+def run_pipeline(name, corpus, repeat, concurrency, run_one):
+    from services.metrics import labelled, current_labels
+
+    route = f"benchmark/{name}"
+
+    def timed(email):
+        with labelled(route=route):
+            started = time.perf_counter()
+            first = None
+            for _ in run_one(email):
+                if first is None:
+                    first = time.perf_counter() - started
+            # problem_type viene impostato dai nodi del grafo durante il run
+            return first, time.perf_counter() - started, current_labels()["problem_type"]
+
+    jobs = [email for _ in range(repeat) for email in corpus]
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(timed, jobs))
+    wall = time.perf_counter() - started
+
+    by_problem_type = {}
+    for _, total, problem_type in results:
+        by_problem_type.setdefault(problem_type, []).append(total)
+    return route, {
+        "emails": len(jobs),
+        "concurrency": concurrency,
+        "wall_s": wall,
+        "throughput_per_s": len(jobs) / wall,
+        "total": percentiles([total for _, total, _ in results]),
+        "first_chunk": percentiles([first for first, _, _ in results if first is not None]),
+        "problem_types": summarize(by_problem_type),
+    }
+
+
+def summarize(grouped):
+    return {
+        value: {"count": len(samples), "mean_ms": sum(samples) / len(samples) * 1000, **percentiles(samples)}
+        for value, samples in sorted(grouped.items())
+    }
+
+
+def breakdown(histogram, route, key):
+    """Per `key` label (node, problem_type...) latency percentiles of one benchmark route."""
+    grouped = {}
+    for labels, values in histogram.samples():
+        if labels.get("route") == route:
+            grouped.setdefault(labels[key], []).extend(values)
+    return summarize(grouped)
+
+
+def compare(report, baseline, tolerance):
+    """Regressions of throughput and p95 against a previous JSON report."""
+    regressions = []
+    for name, current in report["pipelines"].items():
+        previous = baseline.get("pipelines", {}).get(name)
+        if previous is None:
+            continue
+        if current["throughput_per_s"] < previous["throughput_per_s"] * (1 - tolerance):
+            regressions.append(f"{name}: throughput {previous['throughput_per_s']:.2f} -> "
+                               f"{current['throughput_per_s']:.2f}/s")
+        for metric in ("total", "first_chunk"):
+            before, after = previous[metric].get("p95_ms"), current[metric].get("p95_ms")
+            if before and after and after > before * (1 + tolerance):
+                regressions.append(f"{name}: {metric} p95 {before:.0f} -> {after:.0f} ms")
+    return regressions
+
+
+def print_report(report):
+    for name, result in report["pipelines"].items():
+        print(f"\n== {name}: {result['emails']} emails, concurrency {result['concurrency']}, "
+              f"{result['throughput_per_s']:.2f} emails/s")
+        for metric in ("total", "first_chunk"):
+            values = result[metric]
+            print(f"  {metric:<12} " + "  ".join(f"{k}={v:.0f}" for k, v in values.items()))
+        for section in ("problem_types", "nodes", "llm", "rag"):
+            if result.get(section):
+                print(f"  {section}:")
+            for label, values in result.get(section, {}).items():
+                print(f"    {label:<22} n={values['count']:<5} mean={values['mean_ms']:.0f}"
+                      f"  p50={values['p50_ms']:.0f}  p95={values['p95_ms']:.0f}  p99={values['p99_ms']:.0f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=1, help="passes over the corpus")
+    parser.add_argument("--concurrency", type=int, default=1)
+    parser.add_argument("--limit", type=int, default=None, help="use only the first N emails")
+    parser.add_argument("--first-token-ms", type=float, default=300.0, help="simulated LLM time to first token")
+    parser.add_argument("--token-ms", type=float, default=10.0, help="simulated LLM time per token")
+    parser.add_argument("--router", action="store_true",
+                        help="route through fake providers of every configured model instead of a single one")
+    parser.add_argument("--slow-rate", type=float, default=0.05,
+                        help="with --router, share of first tokens 10x slower on the primary models")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="with --router, primary model error rate")
+    parser.add_argument("--no-hedge", action="store_true", help="with --router, disable hedged requests")
+    parser.add_argument("--recordings", default=os.path.join(BACKEND_DIR, "cache", "llm_recordings.jsonl"))
+    parser.add_argument("--json", dest="json_path", help="write the report as JSON")
+    parser.add_argument("--baseline", help="previous JSON report to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="allowed relative slowdown vs baseline")
+    args = parser.parse_args()
+
+    corpus = build_corpus()[:args.limit]
+    # Percorsi risolti prima di spostarsi nella directory temporanea
+    recordings = os.path.abspath(args.recordings)
+    json_path = os.path.abspath(args.json_path) if args.json_path else None
+    baseline_path = os.path.abspath(args.baseline) if args.baseline else None
+    workdir = tempfile.mkdtemp(prefix="pipeline-bench-")
+    sys.path.insert(0, BACKEND_DIR)
+    prepare_workdir(workdir, recordings)
+
+    # Import dopo la configurazione: lang legge l'ambiente e la cwd all'import
+    from lang import process_email, summary_email, set_llm_backend, EmailState
+    from services.llm_backend import ReplayBackend
+    from services.llm_router import create_fake_router, task_routes
+    from services import metrics
+
+    if args.router:
+        chains = task_routes().values()
+        models = {spec for chain in chains for spec in chain}
+        primaries = {chain[0] for chain in chains}
+        backend = create_fake_router(
+            first_token_ms={spec: args.first_token_ms for spec in models},
+            token_ms=args.token_ms,
+            error_rates={spec: args.error_rate for spec in primaries},
+            slow_rates={spec: args.slow_rate for spec in primaries},
+            hedge=not args.no_hedge,
+        )
+    else:
+        backend = ReplayBackend(recordings_path=recordings, first_token_ms=args.first_token_ms,
+                                token_ms=args.token_ms)
+    set_llm_backend(backend)
+
+    pipelines = {
+        "process_email": lambda email: process_email(EmailState(**email, is_reply=False)),
+        "summary_email": lambda email: summary_email(f"Subject: {email['subject']}\n\n{email['email_content']}"),
+    }
+    report = {"corpus": len(corpus), "first_token_ms": args.first_token_ms, "token_ms": args.token_ms,
+              "pipelines": {}}
+    for name, run_one in pipelines.items():
+        route, result = run_pipeline(name, corpus, args.repeat, args.concurrency, run_one)
+        result["nodes"] = breakdown(metrics.node_seconds, route, "node")
+        result["llm"] = breakdown(metrics.llm_seconds, route, "model")
+        result["rag"] = breakdown(metrics.rag_seconds, route, "operation")
+        report["pipelines"][name] = result
+    if args.router:
+        report["router"] = backend.stats()
+
+    print_report(report)
+    if args.router:
+        print("\n== router providers")
+        for model, stats in report["router"]["providers"].items():
+            print(f"  {model:<40} won={stats['won']} lost={stats['lost']} error={stats['error']}"
+                  f"  first_token_p95={stats['first_token_p95_ms'] or 0:.0f}ms")
+    if json_path:
+        with open(json_path, 'w') as f:
+            json.dump(report, f, indent=2)
+    if baseline_path:
+        with open(baseline_path, 'r') as f:
+            regressions = compare(report, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,12 +1,19 @@
 from pydantic import BaseModel
-from typing import Optional, List, Dict, Any
+from typing import Optional, List, Dict, Any, Annotated
 from langgraph.graph import StateGraph, END
 from langgraph.config import get_stream_writer
-from langchain_google_genai import GoogleGenerativeAI
-from github import Github
 import os
+import hashlib
 import logging
 import random
+import threading
+import functools
+import contextvars
+from contextlib import contextmanager
+from collections import OrderedDict
+import operator
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 
 # print executing directory
@@ -14,14 +21,27 @@ print(f"Executing directory: {os.getcwd()}")
 
 
 from services.RAG.rag_service import RAGModule
+from services.llm_cache import llm_cache
+from services.draft_cache import DraftCache
+from services.category_classifier import CategoryClassifier, CATEGORIES, CLASSIFY_PROMPT, normalize_category
+from services.issue_tracker import IssueTracker
+from services import metrics
+from services.llm_router import create_llm_backend
+import time
 # Initialize RAG module
 rag = RAGModule(index_path="./faiss_index/", model_name="all-MiniLM-L6-v2")
+# Bozze già generate per mail quasi identiche, con lo stesso modello di embedding del RAG
+draft_cache = DraftCache(rag.embedding_model)
+
+# Query RAG costanti: contesto calcolato al caricamento dell'indice, non a ogni mail
+REFUND_POLICY_QUERY = "What is the company policy for refund requests?"
+rag.register_static_query("refund_policy", REFUND_POLICY_QUERY)
+# Classificatore locale addestrato sulle categorie date da Gemini
+category_classifier = CategoryClassifier(rag.embedding_model)
 
 
 # Load environment variables
 load_dotenv()
-GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
-g = Github(os.getenv("GITHUB_TOKEN"))
 
 # Set up logging
 logging.basicConfig(level=logging.INFO)
@@ -47,25 +67,56 @@ class EmailState(BaseModel):
     bug_analysis: Optional[str] = None
     faq_answer: Optional[str] = None
     solutions: Optional[List[str]] = []
+    # Chunk già inviati al client, per rigiocarli dopo una riconnessione
+    stream_log: Annotated[List[str], operator.add] = []
 
 # -------------------------------
-# Step 2: Gemini Model Setup
+# Step 2: LLM Setup
 # -------------------------------
 
-gemini_model = GoogleGenerativeAI(model="gemini-1.5-flash", google_api_key=GOOGLE_API_KEY)
+# Nessun client creato all'import; LLM_BACKEND=replay lavora offline con risposte registrate
+# Il router sceglie il modello per task, con fallback e richieste hedged
+llm_backend = create_llm_backend()
+
+
+def set_llm_backend(backend):
+    """Swap the LLM used by call_gemini (benchmarks, offline runs)."""
+    global llm_backend
+    llm_backend = backend
+
+
+def llm_stats():
+    return llm_backend.stats()
 
 # def call_gemini(prompt: str) -> str:
 #     logger.info(f"LLM Prompt: {prompt}")
 #     response = gemini_model.invoke(prompt)
 #     return response.strip()
 
-def call_gemini(prompt: str, stream: bool = False) -> str:
-    logger.info(f"LLM Prompt: {prompt}")
+def call_gemini(prompt: str, stream: bool = False, task: str = "default", timing: Optional[dict] = None) -> str:
+    logger.debug(f"LLM Prompt ({task}): {prompt}")
+    # Prompt identici (stessa mail riaperta, stessa categorizzazione) escono dalla cache
+    # Le metriche misurano solo le chiamate reali a Gemini, non le risposte dalla cache
+    # Cache e metriche usano il modello che ha risposto, anche quando è un fallback del router
+    backend = llm_backend.for_task(task)
+    params = {"temperature": backend.temperature}
+
+    def invoke():
+        started = time.perf_counter()
+        answer = metrics.timed_llm_call(backend.model, prompt, lambda: backend.invoke_answered(prompt))
+        if timing is not None:
+            # Scritto solo per una chiamata reale: con un hit della cache timing resta vuoto
+            timing["llm_ms"] = (time.perf_counter() - started) * 1000
+        return answer
+
     try:
         if stream:
-            return gemini_model.stream(prompt)
+            return llm_cache.stream(
+                backend.models, prompt, params,
+                lambda: metrics.timed_llm_stream(backend.model, prompt, lambda: backend.stream_answered(prompt))
+            )
         else:
-            return gemini_model.invoke(prompt).strip()
+            return llm_cache.invoke(backend.models, prompt, params, invoke)
     except Exception as e:
         logger.error(f"Error calling Gemini: {e}")
         return f"Error: {str(e)}"
@@ -74,26 +125,137 @@ def call_gemini(prompt: str, stream: bool = False) -> str:
 # Step 3: Define Agent Nodes
 # -------------------------------
 
-def categorize_problem(state: EmailState) -> Dict[str, Any]:
+# Chunk emessi dal nodo in esecuzione: finiscono nello stato e quindi nel checkpoint
+_stream_log = contextvars.ContextVar("stream_log", default=None)
 
-    writer = get_stream_writer()
 
-    prompt = f"""
-        Classify the email with subject: {state.subject}, content: {state.email_content} into one of these categories:
-        username_change, password_reset, refund_request, bug_report, faq or other
+def emit(text: str):
+    get_stream_writer()({"custom_key": text})
+    log = _stream_log.get()
+    if log is not None:
+        log.append(text)
+
+
+def logged_node(node):
+    """
+    Wrap a node so the chunks it emits are saved in state.stream_log when it completes,
+    and its execution time is recorded by route and problem_type.
     """
-    response = call_gemini(prompt)
+    @functools.wraps(node)
+    def wrapper(state: EmailState) -> Dict[str, Any]:
+        log = []
+        token = _stream_log.set(log)
+        metrics.set_label("problem_type", state.problem_type, allowed=CATEGORIES)
+        started = time.perf_counter()
+        try:
+            update = node(state) or {}
+        finally:
+            _stream_log.reset(token)
+        metrics.set_label("problem_type", update.get("problem_type"), allowed=CATEGORIES)
+        metrics.node_seconds.observe(time.perf_counter() - started, node=node.__name__, **metrics.current_labels())
+        return {**update, "stream_log": log}
+    return wrapper
+
+# Retrieval speculativo: contesto RAG della mail calcolato mentre si categorizza
+speculative_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="speculative")
+# Ricerche non ancora consumate: le più vecchie vengono scartate oltre il limite o la scadenza
+SPECULATIVE_MAX_PENDING = int(os.getenv("SPECULATIVE_MAX_PENDING", "32"))
+SPECULATIVE_TTL = float(os.getenv("SPECULATIVE_TTL", "120"))
+_speculative_contexts = OrderedDict()
+_speculative_lock = threading.Lock()
+
+def classify_email(subject: str, email_content: str) -> str:
+    label, confidence = category_classifier.predict(subject, email_content)
+    if label is not None and confidence >= category_classifier.confidence:
+        logger.info(f"Local classifier: {label} ({confidence:.2f})")
+        return label
+
+    prompt = CLASSIFY_PROMPT.format(subject=subject, email_content=email_content)
+    timing = {}
+    response = call_gemini(prompt, task="categorize", timing=timing)
+    if response.startswith("Error:"):
+        return response
+    label = normalize_category(response)
+    if label is None:
+        logger.warning(f"Unexpected category from LLM: {response!r}")
+        return "other"
+    # Ogni risposta valida di Gemini diventa un esempio di training; llm_ms è None se veniva dalla cache
+    category_classifier.record(subject, email_content, label, timing.get("llm_ms"))
+    return label
+
+
+def _speculative_key(email_content: str) -> str:
+    return hashlib.sha1(email_content.encode('utf-8')).hexdigest()
+
+
+def start_speculative_retrieval(email_content: str):
+    key = _speculative_key(email_content)
+    now = time.monotonic()
+    with _speculative_lock:
+        if key not in _speculative_contexts:
+            # Copia del contesto: la ricerca viene conteggiata sulla route della richiesta
+            _speculative_contexts[key] = (now, speculative_executor.submit(
+                contextvars.copy_context().run, rag.generate_context, email_content
+            ))
+        expired = []
+        while _speculative_contexts:
+            started, future = next(iter(_speculative_contexts.values()))
+            if len(_speculative_contexts) <= SPECULATIVE_MAX_PENDING and now - started < SPECULATIVE_TTL:
+                break
+            _, (_, future) = _speculative_contexts.popitem(last=False)
+            expired.append(future)
+    for future in expired:
+        future.cancel()
+
+
+def take_speculative_context(email_content: str) -> str:
+    with _speculative_lock:
+        _, future = _speculative_contexts.pop(_speculative_key(email_content), (None, None))
+    if future is None or future.cancelled():
+        return rag.generate_context(email_content)
+    return future.result()
+
+
+def discard_speculative_context(email_content: str):
+    with _speculative_lock:
+        _, future = _speculative_contexts.pop(_speculative_key(email_content), (None, None))
+    if future is not None:
+        # Se la ricerca è già partita il risultato viene semplicemente ignorato
+        future.cancel()
+
+
+def categorize_problem(state: EmailState) -> Dict[str, Any]:
+
+
+    if not state.problem_type:
+        # Il retrieval per faq_answer parte in parallelo alla categorizzazione
+        start_speculative_retrieval(state.email_content)
+    to_faq = False
+    try:
+        # Categoria già calcolata dal pre-triage in background
+        response = state.problem_type or classify_email(state.subject, state.email_content)
+        # Bozza riusabile cercata subito: con un hit si salta anche l'handler (es. faq_answer e la sua chiamata LLM)
+        update = {
+            "problem_type": response,
+            "draft": draft_cache.lookup(state.email_content, response, state.username, state.destination_email),
+        }
+        to_faq = route_after_categorization(state.model_copy(update=update)) == "faq_handler"
+    finally:
+        # Fuori dal ramo faq (o in caso di errore) la ricerca non verrà mai consumata
+        if not to_faq:
+            discard_speculative_context(state.email_content)
+    if to_faq:
+        start_speculative_retrieval(state.email_content)
     category = f"<thinking> categorize problem ... {response} </thinking>"
-    writer({"custom_key": category})
-    return {"problem_type": response}
+    emit(category)
+    return update
 
 
 def account_management(state: EmailState) -> Dict[str, Any]:
 
     if "password" in state.problem_type.lower():
 
-        writer = get_stream_writer()
-        writer({"custom_key": "<action> generate password reset link </action>"})
+        emit("<action> generate password reset link </action>")
 
         def generate_password_reset_link():
             # Generate a secure password reset link that concatenates a random string with the base URL
@@ -104,8 +266,7 @@ def account_management(state: EmailState) -> Dict[str, Any]:
         state.link = generate_password_reset_link()
     elif "username" in state.problem_type.lower():
 
-        writer = get_stream_writer()
-        writer({"custom_key": "<action> generate username reset link </action>"})
+        emit("<action> generate username reset link </action>")
 
         def generate_username_change_link():
             print("Generating username change link")
@@ -122,38 +283,33 @@ def account_management(state: EmailState) -> Dict[str, Any]:
         
     return {"link": state.link} 
 
-def bug_report(state: EmailState) -> Dict[str, Any]:
-
-    writer = get_stream_writer()
-    writer({"custom_key": "<action> creating ticket for the bug </action>"})
-
+def summarize_bug(email_content: str) -> str:
     prompt = f"""
-        Bug report: {state.email_content}
+        Bug report: {email_content}
 
         Output format:
         summarize the bug without adding any other information, just the bug description
     """
-    response = call_gemini(prompt)
-    user = g.get_user()
-    repo = g.get_repo("bonsurha/EXAMPLE")
-    # Get the first project
-    bug_body = response
-    print(f"Bug body: {bug_body}")
-    # Create a new issue in the GitHub repository   
-    issue = repo.create_issue(
-        title=f"Bug Report",
-        body=bug_body,
-        labels=["bug", "triage"]
-    )
-
-    return {"bug_analysis": response}
+    return call_gemini(prompt, task="bug_summary")
+
+
+# Issue GitHub aperte in background, con dedup sui riassunti dei bug già segnalati
+issue_tracker = IssueTracker(rag.embedding_model, summarize=summarize_bug)
+
+
+def bug_report(state: EmailState) -> Dict[str, Any]:
+
+    emit("<action> creating ticket for the bug </action>")
+
+    # Riassunto e issue li gestisce il worker: la bozza non aspetta GitHub
+    report_id = issue_tracker.enqueue(state.email_content)
+    return {"jira_ticket": report_id}
 
 def faq_answer(state: EmailState) -> Dict[str, Any]:
 
-    writer = get_stream_writer()
-    writer({"custom_key": "<thinking> retrieve data from knowledge based </thinking>"})
+    emit("<thinking> retrieve data from knowledge based </thinking>")
 
-    rag_response = rag.generate_context(state.email_content)
+    rag_response = take_speculative_context(state.email_content)
     prompt = f"""
         Answer common questions using provided documentation:
         Include just the email body
@@ -161,39 +317,41 @@ def faq_answer(state: EmailState) -> Dict[str, Any]:
         Question: {state.email_content}
         Provided rag context: {rag_response}
     """
-    response = call_gemini(prompt)
+    response = call_gemini(prompt, task="draft")
 
     return {"faq_answer": response}
 
 def check_compliance(state: EmailState) -> Dict[str, Any]:
 
-    writer = get_stream_writer()
-    writer({"custom_key": "<action> retrieving data from knowledge based </action>"})
+    emit("<action> retrieving data from knowledge based </action>")
 
-    rag_response = rag.generate_context("What is the company policy for refund requests?")
+    rag_response = rag.static_context("refund_policy")
     prompt = f"""
         Check request {state.email_content} from {state.destination_email} against company policies.
         Company policy: {rag_response}
         RESPOND WITH ONLY True OR False
     """
-    response = call_gemini(prompt)
+    response = call_gemini(prompt, task="compliance")
     compliant = response.lower() == "true"
     return {"compliant": compliant}
 
 def refund_request(state: EmailState):
     # Verify payments information
 
-    writer = get_stream_writer()
-    writer({"custom_key": "<action> Researching user payment information </action>"})
+    emit("<action> Researching user payment information </action>")
     return
 
 def generate_draft(state: EmailState) -> Dict[str, Any]:
     print("Generating draft...")
-    writer = get_stream_writer()
-    writer({"custom_key": "<thinking> Generating draft email </thinking>"})
+    emit("<thinking> Generating draft email </thinking>")
 
     print(f"Content: {state}")
 
+    if state.draft is not None:
+        # Bozza dalla cache semantica, trovata da categorize_problem
+        emit(state.draft)
+        return {"draft": state.draft}
+
     if state.problem_type == "password_reset":
         prompt = f"""
         Generate professional email to {state.destination_email} with password reset link: {state.link} for username: {state.username}
@@ -254,11 +412,15 @@ def generate_draft(state: EmailState) -> Dict[str, Any]:
         Ironic email to not refund the user
 
     """
-    response = call_gemini(prompt, True)
+    response = call_gemini(prompt, True, task="draft")
 
+    chunks = []
     for chunk in response:
-        writer({"custom_key": chunk})
-    return {"draft": response}
+        chunks.append(chunk)
+        emit(chunk)
+    draft = "".join(chunks)
+    draft_cache.add(state.email_content, state.problem_type, draft, state.username, state.destination_email)
+    return {"draft": draft}
 
 
 
@@ -268,10 +430,14 @@ def generate_draft(state: EmailState) -> Dict[str, Any]:
 
 def route_after_categorization(state: EmailState):
 
+    if state.draft is not None:
+        # Bozza già pronta dalla cache: il ticket per i bug va comunque aperto
+        return ["bug_report", "generate_draft"] if state.problem_type == "bug_report" else "generate_draft"
     if state.problem_type in ["password_reset", "username_change"]:
         return "account_management"
     elif state.problem_type == "bug_report":
-        return "bug_report"
+        # La bozza per i bug non usa bug_analysis: ticket e bozza partono insieme
+        return ["bug_report", "generate_draft"]
     elif state.problem_type == "refund_request":
         return "refund_request"
     elif state.problem_type == "faq" or state.problem_type == "other":
@@ -285,13 +451,13 @@ def route_after_categorization(state: EmailState):
 graph = StateGraph(EmailState)
 
 # Add nodes
-graph.add_node("categorize_problem", categorize_problem)
-graph.add_node("account_management", account_management)
-graph.add_node("bug_report", bug_report)
-graph.add_node("faq_handler", faq_answer)
-graph.add_node("check_compliance", check_compliance)
-graph.add_node("generate_draft", generate_draft)
-graph.add_node("refund_request", refund_request)
+graph.add_node("categorize_problem", logged_node(categorize_problem))
+graph.add_node("account_management", logged_node(account_management))
+graph.add_node("bug_report", logged_node(bug_report))
+graph.add_node("faq_handler", logged_node(faq_answer))
+graph.add_node("check_compliance", logged_node(check_compliance))
+graph.add_node("generate_draft", logged_node(generate_draft))
+graph.add_node("refund_request", logged_node(refund_request))
 
 
 
@@ -307,29 +473,105 @@ graph.add_conditional_edges(
         "bug_report": "bug_report",
         "check_compliance": "check_compliance",
         "faq_handler": "faq_handler",
-        "refund_request": "refund_request"
+        "refund_request": "refund_request",
+        "generate_draft": "generate_draft"
     }
 )
 
 # Add direct edges
 graph.add_edge("account_management", "generate_draft")
-graph.add_edge("bug_report", "generate_draft")
+graph.add_edge("bug_report", END)
 graph.add_edge("faq_handler", "generate_draft")
 graph.add_edge("check_compliance", "generate_draft")
 graph.add_edge("refund_request", "generate_draft")
 graph.add_edge("generate_draft", END)
 
+# Checkpoint per message id: una websocket caduta riprende dall'ultimo nodo completato
+CHECKPOINT_PATH = os.path.join("cache", "checkpoints.db")
+
+
+def create_checkpointer():
+    try:
+        from langgraph.checkpoint.sqlite import SqliteSaver
+    except ImportError:
+        from langgraph.checkpoint.memory import MemorySaver
+        logger.warning("langgraph-checkpoint-sqlite not installed, graph checkpoints are kept in memory")
+        return MemorySaver()
+    os.makedirs(os.path.dirname(CHECKPOINT_PATH), exist_ok=True)
+    return SqliteSaver(sqlite3.connect(CHECKPOINT_PATH, check_same_thread=False))
+
+
 # Compile the graph
-app = graph.compile()
+app = graph.compile(checkpointer=create_checkpointer())
+# Run senza message id (benchmark, batch): niente da riprendere, nessun checkpoint su disco
+stateless_app = graph.compile()
+
+# Campi scritti dai nodi: "Error: ..." vuol dire una chiamata LLM fallita
+NODE_OUTPUT_FIELDS = ("problem_type", "draft", "summary", "bug_analysis", "faq_answer")
+
+# Un run alla volta per thread_id: pre-triage e websocket /draft della stessa mail
+# non devono eseguire (o riprendere) lo stesso checkpoint in parallelo
+_thread_locks = {}
+_thread_locks_guard = threading.Lock()
+
+
+@contextmanager
+def thread_run(thread_id: str):
+    with _thread_locks_guard:
+        entry = _thread_locks.setdefault(thread_id, [threading.Lock(), 0])
+        entry[1] += 1
+    entry[0].acquire()
+    try:
+        yield
+    finally:
+        entry[0].release()
+        with _thread_locks_guard:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del _thread_locks[thread_id]
+
+
+def has_error_output(values: Dict[str, Any]) -> bool:
+    outputs = [values.get(field) for field in NODE_OUTPUT_FIELDS] + list(values.get("stream_log", []))
+    return any(isinstance(text, str) and text.startswith("Error:") for text in outputs)
 
 
 # -------------------------------
 # Step 6: Run the Workflow
 # -------------------------------
 
-def process_email(initial_state: EmailState):
-    stream = app.stream(initial_state, stream_mode="custom")
-    return stream
+def process_email(initial_state: EmailState, thread_id: Optional[str] = None):
+    """
+    Stream the graph output for a mail. With a thread_id (the message id) the run is
+    checkpointed: a completed run is replayed from the checkpoint, an interrupted one
+    replays the chunks already emitted and resumes from the last completed node.
+    Runs that stored an LLM error are started over instead of replayed.
+    """
+    if thread_id is None:
+        yield from stateless_app.stream(initial_state, stream_mode="custom")
+        return
+
+    config = {"configurable": {"thread_id": thread_id}}
+    with thread_run(thread_id):
+        snapshot = app.get_state(config)
+        if snapshot.values and has_error_output(snapshot.values):
+            logger.info(f"Graph run for {thread_id} failed previously, starting over")
+            app.checkpointer.delete_thread(thread_id)
+            snapshot = app.get_state(config)
+        if not snapshot.values:
+            yield from app.stream(initial_state, config, stream_mode="custom")
+            return
+
+        for chunk in snapshot.values.get("stream_log", []):
+            yield {"custom_key": chunk}
+        if snapshot.next:
+            logger.info(f"Resuming graph run for {thread_id} at {list(snapshot.next)}")
+            yield from app.stream(None, config, stream_mode="custom")
+
+
+def warm_up():
+    """Startup warm-up: embedding model, FAISS index and static RAG queries."""
+    rag.warm_up()
 
 
 def summary_email(state: str) -> [str]:
@@ -338,5 +580,5 @@ def summary_email(state: str) -> [str]:
         Output format:
         - summary
     """
-    stream = call_gemini(prompt, True)
+    stream = call_gemini(prompt, True, task="summary")
     return stream
\ No newline at end of file
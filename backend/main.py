@@ -1,25 +1,62 @@
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect
-from pydantic import BaseModel
-from fastapi.responses import JSONResponse
+from fastapi import FastAPI, WebSocket, WebSocketDisconnect, Depends, Query, BackgroundTasks
+from pydantic import BaseModel, Field
+from typing import List
+from fastapi.responses import JSONResponse, StreamingResponse, PlainTextResponse
 from fastapi.middleware.cors import CORSMiddleware
-from lang import summary_email, process_email, EmailState
+from lang import summary_email, process_email, EmailState, warm_up, issue_tracker, draft_cache, llm_stats
 from services.gmail_service import (
-    authenticate,
-    get_unread_messages,
-    parse_message,
-    send_reply_email,
+    iter_unread_messages,
+    iter_parsed_messages,
+    parse_raw_message,
+    parse_messages,
+    get_message_body,
     mark_as_read,
+    batch_modify_labels,
+    resolve_gmail_id,
     get_message_by_rfc822_message_id
 )
-from googleapiclient.discovery import build
+from services.gmail_client import gmail_clients, get_gmail_service
+from services.mail_sync import mailbox_sync, parse_cursor
+from services.concurrency import run_blocking, iterate_blocking, stream_slots, configure_threadpool, shutdown
+from services.streaming import stream_to_websocket
+from services.outbox import outbox
+from services.llm_cache import llm_cache
+from services.metrics import registry, MetricsMiddleware
+from services.message_store import message_store, normalize_rfc822_id
+from services.pretriage import pretriage
+from services.batch_triage import batch_categorize
+from services.category_classifier import CATEGORIES
+from services.notifications import notification_hub, watch_renewer, decode_push_envelope, PUBSUB_VERIFICATION_TOKEN
+from contextlib import asynccontextmanager
 import asyncio
-from fastapi import FastAPI
-from fastapi.responses import JSONResponse
-from pydantic import BaseModel
-from googleapiclient.discovery import build
+import os
 import base64
+import json
 
-app = FastAPI()
+# Carica modello e indice RAG prima di accettare richieste
+RAG_WARMUP = os.getenv("RAG_WARMUP", "true").lower() == "true"
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    configure_threadpool()
+    if RAG_WARMUP:
+        await run_blocking(warm_up)
+    outbox.start()
+    issue_tracker.start()
+    pretriage.start()
+    notification_hub.bind_loop(asyncio.get_running_loop())
+    watch_renewer.start()
+    yield
+    watch_renewer.stop()
+    pretriage.stop()
+    issue_tracker.stop()
+    outbox.stop()
+    draft_cache.flush()
+    shutdown()
+
+
+app = FastAPI(lifespan=lifespan)
 
 # Add CORS middleware
 app.add_middleware(
@@ -29,11 +66,25 @@ app.add_middleware(
     allow_methods=["*"],  # Allows all methods
     allow_headers=["*"],  # Allows all headers
 )
+# Durata per route e problem_type; etichetta anche le metriche di LLM, RAG e grafo
+app.add_middleware(MetricsMiddleware)
 
 
 class IdRequest(BaseModel):
     original_id: str
 
+class MarkAsReadRequest(BaseModel):
+    message_id: str
+
+class BatchModifyRequest(BaseModel):
+    ids: List[str] = Field(..., min_length=1)
+    add_label_ids: List[str] = []
+    remove_label_ids: List[str] = []
+
+class BatchTriageRequest(BaseModel):
+    # Vuoto = tutta la inbox non letta in cache
+    message_ids: List[str] = []
+
 class EmailReplyRequest(BaseModel):
     to: str
     subject: str
@@ -42,17 +93,6 @@ class EmailReplyRequest(BaseModel):
     original_message_id: str
 
 
-def get_message_by_rfc822_message_id(service, rfc822_id):
-    query = f'rfc822msgid:{rfc822_id}'
-    response = service.users().messages().list(userId='me', q=query).execute()
-    messages = response.get('messages', [])
-
-    if not messages:
-        return None
-
-    message_id = messages[0]['id']
-    return service.users().messages().get(userId='me', id=message_id, format='full').execute()
-
 def parsing_message(message):
     headers = message['payload']['headers']
     payload = message['payload']
@@ -78,16 +118,29 @@ def parsing_message(message):
     }
 
 
+def fetch_rfc822_message(mail_id):
+    # Il client torna nel pool subito dopo il fetch, non resta occupato durante lo stream
+    with gmail_clients.service() as service:
+        return get_message_by_rfc822_message_id(service, mail_id)
+
+
+def get_precomputed_triage(mail_id):
+    gmail_id = message_store.get_gmail_id(mail_id)
+    return message_store.get_triage(gmail_id) if gmail_id else None
+
+
 @app.websocket("/summary/{mail_id}/ws")
 async def websocket_summary(websocket: WebSocket, mail_id: str):
     await websocket.accept()
 
     try:
-        creds = authenticate()
-        service = build('gmail', 'v1', credentials=creds)
+        # Riassunto già pronto dal pre-triage: niente Gmail né Gemini
+        triage = await run_blocking(get_precomputed_triage, mail_id)
+        if triage and triage["summary"]:
+            await stream_to_websocket(websocket, iter([triage["summary"]]), name=f"summary:{mail_id}")
+            return
 
-        # Usa lo stesso metodo che già utilizzi
-        raw_msg = get_message_by_rfc822_message_id(service, mail_id)
+        raw_msg = await run_blocking(fetch_rfc822_message, mail_id)
         if raw_msg is None:
             await websocket.send_text("❌ Message not found")
             return
@@ -102,11 +155,10 @@ async def websocket_summary(websocket: WebSocket, mail_id: str):
                         
                         {parsed['body']}"""
 
-        stream = summary_email(full_text)
-
-        for chunk in stream:
-            await websocket.send_text(chunk)
-            await asyncio.sleep(0.5)
+        # Gemini gira nel pool dedicato; stream_slots limita gli stream contemporanei
+        async with stream_slots:
+            stream = await run_blocking(summary_email, full_text)
+            await stream_to_websocket(websocket, stream, name=f"summary:{mail_id}")
     except WebSocketDisconnect:
         pass
     except Exception as e:
@@ -120,11 +172,13 @@ async def websocket_draft(websocket: WebSocket, mail_id: str):
     await websocket.accept()
 
     try:
-        creds = authenticate()
-        service = build('gmail', 'v1', credentials=creds)
+        triage = await run_blocking(get_precomputed_triage, mail_id)
+        if triage and triage["draft_chunks"]:
+            await stream_to_websocket(websocket, iter(triage["draft_chunks"]), name=f"draft:{mail_id}")
+            return
 
         # Recupera la mail reale
-        raw_msg = get_message_by_rfc822_message_id(service, mail_id)
+        raw_msg = await run_blocking(fetch_rfc822_message, mail_id)
         if raw_msg is None:
             await websocket.send_text("❌ Message not found")
             return
@@ -136,13 +190,17 @@ async def websocket_draft(websocket: WebSocket, mail_id: str):
             username=parsed["from"].split(" ")[0] if " " in parsed["from"] else parsed["from"],
             email_content=parsed["body"],
             destination_email=parsed["from"],
+            # Se il pre-triage ha già la categoria il grafo salta la chiamata a Gemini
+            problem_type=triage["problem_type"] if triage else None,
             is_reply=False
         )
-        stream = process_email(state)
-
-        for chunk in stream:
-            await websocket.send_text(chunk["custom_key"])
-            await asyncio.sleep(0.5)
+        async with stream_slots:
+            # Checkpoint per Message-ID: una riconnessione riprende il grafo invece di rieseguirlo
+            stream = await run_blocking(process_email, state, normalize_rfc822_id(mail_id))
+            await stream_to_websocket(
+                websocket, stream, name=f"draft:{mail_id}",
+                transform=lambda chunk: chunk["custom_key"]
+            )
 
     except WebSocketDisconnect:
         pass
@@ -154,68 +212,190 @@ async def websocket_draft(websocket: WebSocket, mail_id: str):
 
 
 @app.get("/")
-def read_root():
+async def read_root():
     return {"message": "Welcome to the Gmail API FastAPI!"}
 
-@app.get("/unread-mails")
-def read_unread_emails():
-    try:
-        creds = authenticate()
-        service = build('gmail', 'v1', credentials=creds)
+@app.get("/llm-cache/stats")
+async def read_llm_cache_stats():
+    return llm_cache.stats()
 
-        messages = get_unread_messages(service)
-        if not messages:
-            return {"count": 0, "messages": []}
+@app.get("/llm/stats")
+async def read_llm_stats():
+    return llm_stats()
 
-        parsed_messages = [parse_message(service, msg['id']) for msg in messages]
-        return {"count": len(parsed_messages), "messages": parsed_messages}
+@app.get("/metrics")
+async def read_metrics():
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4")
+
+@app.get("/unread-mails")
+async def read_unread_emails(page_token: str = None, page_size: int = Query(100, ge=1, le=500), service=Depends(get_gmail_service)):
+    if page_token:
+        try:
+            parse_cursor(page_token)
+        except ValueError as e:
+            return JSONResponse(content={"error": str(e)}, status_code=400)
+    try:
+        # Servito dalla cache locale: dopo la prima sync Gmail restituisce solo le differenze
+        await run_blocking(mailbox_sync.sync, service)
+        page, next_page_token = await run_blocking(mailbox_sync.unread_page, page_token, page_size)
+        return {"count": len(page), "messages": page, "errors": [], "next_page_token": next_page_token}
 
     except Exception as e:
         return JSONResponse(content={"error": str(e)}, status_code=500)
 
-@app.post("/reply-mail")
-def reply_to_email(request: EmailReplyRequest):
+@app.get("/unread-mails/stream")
+async def stream_unread_emails(view: str = Query("full", pattern="^(full|metadata)$")):
+    # NDJSON: una riga per messaggio, emessa appena il suo batch è stato scaricato
+    def generate():
+        count = 0
+        try:
+            # Il client va preso qui: le dipendenze con yield vengono chiuse prima dello stream
+            with gmail_clients.service() as service:
+                msg_ids = (msg['id'] for msg in iter_unread_messages(service))
+                for kind, item in iter_parsed_messages(service, msg_ids, message_format=view):
+                    if kind == 'message':
+                        count += 1
+                    yield json.dumps({"type": kind, "data": item}, ensure_ascii=False) + "\n"
+            yield json.dumps({"type": "end", "count": count}) + "\n"
+        except Exception as e:
+            yield json.dumps({"type": "fatal", "error": str(e)}) + "\n"
+
+    return StreamingResponse(iterate_blocking(generate()), media_type="application/x-ndjson")
+
+@app.get("/messages/{message_id}/body")
+async def read_message_body(message_id: str, service=Depends(get_gmail_service)):
+    # Body scaricato e decodificato solo quando la mail viene aperta
     try:
-        creds = authenticate()
-        service = build('gmail', 'v1', credentials=creds)
+        parsed = await run_blocking(get_message_body, service, message_id)
+        return {"message_id": message_id, "text": parsed["text"]}
+    except Exception as e:
+        return JSONResponse(content={"error": str(e)}, status_code=500)
 
-        result = send_reply_email(
-            service,
+@app.post("/reply-mail", status_code=202)
+async def reply_to_email(request: EmailReplyRequest):
+    # Solo accodamento: l'invio vero lo fanno i worker dell'outbox
+    try:
+        outbox_id = await run_blocking(
+            outbox.enqueue,
             to=request.to,
             subject=request.subject,
             message_text=request.message,
             thread_id=request.thread_id,
             original_message_id=request.original_message_id
         )
-        return {"status": "success", "message_id": result["id"]}
+        return {"status": "queued", "message_id": outbox_id}
 
     except Exception as e:
         return JSONResponse(content={"error": str(e)}, status_code=500)
 
+@app.get("/outbox/{message_id}")
+async def read_outbox_status(message_id: str):
+    status = await run_blocking(outbox.status, message_id)
+    if status is None:
+        return JSONResponse(content={"error": "Message not found"}, status_code=404)
+    return status
+
+
+@app.get("/bug-reports/{report_id}")
+async def read_bug_report_status(report_id: str):
+    status = await run_blocking(issue_tracker.status, report_id)
+    if status is None:
+        return JSONResponse(content={"error": "Bug report not found"}, status_code=404)
+    return status
+
 
 
 @app.post("/get_from_id")
-def get_from_id(request: IdRequest):
+async def get_from_id(request: IdRequest, service=Depends(get_gmail_service)):
     try:
-        creds = authenticate()
-        service = build('gmail', 'v1', credentials=creds)
-
-        raw_msg = get_message_by_rfc822_message_id(service, request.original_id)
+        raw_msg = await run_blocking(get_message_by_rfc822_message_id, service, request.original_id)
         if raw_msg is None:
             return JSONResponse(content={"error": "Message not found"}, status_code=404)
 
-        parsed = parse_message(raw_msg)
+        parsed = await run_blocking(parse_raw_message, raw_msg)
         return {"status": "success", "message": parsed}
 
     except Exception as e:
         return JSONResponse(content={"error": str(e)}, status_code=500)
 
 @app.post("/mark-as-read")
-def mark_as_read(message_id: str):
+async def mark_message_as_read(request: MarkAsReadRequest, service=Depends(get_gmail_service)):
     try:
-        creds = authenticate()
-        service = build('gmail', 'v1', credentials=creds)
-        result = mark_as_read(service, message_id)
+        message_id = await run_blocking(resolve_gmail_id, service, request.message_id)
+        if message_id is None:
+            return JSONResponse(content={"error": "Message not found"}, status_code=404)
+        result = await run_blocking(mark_as_read, service, message_id)
+        await run_blocking(mailbox_sync.apply_label_changes, [message_id], remove_label_ids=['UNREAD'])
         return {"status": "success", "result": result["id"]}
     except Exception as e:
         return JSONResponse(content={"error": str(e)}, status_code=500)
+
+@app.post("/messages/batch-modify")
+async def batch_modify_messages(request: BatchModifyRequest, service=Depends(get_gmail_service)):
+    # Triage a raffica: una chiamata batchModify ogni 1000 messaggi
+    try:
+        message_ids = await run_blocking(
+            batch_modify_labels,
+            service,
+            request.ids,
+            request.add_label_ids,
+            request.remove_label_ids
+        )
+        await run_blocking(
+            mailbox_sync.apply_label_changes,
+            message_ids,
+            request.add_label_ids,
+            request.remove_label_ids
+        )
+        return {"status": "success", "count": len(message_ids)}
+    except Exception as e:
+        return JSONResponse(content={"error": str(e)}, status_code=500)
+
+@app.post("/gmail/push")
+async def gmail_push(envelope: dict, background_tasks: BackgroundTasks, token: str = None):
+    # Push di Pub/Sub per users.watch: si risponde subito, la sync gira dopo
+    if PUBSUB_VERIFICATION_TOKEN and token != PUBSUB_VERIFICATION_TOKEN:
+        return JSONResponse(content={"error": "Invalid token"}, status_code=403)
+    notification = decode_push_envelope(envelope)
+    if notification is not None:
+        background_tasks.add_task(notification_hub.handle_notification, notification)
+    return {"status": "ok"}
+
+@app.get("/events")
+async def mail_events():
+    # Server-Sent Events: un evento new_message per ogni mail non letta in arrivo
+    return StreamingResponse(notification_hub.event_stream(), media_type="text/event-stream")
+
+def triage_messages(service, message_ids):
+    cached = {message['message_id']: message for message in mailbox_sync.unread_messages()}
+    if not message_ids:
+        message_ids = list(cached)
+
+    # Body necessari: quelli non in cache (o in cache solo metadata) si scaricano in batch
+    missing = [msg_id for msg_id in message_ids if cached.get(msg_id, {}).get('text') is None]
+    parsed_messages, errors = parse_messages(service, missing)
+    cached.update({parsed['message_id']: parsed for parsed in parsed_messages})
+
+    items = [
+        {"message_id": msg_id, "subject": cached[msg_id]['subject'], "body": cached[msg_id]['text']}
+        for msg_id in message_ids if msg_id in cached
+    ]
+    labels = {
+        msg_id: problem_type for msg_id, problem_type in batch_categorize(items).items()
+        if problem_type in CATEGORIES
+    }
+    for item in items:
+        if item['message_id'] not in labels:
+            errors[item['message_id']] = "Could not classify the email"
+    for msg_id, problem_type in labels.items():
+        message_store.save_triage(msg_id, problem_type=problem_type)
+    return labels, errors
+
+@app.post("/triage/batch")
+async def batch_triage(request: BatchTriageRequest, service=Depends(get_gmail_service)):
+    # Categorie per molte mail con pochi prompt
+    try:
+        labels, errors = await run_blocking(triage_messages, service, request.message_ids)
+        return {"count": len(labels), "categories": labels, "errors": errors}
+    except Exception as e:
+        return JSONResponse(content={"error": str(e)}, status_code=500)
@@ -5,9 +5,73 @@ from langchain.embeddings import HuggingFaceEmbeddings
 from langchain.docstore.document import Document
 from langchain.document_loaders import JSONLoader, TextLoader, PyPDFLoader, CSVLoader
 import os
+import time
+import logging
+import threading
+from contextlib import nullcontext
+
+try:
+    from services.metrics import span, rag_seconds
+except ImportError:
+    # Script lanciati da services/RAG (daily_update, mockAgent): niente metriche
+    span = rag_seconds = None
 
 text_splitter = RecursiveCharacterTextSplitter(chunk_size=50, chunk_overlap=10)
 
+# Token massimi del contesto RAG incollato nei prompt
+CONTEXT_TOKEN_BUDGET = int(os.getenv("RAG_CONTEXT_TOKEN_BUDGET", "800"))
+CONTEXT_CANDIDATES = int(os.getenv("RAG_CONTEXT_CANDIDATES", "8"))
+# Sotto questa soglia non conviene aggiungere un pezzo di documento
+MIN_CHUNK_TOKENS = 30
+# Jaccard tra insiemi di parole oltre il quale due chunk sono lo stesso testo
+NEAR_DUPLICATE_JACCARD = 0.8
+
+logger = logging.getLogger(__name__)
+
+
+def estimate_tokens(text):
+    # Stima grezza (~4 caratteri per token): basta per rispettare il budget
+    return (len(text) + 3) // 4
+
+
+def truncate_to_tokens(text, tokens):
+    limit = tokens * 4
+    if len(text) <= limit:
+        return text
+    cut = text[:limit]
+    # Taglia all'ultima fine frase se non si perde troppo testo
+    end = max(cut.rfind(". "), cut.rfind("\n"))
+    return cut[:end + 1] if end > limit // 2 else cut
+
+
+def is_near_duplicate(a, b):
+    if a in b or b in a:
+        return True
+    words_a, words_b = set(a.lower().split()), set(b.lower().split())
+    if not words_a or not words_b:
+        return False
+    return len(words_a & words_b) / len(words_a | words_b) >= NEAR_DUPLICATE_JACCARD
+
+
+def is_adjacent(group, doc):
+    source = doc.metadata.get("source")
+    chunk = doc.metadata.get("chunk")
+    if chunk is None:
+        return False
+    return any(
+        other.metadata.get("source") == source and other.metadata.get("chunk") is not None
+        and abs(other.metadata["chunk"] - chunk) == 1
+        for other in group
+    )
+
+
+def merge_overlap(first, second, min_overlap=20):
+    """Concatena due chunk consecutivi togliendo la parte sovrapposta."""
+    for size in range(min(len(first), len(second)), min_overlap - 1, -1):
+        if first.endswith(second[:size]):
+            return first + second[size:]
+    return f"{first} {second}"
+
 class RAGModule:
     def __init__(self, index_path="./faiss_index", model_name="all-MiniLM-L6-v2"):
         # Embedding + vector store
@@ -18,32 +82,125 @@ class RAGModule:
             print("-------------")
             print(index_path)
             raise FileNotFoundError(f"L'indice FAISS non è stato trovato in: {index_path}. Esegui prima 'index_all.py'.")
+        self.last_context_stats = None
+        self.index_path = index_path
+        self.index_version = self._read_index_version()
+        # Query costanti (es. policy rimborsi) con il contesto precalcolato per versione dell'indice
+        self._static_queries = {}
+        self._static_contexts = {}
+        self._static_lock = threading.Lock()
 
 
 
     def get_similar_cases(self, message, k=5):
         """Ritorna i k documenti più simili dal DB"""
-        return self.vectorstore.similarity_search(message, k=k)
+        with self._span("similarity_search"):
+            return self.vectorstore.similarity_search(message, k=k)
+
+    def _span(self, operation):
+        return span(rag_seconds, operation=operation) if span else nullcontext()
+
+    def build_context(self, similar_docs, token_budget=CONTEXT_TOKEN_BUDGET):
+        """
+        Costruisce il contesto per il prompt restando entro token_budget:
+        scarta i chunk duplicati o quasi identici, unisce i chunk adiacenti della stessa
+        fonte e aggiunge i documenti in ordine di rilevanza, troncando l'ultimo.
+        """
+        naive_tokens = estimate_tokens("".join(doc.page_content for doc in similar_docs[:5]))
+
+        # 1. Deduplica (similar_docs è già ordinato per rilevanza)
+        kept = []
+        for doc in similar_docs:
+            if not any(is_near_duplicate(doc.page_content, other.page_content) for other in kept):
+                kept.append(doc)
+
+        # 2. Unisce i chunk consecutivi della stessa fonte, nella posizione del più rilevante
+        groups = []
+        for doc in kept:
+            for group in groups:
+                if is_adjacent(group, doc):
+                    group.append(doc)
+                    break
+            else:
+                groups.append([doc])
 
-    def build_context(self, similar_docs):
+        # 3. Riempie il budget in ordine di rilevanza
         context = ""
-        for i, doc in enumerate(similar_docs):
-            context += f"\nDocumento {i+1} (Fonte: {doc.metadata.get('source', 'Sconosciuta')}):\n{doc.page_content}\n"
+        used_tokens = 0
+        for i, group in enumerate(groups):
+            group.sort(key=lambda d: d.metadata.get("chunk", 0))
+            text = group[0].page_content
+            for doc in group[1:]:
+                text = merge_overlap(text, doc.page_content)
+            header = f"\nDocumento {i+1} (Fonte: {group[0].metadata.get('source', 'Sconosciuta')}):\n"
+            remaining = token_budget - used_tokens - estimate_tokens(header)
+            if remaining < MIN_CHUNK_TOKENS:
+                break
+            if estimate_tokens(text) > remaining:
+                text = truncate_to_tokens(text, remaining)
+            context += f"{header}{text}\n"
+            used_tokens += estimate_tokens(header) + estimate_tokens(text)
 
+        self.last_context_stats = {
+            "candidates": len(similar_docs),
+            "documents": len(groups),
+            "naive_tokens": naive_tokens,
+            "context_tokens": used_tokens,
+            "tokens_saved": max(0, naive_tokens - used_tokens),
+        }
+        logger.info(f"RAG context: {self.last_context_stats}")
+        return context
 
-        print(context)
+    def generate_context(self, message, token_budget=CONTEXT_TOKEN_BUDGET):
+        # Più candidati del vecchio top-5: il budget decide quanti entrano davvero
+        with self._span("generate_context"):
+            similar_docs = self.get_similar_cases(message, k=CONTEXT_CANDIDATES)
+            context = self.build_context(similar_docs, token_budget)
         return context
 
-    def generate_context(self, message):
-        similar_docs = self.get_similar_cases(message)
-        context = self.build_context(similar_docs)
+    def _read_index_version(self):
+        # Cambia quando index_all.py o update_vectorstore.py riscrivono l'indice su disco
+        index_file = os.path.join(self.index_path, "index.faiss")
+        if not os.path.exists(index_file):
+            return None
+        stat = os.stat(index_file)
+        return f"{stat.st_mtime_ns}-{stat.st_size}-{self.vectorstore.index.ntotal}"
+
+    def register_static_query(self, name, query):
+        """Registra una query costante: il suo contesto viene calcolato una volta per versione dell'indice."""
+        with self._static_lock:
+            self._static_queries[name] = query
+            self._static_contexts.pop(name, None)
+
+    def static_context(self, name):
+        with self._static_lock:
+            cached = self._static_contexts.get(name)
+            if cached is not None and cached[0] == self.index_version:
+                return cached[1]
+            query = self._static_queries[name]
+        context = self.generate_context(query)
+        with self._static_lock:
+            self._static_contexts[name] = (self.index_version, context)
         return context
 
+    def refresh_static_contexts(self):
+        for name in list(self._static_queries):
+            self.static_context(name)
+
+    def warm_up(self):
+        """Carica modello e indice e precalcola le query costanti prima della prima richiesta."""
+        started = time.perf_counter()
+        self.vectorstore.similarity_search("warm up", k=1)
+        self.refresh_static_contexts()
+        logger.info(f"RAG warm-up done in {time.perf_counter() - started:.2f}s")
+
     def update_index(self, data_path, file_type="json"):
         """Aggiorna l'indice FAISS con nuovi documenti, applicando il chunking."""
         documents_to_add = self.load_and_process(data_path, file_type)
         self.vectorstore.add_documents(documents_to_add)
         self.vectorstore.save_local("./faiss_index")
+        self.index_version = self._read_index_version()
+        self.refresh_static_contexts()
         print(f"✅ Indice FAISS aggiornato con chunking da: {data_path}")
 
     def load_and_process(self, file_path, file_type):
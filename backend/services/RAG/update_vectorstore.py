@@ -1,5 +1,5 @@
 import os
-import json
+import sys
 from datetime import datetime
 from langchain.vectorstores import FAISS
 from langchain.embeddings import HuggingFaceEmbeddings
@@ -10,19 +10,17 @@ CONVERSATION_DIR = "../../conversations"
 VECTORSTORE_DIR = "../../faiss_index"
 EMBEDDING_MODEL_NAME = "sentence-transformers/all-MiniLM-L6-v2"
 
-def get_today_filename():
-    today = datetime.today().strftime("%Y-%m-%d")
-    return os.path.join(CONVERSATION_DIR, f"conversations_{today}.json")
+# Lo script gira da services/RAG: rende importabile il package services
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "../..")))
+from services.message_store import MessageStore
 
 def update_vectorstore_from_today():
-    json_path = get_today_filename()
-    if not os.path.exists(json_path):
-        print("❌ Nessun file JSON per oggi.")
+    store = MessageStore(os.path.join(CONVERSATION_DIR, "conversations.db"))
+    data = store.get_day_conversations(datetime.today().strftime("%Y-%m-%d"))
+    if not data:
+        print("❌ Nessuna conversazione per oggi.")
         return
 
-    with open(json_path, 'r') as f:
-        data = json.load(f)
-
     all_texts = []
     for thread_id, thread in data.items():
         conversation = f"Subject: {thread['subject']}\n\n"
@@ -0,0 +1,125 @@
+import os
+import re
+import json
+import logging
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+
+from lang import call_gemini, classify_email, category_classifier
+from services.category_classifier import CATEGORIES
+from services.concurrency import RateLimiter
+
+# Limiti di un singolo prompt di triage
+BATCH_TRIAGE_MAX_ITEMS = int(os.getenv("BATCH_TRIAGE_MAX_ITEMS", "25"))
+BATCH_TRIAGE_MAX_CHARS = int(os.getenv("BATCH_TRIAGE_MAX_CHARS", "12000"))
+BATCH_TRIAGE_BODY_CHARS = 1500
+BATCH_TRIAGE_CONCURRENCY = int(os.getenv("BATCH_TRIAGE_CONCURRENCY", "4"))
+# Richieste al secondo verso Gemini per il triage
+BATCH_TRIAGE_RPS = float(os.getenv("BATCH_TRIAGE_RPS", "1"))
+
+logger = logging.getLogger(__name__)
+
+rate_limiter = RateLimiter(BATCH_TRIAGE_RPS, burst=BATCH_TRIAGE_CONCURRENCY)
+triage_executor = ThreadPoolExecutor(max_workers=BATCH_TRIAGE_CONCURRENCY, thread_name_prefix="triage")
+
+
+def format_item(index, item):
+    body = (item.get("body") or "")[:BATCH_TRIAGE_BODY_CHARS]
+    return f"### {index}\nSubject: {item.get('subject') or ''}\n{body}\n"
+
+
+def pack_batches(items, max_items=BATCH_TRIAGE_MAX_ITEMS, max_chars=BATCH_TRIAGE_MAX_CHARS):
+    """Group items into prompts bounded by item count and size."""
+    batches = []
+    current, size = [], 0
+    for item in items:
+        item_size = len(format_item(0, item))
+        if current and (len(current) >= max_items or size + item_size > max_chars):
+            batches.append(current)
+            current, size = [], 0
+        current.append(item)
+        size += item_size
+    if current:
+        batches.append(current)
+    return batches
+
+
+def parse_batch_response(response, count):
+    """Map the JSON answer back to {index: category}; unknown or missing items are left out."""
+    # Gemini spesso racchiude il JSON in un blocco ```json
+    match = re.search(r'\[.*\]', response, re.DOTALL)
+    if not match:
+        return {}
+    try:
+        data = json.loads(match.group(0))
+    except ValueError:
+        return {}
+    labels = {}
+    for entry in data:
+        if not isinstance(entry, dict):
+            continue
+        try:
+            index = int(entry.get("id"))
+        except (TypeError, ValueError):
+            continue
+        category = str(entry.get("category", "")).strip().lower()
+        if 0 <= index < count and category in CATEGORIES:
+            labels[index] = category
+    return labels
+
+
+def categorize_batch(batch):
+    emails = "\n".join(format_item(i, item) for i, item in enumerate(batch))
+    prompt = f"""
+        Classify each email below into one of these categories:
+        {", ".join(CATEGORIES)}
+
+        {emails}
+
+        Output format:
+        a JSON array with one object per email, like [{{"id": 0, "category": "faq"}}]
+        RESPOND WITH ONLY THE JSON ARRAY
+    """
+    rate_limiter.acquire()
+    labels = parse_batch_response(call_gemini(prompt, task="categorize"), len(batch))
+
+    results = {}
+    for i, item in enumerate(batch):
+        if i in labels:
+            results[item["message_id"]] = labels[i]
+            category_classifier.record(item.get("subject"), item.get("body"), labels[i])
+        else:
+            # Risposta non parsabile per questo item: riprova da solo
+            logger.info(f"Batch triage fallback for {item['message_id']}")
+            rate_limiter.acquire()
+            label = classify_email(item.get("subject"), item.get("body"))
+            if label in CATEGORIES:
+                results[item["message_id"]] = label
+            else:
+                logger.warning(f"Batch triage could not classify {item['message_id']}: {label}")
+    return results
+
+
+def batch_categorize(items):
+    """
+    Categorize many emails with few LLM requests.
+    items: [{'message_id', 'subject', 'body'}]; returns {message_id: category},
+    leaving out the emails that could not be classified.
+    Confident local classifications skip the LLM entirely.
+    """
+    results = {}
+    pending = []
+    for item in items:
+        label, confidence = category_classifier.predict(item.get("subject"), item.get("body"))
+        if label is not None and confidence >= category_classifier.confidence:
+            results[item["message_id"]] = label
+        else:
+            pending.append(item)
+
+    futures = [
+        triage_executor.submit(contextvars.copy_context().run, categorize_batch, batch)
+        for batch in pack_batches(pending)
+    ]
+    for future in futures:
+        results.update(future.result())
+    return results
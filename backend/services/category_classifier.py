@@ -0,0 +1,191 @@
+import os
+import re
+import time
+import hashlib
+import logging
+import threading
+
+import numpy as np
+
+from services.message_store import connect_sqlite
+
+CATEGORIES = ("username_change", "password_reset", "refund_request", "bug_report", "faq", "other")
+# Prompt di classificazione di una singola mail (classify_email e il backend sintetico)
+CLASSIFY_PROMPT = """
+        Classify the email with subject: {subject}, content: {email_content} into one of these categories:
+        username_change, password_reset, refund_request, bug_report, faq or other
+    """
+CLASSIFIER_DB_PATH = os.path.join("cache", "category_classifier.db")
+# Quota minima di voti k-NN per rispondere senza chiamare Gemini
+CLASSIFIER_CONFIDENCE = float(os.getenv("CLASSIFIER_CONFIDENCE", "0.8"))
+CLASSIFIER_K = int(os.getenv("CLASSIFIER_K", "7"))
+# Sotto questo numero di esempi etichettati si usa sempre l'LLM
+CLASSIFIER_MIN_EXAMPLES = int(os.getenv("CLASSIFIER_MIN_EXAMPLES", "30"))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS examples (
+    key TEXT PRIMARY KEY,
+    subject TEXT,
+    text TEXT,
+    label TEXT NOT NULL,
+    embedding BLOB NOT NULL,
+    llm_ms REAL,
+    created_at REAL NOT NULL
+);
+"""
+
+logger = logging.getLogger(__name__)
+
+
+def example_text(subject, email_content):
+    return f"{subject or ''}\n{email_content or ''}".strip()
+
+
+def normalize_category(response):
+    """
+    Map a raw LLM answer ("Faq.", "**bug_report**", "Category: refund request")
+    to one of CATEGORIES; None when it names no category or more than one.
+    """
+    words = re.sub(r'[^a-z_ ]+', ' ', (response or "").strip().lower()).split()
+    cleaned = "_".join(words)
+    if cleaned in CATEGORIES:
+        return cleaned
+    found = {category for category in CATEGORIES if category in cleaned}
+    return found.pop() if len(found) == 1 else None
+
+
+class CategoryClassifier:
+    """
+    k-NN classifier over the MiniLM embeddings, trained on the labels Gemini gave
+    to past emails.
+
+    Every LLM categorization is recorded with its embedding; predict() returns the
+    weighted majority label of the k most similar examples and the share of votes
+    it got, so callers can fall back to the LLM below a confidence threshold.
+    """
+
+    def __init__(self, embedding_model, db_path=CLASSIFIER_DB_PATH, k=CLASSIFIER_K,
+                 confidence=CLASSIFIER_CONFIDENCE, min_examples=CLASSIFIER_MIN_EXAMPLES):
+        self.embedding_model = embedding_model
+        self.db_path = db_path
+        self.k = k
+        self.confidence = confidence
+        self.min_examples = min_examples
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._vectors = []
+        self._labels = []
+        self._matrix = None
+        self._load()
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = connect_sqlite(self.db_path)
+            conn.executescript(SCHEMA)
+            self._local.conn = conn
+        return conn
+
+    def _load(self):
+        if not os.path.exists(self.db_path):
+            return
+        for row in self._connect().execute("SELECT label, embedding FROM examples ORDER BY created_at"):
+            self._vectors.append(np.frombuffer(row["embedding"], dtype='float32'))
+            self._labels.append(row["label"])
+        logger.info(f"Category classifier loaded {len(self._labels)} examples")
+
+    def embed(self, subject, email_content):
+        vector = np.array(self.embedding_model.embed_query(example_text(subject, email_content)), dtype='float32')
+        return vector / (np.linalg.norm(vector) or 1.0)
+
+    def record(self, subject, email_content, label, llm_ms=None):
+        """Store an LLM-labeled email as a training example."""
+        if label not in CATEGORIES:
+            return
+        key = hashlib.sha1(example_text(subject, email_content).encode('utf-8')).hexdigest()
+        vector = self.embed(subject, email_content)
+        with self._connect() as conn:
+            inserted = conn.execute(
+                "INSERT OR IGNORE INTO examples (key, subject, text, label, embedding, llm_ms, created_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (key, subject, email_content, label, vector.tobytes(), llm_ms, time.time())
+            ).rowcount
+        if inserted:
+            with self._lock:
+                self._vectors.append(vector)
+                self._labels.append(label)
+                self._matrix = None
+
+    def _vote(self, matrix, labels, vector, exclude=None):
+        similarities = matrix @ vector
+        if exclude is not None:
+            similarities[exclude] = -np.inf
+        top = np.argsort(-similarities)[:self.k]
+        votes = {}
+        for i in top:
+            if np.isfinite(similarities[i]):
+                votes[labels[i]] = votes.get(labels[i], 0.0) + max(float(similarities[i]), 0.0)
+        total = sum(votes.values())
+        if not total:
+            return None, 0.0
+        label = max(votes, key=votes.get)
+        return label, votes[label] / total
+
+    def predict(self, subject, email_content):
+        """Return (label, confidence); label is None when there are too few examples."""
+        with self._lock:
+            if len(self._labels) < self.min_examples:
+                return None, 0.0
+            if self._matrix is None:
+                self._matrix = np.vstack(self._vectors)
+            matrix, labels = self._matrix, list(self._labels)
+        return self._vote(matrix, labels, self.embed(subject, email_content))
+
+    def report(self):
+        """
+        Leave-one-out evaluation of the local classifier against the stored LLM labels:
+        accuracy, share of emails answered locally at the configured confidence and
+        latency compared with the recorded LLM calls.
+        """
+        rows = self._connect().execute("SELECT subject, text, label, embedding, llm_ms FROM examples").fetchall()
+        if len(rows) < 2:
+            return {"examples": len(rows)}
+        matrix = np.vstack([np.frombuffer(row["embedding"], dtype='float32') for row in rows])
+        labels = [row["label"] for row in rows]
+
+        correct = confident = confident_correct = 0
+        for i, row in enumerate(rows):
+            label, confidence = self._vote(matrix, labels, matrix[i], exclude=i)
+            correct += label == row["label"]
+            if confidence >= self.confidence:
+                confident += 1
+                confident_correct += label == row["label"]
+
+        # Latenza misurata sul percorso reale: embedding + k-NN
+        timings = []
+        for row in rows[:50]:
+            started = time.perf_counter()
+            self._vote(matrix, labels, self.embed(row["subject"], row["text"]))
+            timings.append((time.perf_counter() - started) * 1000)
+        llm_timings = [row["llm_ms"] for row in rows if row["llm_ms"] is not None]
+
+        return {
+            "examples": len(rows),
+            "accuracy": correct / len(rows),
+            "threshold": self.confidence,
+            "local_coverage": confident / len(rows),
+            "local_accuracy": confident_correct / confident if confident else None,
+            "local_p50_ms": float(np.percentile(timings, 50)),
+            "local_p95_ms": float(np.percentile(timings, 95)),
+            "llm_p50_ms": float(np.percentile(llm_timings, 50)) if llm_timings else None,
+            "llm_p95_ms": float(np.percentile(llm_timings, 95)) if llm_timings else None,
+        }
+
+
+if __name__ == '__main__':
+    import json
+    from langchain.embeddings import HuggingFaceEmbeddings
+
+    # Report offline: python -m services.category_classifier
+    classifier = CategoryClassifier(HuggingFaceEmbeddings(model_name="all-MiniLM-L6-v2"))
+    print(json.dumps(classifier.report(), indent=2))
@@ -0,0 +1,95 @@
+import os
+import time
+import asyncio
+import functools
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+
+import anyio.to_thread
+
+# Thread dedicati alle chiamate bloccanti (Gmail, Gemini, FAISS)
+BLOCKING_WORKERS = int(os.getenv("BLOCKING_WORKERS", "32"))
+# Stream LLM (summary/draft) contemporanei per worker uvicorn
+MAX_CONCURRENT_STREAMS = int(os.getenv("MAX_CONCURRENT_STREAMS", "16"))
+# Thread del pool di default di FastAPI (dipendenze ed endpoint sincroni)
+DEFAULT_THREADPOOL_SIZE = int(os.getenv("DEFAULT_THREADPOOL_SIZE", "40"))
+
+blocking_executor = ThreadPoolExecutor(max_workers=BLOCKING_WORKERS, thread_name_prefix="blocking")
+stream_slots = asyncio.Semaphore(MAX_CONCURRENT_STREAMS)
+
+_DONE = object()
+
+
+class RateLimiter:
+    """
+    Thread-safe token bucket: `rate` operations per second with bursts up to `burst`.
+    acquire() blocks the calling thread until a token is available.
+    """
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+def configure_threadpool():
+    """Resize the anyio threadpool used by FastAPI for sync dependencies."""
+    anyio.to_thread.current_default_thread_limiter().total_tokens = DEFAULT_THREADPOOL_SIZE
+
+
+async def run_blocking(func, *args, **kwargs):
+    """Run a blocking call on the dedicated executor without stalling the event loop."""
+    loop = asyncio.get_running_loop()
+    # Come asyncio.to_thread: i contextvars della richiesta (etichette delle metriche) seguono la chiamata
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(blocking_executor, functools.partial(context.run, func, *args, **kwargs))
+
+
+async def iterate_blocking(iterable):
+    """
+    Async iterator over a synchronous generator (LLM stream, LangGraph stream...).
+    Each next() runs on the dedicated executor, so a slow chunk only holds one thread.
+    The generator is closed when the iteration stops early or is cancelled.
+    """
+    iterator = await run_blocking(iter, iterable)
+    # next() e close() non possono sovrapporsi sullo stesso generatore
+    lock = threading.Lock()
+
+    def advance():
+        with lock:
+            return next(iterator, _DONE)
+
+    def close():
+        with lock:
+            if hasattr(iterator, "close"):
+                iterator.close()
+
+    try:
+        while True:
+            item = await run_blocking(advance)
+            if item is _DONE:
+                break
+            yield item
+    finally:
+        # Consumer interrotto (client disconnesso, task cancellato): chiude il generatore così
+        # LangGraph e lo stream LLM si fermano; il close aspetta l'eventuale next() in corso
+        blocking_executor.submit(contextvars.copy_context().run, close)
+
+
+def shutdown():
+    blocking_executor.shutdown(wait=False, cancel_futures=True)
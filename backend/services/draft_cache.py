@@ -0,0 +1,201 @@
+import os
+import re
+import json
+import time
+import logging
+import threading
+
+import faiss
+import numpy as np
+
+DRAFT_CACHE_DIR = os.path.join("cache", "draft_cache")
+# Similarità coseno minima per riusare una bozza
+DRAFT_CACHE_THRESHOLD = float(os.getenv("DRAFT_CACHE_THRESHOLD", "0.92"))
+# Bozze tenute per problem_type; oltre si scarta quella usata meno di recente
+DRAFT_CACHE_MAX_ENTRIES = int(os.getenv("DRAFT_CACHE_MAX_ENTRIES", "500"))
+# Le modifiche si scrivono su disco ogni N bozze aggiunte o dopo questi secondi
+DRAFT_CACHE_FLUSH_EVERY = int(os.getenv("DRAFT_CACHE_FLUSH_EVERY", "20"))
+DRAFT_CACHE_FLUSH_SECONDS = float(os.getenv("DRAFT_CACHE_FLUSH_SECONDS", "60"))
+# Le bozze di password_reset/username_change contengono link personali: mai riusarle
+CACHEABLE_PROBLEM_TYPES = ("faq", "other", "refund_request", "bug_report")
+
+USERNAME_PLACEHOLDER = "{{username}}"
+EMAIL_PLACEHOLDER = "{{destination_email}}"
+
+logger = logging.getLogger(__name__)
+
+
+def normalize_email(text):
+    """Drop quoted replies and signature, collapse whitespace, lowercase."""
+    lines = []
+    for line in text.splitlines():
+        if line.strip() == "--":
+            break
+        if line.lstrip().startswith(">"):
+            continue
+        lines.append(line)
+    return re.sub(r'\s+', ' ', " ".join(lines)).strip().lower()
+
+
+def make_template(draft, username=None, destination_email=None):
+    """
+    Draft with the recipient replaced by placeholders, or None if it stays personal.
+
+    The address is replaced wherever it appears; the name only on the greeting line
+    and as a whole word, so a short or common name does not touch the rest of the
+    text. A draft that still mentions the name after that is not reusable.
+    """
+    template = draft
+    if destination_email:
+        template = template.replace(destination_email, EMAIL_PLACEHOLDER)
+    if username:
+        name = re.compile(rf'(?<!\w){re.escape(username)}(?!\w)')
+        lines = template.split("\n")
+        for i, line in enumerate(lines):
+            if line.strip():
+                lines[i] = name.sub(USERNAME_PLACEHOLDER, line)
+                break
+        template = "\n".join(lines)
+        if name.search(template.replace(USERNAME_PLACEHOLDER, "").replace(EMAIL_PLACEHOLDER, "")):
+            return None
+    return template
+
+
+def render_template(template, username=None, destination_email=None):
+    """Fill the placeholders of a cached draft; None if a needed value is missing."""
+    if (USERNAME_PLACEHOLDER in template and not username) or (EMAIL_PLACEHOLDER in template and not destination_email):
+        return None
+    return template.replace(USERNAME_PLACEHOLDER, username or "").replace(EMAIL_PLACEHOLDER, destination_email or "")
+
+
+class DraftCache:
+    """
+    Semantic cache of generated drafts.
+
+    Each problem_type has its own FAISS inner-product index over normalized MiniLM
+    embeddings of the incoming emails (so the score is the cosine similarity).
+    Drafts are stored as templates with the recipient's name and address replaced
+    by placeholders, and a lookup above the threshold fills them in for the new
+    recipient. Each type keeps at most max_entries drafts, evicting the least
+    recently used; changes are written to disk in batches (see flush()).
+    """
+
+    def __init__(self, embedding_model, cache_dir=DRAFT_CACHE_DIR, threshold=DRAFT_CACHE_THRESHOLD,
+                 max_entries=DRAFT_CACHE_MAX_ENTRIES, flush_every=DRAFT_CACHE_FLUSH_EVERY,
+                 flush_seconds=DRAFT_CACHE_FLUSH_SECONDS):
+        self.embedding_model = embedding_model
+        self.cache_dir = cache_dir
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.flush_every = flush_every
+        self.flush_seconds = flush_seconds
+        self._indexes = {}
+        self._entries = {}
+        self._dirty = set()
+        self._unsaved_adds = 0
+        self._flushed_at = time.monotonic()
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._load()
+
+    def _paths(self, problem_type):
+        return (os.path.join(self.cache_dir, f"{problem_type}.faiss"),
+                os.path.join(self.cache_dir, f"{problem_type}.json"))
+
+    def _load(self):
+        for problem_type in CACHEABLE_PROBLEM_TYPES:
+            index_path, entries_path = self._paths(problem_type)
+            if os.path.exists(index_path) and os.path.exists(entries_path):
+                self._indexes[problem_type] = faiss.read_index(index_path)
+                with open(entries_path, 'r') as f:
+                    entries = json.load(f)
+                for entry in entries:
+                    if "template" not in entry:
+                        # Formato precedente: bozza con destinatario in chiaro
+                        entry["template"] = make_template(entry.pop("draft"), entry.pop("username", None),
+                                                          entry.pop("destination_email", None))
+                        entry["last_used"] = 0.0
+                self._entries[problem_type] = entries
+
+    def flush(self):
+        """Write the indexes and entries changed since the last flush."""
+        with self._flush_lock:
+            with self._lock:
+                snapshot = [
+                    (problem_type, faiss.serialize_index(self._indexes[problem_type]).tobytes(),
+                     json.dumps(self._entries[problem_type], ensure_ascii=False))
+                    for problem_type in self._dirty
+                ]
+                self._dirty.clear()
+                self._unsaved_adds = 0
+                self._flushed_at = time.monotonic()
+            if not snapshot:
+                return
+            os.makedirs(self.cache_dir, exist_ok=True)
+            for problem_type, index_bytes, entries_json in snapshot:
+                index_path, entries_path = self._paths(problem_type)
+                # File temporaneo + rename: un crash a metà scrittura non lascia indice ed entry disallineati
+                for path, data, mode in ((index_path, index_bytes, 'wb'), (entries_path, entries_json, 'w')):
+                    with open(path + ".tmp", mode) as f:
+                        f.write(data)
+                    os.replace(path + ".tmp", path)
+
+    def _embed(self, email_content):
+        vector = np.array([self.embedding_model.embed_query(normalize_email(email_content))], dtype='float32')
+        faiss.normalize_L2(vector)
+        return vector
+
+    def lookup(self, email_content, problem_type, username=None, destination_email=None):
+        """Return an adapted cached draft for a near-duplicate email, or None."""
+        if problem_type not in CACHEABLE_PROBLEM_TYPES:
+            return None
+        with self._lock:
+            index = self._indexes.get(problem_type)
+            if index is None or index.ntotal == 0:
+                return None
+        vector = self._embed(email_content)
+        with self._lock:
+            scores, ids = index.search(vector, 1)
+            if ids[0][0] < 0 or scores[0][0] < self.threshold:
+                return None
+            entry = self._entries[problem_type][ids[0][0]]
+            if entry["template"] is None:
+                return None
+            draft = render_template(entry["template"], username, destination_email)
+            if draft is None:
+                return None
+            entry["last_used"] = time.time()
+            self._dirty.add(problem_type)
+        logger.info(f"Draft cache hit for {problem_type} (similarity {scores[0][0]:.3f})")
+        return draft
+
+    def _evict(self, problem_type):
+        entries = self._entries[problem_type]
+        while entries and len(entries) >= self.max_entries:
+            oldest = min(range(len(entries)), key=lambda i: entries[i]["last_used"])
+            # IndexFlat compatta gli id dopo remove_ids: restano allineati alla lista
+            self._indexes[problem_type].remove_ids(np.array([oldest], dtype='int64'))
+            del entries[oldest]
+
+    def add(self, email_content, problem_type, draft, username=None, destination_email=None):
+        if problem_type not in CACHEABLE_PROBLEM_TYPES or not draft or draft.startswith("Error:"):
+            return
+        template = make_template(draft, username, destination_email)
+        if template is None:
+            logger.info(f"Draft for {problem_type} mentions the recipient outside the greeting, not cached")
+            return
+        vector = self._embed(email_content)
+        with self._lock:
+            index = self._indexes.get(problem_type)
+            if index is None:
+                index = self._indexes[problem_type] = faiss.IndexFlatIP(vector.shape[1])
+                self._entries[problem_type] = []
+            self._evict(problem_type)
+            index.add(vector)
+            self._entries[problem_type].append({"template": template, "last_used": time.time()})
+            self._dirty.add(problem_type)
+            self._unsaved_adds += 1
+            due = (self._unsaved_adds >= self.flush_every
+                   or time.monotonic() - self._flushed_at >= self.flush_seconds)
+        if due:
+            self.flush()
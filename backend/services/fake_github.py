@@ -0,0 +1,143 @@
+import re
+import json
+import argparse
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+ISSUES_PATH = re.compile(r'^/repos/(?P<repo>[^/]+/[^/]+)/issues(?:/(?P<number>\d+))?(?P<comments>/comments)?/?$')
+
+
+class FakeGitHub:
+    """
+    In-memory stand-in for the few GitHub REST endpoints the issue tracker uses
+    (create, get and list issues, add comments). Point GITHUB_API_URL at it to
+    exercise bug report filing and deduplication without a token or network;
+    fail_next() simulates an outage for the retry path.
+    """
+
+    def __init__(self, host="127.0.0.1", port=0):
+        self.issues = {}
+        self.comments = {}
+        self.requests = []
+        self._failures = []
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), self._handler())
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def fail_next(self, count=1, status=502):
+        """Answer the next `count` requests with an error status."""
+        with self._lock:
+            self._failures.extend([status] * count)
+
+    def _take_failure(self, method, path):
+        with self._lock:
+            self.requests.append((method, path))
+            return self._failures.pop(0) if self._failures else None
+
+    def _issue_json(self, repo, number):
+        issue = self.issues[(repo, number)]
+        return {
+            **issue,
+            "url": f"{self.url}/repos/{repo}/issues/{number}",
+            "html_url": f"{self.url}/{repo}/issues/{number}",
+            "comments": len(self.comments.get((repo, number), [])),
+        }
+
+    def _handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def _reply(self, status, payload):
+                body = json.dumps(payload).encode('utf-8')
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _match(self):
+                return ISSUES_PATH.match(self.path.split("?")[0])
+
+            def _failed(self):
+                status = fake._take_failure(self.command, self.path)
+                if status is not None:
+                    self._reply(status, {"message": "Server Error"})
+                return status is not None
+
+            def do_GET(self):
+                if self._failed():
+                    return
+                match = self._match()
+                if not match:
+                    return self._reply(404, {"message": "Not Found"})
+                repo, number = match["repo"], match["number"]
+                with fake._lock:
+                    if number is None:
+                        return self._reply(200, [fake._issue_json(r, n) for r, n in fake.issues if r == repo])
+                    if (repo, int(number)) not in fake.issues:
+                        return self._reply(404, {"message": "Not Found"})
+                    if match["comments"]:
+                        return self._reply(200, fake.comments.get((repo, int(number)), []))
+                    return self._reply(200, fake._issue_json(repo, int(number)))
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                data = json.loads(self.rfile.read(length) or b"{}")
+                if self._failed():
+                    return
+                match = self._match()
+                if not match:
+                    return self._reply(404, {"message": "Not Found"})
+                repo, number = match["repo"], match["number"]
+                with fake._lock:
+                    if number is None:
+                        number = sum(1 for r, _ in fake.issues if r == repo) + 1
+                        fake.issues[(repo, number)] = {
+                            "id": number,
+                            "number": number,
+                            "title": data.get("title", ""),
+                            "body": data.get("body"),
+                            "state": "open",
+                            "labels": [{"name": label} for label in data.get("labels", [])],
+                        }
+                        return self._reply(201, fake._issue_json(repo, number))
+                    number = int(number)
+                    if not match["comments"] or (repo, number) not in fake.issues:
+                        return self._reply(404, {"message": "Not Found"})
+                    comments = fake.comments.setdefault((repo, number), [])
+                    comment = {
+                        "id": len(comments) + 1,
+                        "body": data.get("body"),
+                        "url": f"{fake.url}/repos/{repo}/issues/comments/{len(comments) + 1}",
+                    }
+                    comments.append(comment)
+                    return self._reply(201, comment)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name="fake-github", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+if __name__ == '__main__':
+    # python -m services.fake_github --port 8765, poi GITHUB_API_URL=http://127.0.0.1:8765
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=8765)
+    args = parser.parse_args()
+    server = FakeGitHub(port=args.port)
+    print(f"Fake GitHub API on {server.url}")
+    server._server.serve_forever()
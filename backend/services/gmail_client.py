@@ -0,0 +1,129 @@
+import os
+import time
+import queue
+import threading
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+
+import httplib2
+import google_auth_httplib2
+from google.auth.transport.requests import Request
+from googleapiclient.discovery import build
+
+from services.gmail_service import authenticate, TOKEN_PATH
+from services.metrics import gmail_seconds, gmail_operation
+
+# Quanti client Gmail tenere aperti (ognuno ha la sua connessione HTTP persistente)
+POOL_SIZE = int(os.getenv("GMAIL_POOL_SIZE", "8"))
+# Secondi di attesa massima per un client libero quando il pool è esaurito
+POOL_TIMEOUT = float(os.getenv("GMAIL_POOL_TIMEOUT", "30"))
+# Il token viene rinnovato quando mancano meno di questi secondi alla scadenza
+REFRESH_MARGIN = timedelta(seconds=int(os.getenv("GMAIL_REFRESH_MARGIN", "300")))
+HTTP_TIMEOUT = float(os.getenv("GMAIL_HTTP_TIMEOUT", "30"))
+
+
+class InstrumentedHttp(google_auth_httplib2.AuthorizedHttp):
+    """AuthorizedHttp that records the latency of every Gmail API request, batches included."""
+
+    def request(self, uri, method="GET", *args, **kwargs):
+        started = time.perf_counter()
+        status = "error"
+        try:
+            response, content = super().request(uri, method, *args, **kwargs)
+            status = str(response.status)
+            return response, content
+        finally:
+            gmail_seconds.observe(
+                time.perf_counter() - started, method=method, operation=gmail_operation(uri), status=status
+            )
+
+
+class GmailClientManager:
+    """
+    Process-wide pool of ready Gmail service objects.
+
+    Credentials are loaded once and kept in memory; they are refreshed under a lock
+    shortly before they expire. googleapiclient services are not thread-safe, so each
+    request borrows a service for its exclusive use and gives it back afterwards.
+    """
+
+    def __init__(self, pool_size=POOL_SIZE, pool_timeout=POOL_TIMEOUT, refresh_margin=REFRESH_MARGIN):
+        self.pool_size = pool_size
+        self.pool_timeout = pool_timeout
+        self.refresh_margin = refresh_margin
+        self._creds = None
+        self._creds_lock = threading.Lock()
+        self._pool = queue.LifoQueue()
+        self._created = 0
+        self._pool_lock = threading.Lock()
+
+    def _needs_refresh(self, creds):
+        if not creds.valid:
+            return True
+        if creds.expiry is None:
+            return False
+        # google-auth usa datetime naive in UTC per expiry
+        now = datetime.now(timezone.utc).replace(tzinfo=None)
+        return creds.expiry - now < self.refresh_margin
+
+    def get_credentials(self):
+        with self._creds_lock:
+            if self._creds is None:
+                self._creds = authenticate()
+            elif self._needs_refresh(self._creds) and self._creds.refresh_token:
+                # Refresh in-place: tutti i client del pool condividono lo stesso oggetto
+                self._creds.refresh(Request())
+                with open(TOKEN_PATH, 'w') as token:
+                    token.write(self._creds.to_json())
+            return self._creds
+
+    def _build_service(self):
+        http = InstrumentedHttp(
+            self.get_credentials(),
+            http=httplib2.Http(timeout=HTTP_TIMEOUT)
+        )
+        return build('gmail', 'v1', http=http, cache_discovery=False)
+
+    def _acquire(self):
+        try:
+            return self._pool.get_nowait()
+        except queue.Empty:
+            pass
+
+        with self._pool_lock:
+            can_create = self._created < self.pool_size
+            if can_create:
+                self._created += 1
+
+        if not can_create:
+            try:
+                return self._pool.get(timeout=self.pool_timeout)
+            except queue.Empty:
+                raise TimeoutError("No Gmail client available in the pool")
+
+        try:
+            return self._build_service()
+        except Exception:
+            with self._pool_lock:
+                self._created -= 1
+            raise
+
+    @contextmanager
+    def service(self):
+        """Borrow a Gmail service from the pool for the duration of the block."""
+        # Rinnovo proattivo prima di consegnare il client
+        self.get_credentials()
+        service = self._acquire()
+        try:
+            yield service
+        finally:
+            self._pool.put(service)
+
+
+gmail_clients = GmailClientManager()
+
+
+def get_gmail_service():
+    """FastAPI dependency that yields a pooled Gmail service."""
+    with gmail_clients.service() as service:
+        yield service
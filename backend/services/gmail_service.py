@@ -2,11 +2,15 @@ import os.path
 import base64
 import json
 import re
+import time
 
 from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
 from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
+from cachetools import LRUCache
+import threading
 import requests
 from email import message_from_bytes
 from email.mime.text import MIMEText
@@ -14,51 +18,35 @@ from datetime import datetime
 from email.utils import formatdate
 import markdown
 
+from services.message_store import message_store
+
 # Scope per lettura Gmail
 SCOPES = ['https://www.googleapis.com/auth/gmail.modify']
+TOKEN_PATH = 'token.json'
+# Gmail accetta fino a 100 chiamate per batch, ma consiglia di restare sotto 50
+BATCH_SIZE = 50
+BATCH_RETRIES = 2
+RETRYABLE_STATUSES = (429, 500, 503)
+# Default di Gmail per messages.list
+PAGE_SIZE = 100
+# Messaggi completi tenuti in memoria per riaprire una mail senza chiamare Gmail
+MESSAGE_CACHE_SIZE = int(os.getenv("GMAIL_MESSAGE_CACHE_SIZE", "256"))
 
+# Limite di Gmail per users.messages.batchModify
+BATCH_MODIFY_LIMIT = 1000
+# Header richiesti per la lista della inbox
+METADATA_HEADERS = ['From', 'To', 'Subject', 'Date', 'Message-ID']
 
-def save_message_to_json(parsed_message, reply=False):
-    # Assicurati che la directory esista
-    os.makedirs("conversations", exist_ok=True)
-
-    # Crea il path del file giornaliero
-    today = datetime.today().strftime("%Y-%m-%d")
-    json_path = os.path.join("conversations", f"conversations_{today}.json")
-
-    # Carica dati esistenti se il file esiste
-    if os.path.exists(json_path):
-        with open(json_path, 'r') as f:
-            data = json.load(f)
-    else:
-        data = {}
-
-    thread_id = parsed_message['thread_id']
-    msg_entry = {
-        "from": parsed_message['senderName'] if not reply else "Support Agent",
-        "email": parsed_message['senderEmail'] if not reply else "support@fitapp.com",
-        "date": parsed_message['date'],
-        "text": parsed_message['text']
-    }
-
-    if thread_id not in data:
-        data[thread_id] = {
-            "subject": parsed_message['subject'],
-            "messages": []
-        }
-
-    if msg_entry not in data[thread_id]["messages"]:
-        data[thread_id]["messages"].append(msg_entry)
+_message_cache = LRUCache(maxsize=MESSAGE_CACHE_SIZE)
+_message_cache_lock = threading.Lock()
 
-    with open(json_path, 'w') as f:
-        json.dump(data, f, indent=2, ensure_ascii=False)
 
 def authenticate():
     creds = None
     print("1...")
-    if os.path.exists('token.json'):
+    if os.path.exists(TOKEN_PATH):
         print("2...")
-        creds = Credentials.from_authorized_user_file('token.json', SCOPES)
+        creds = Credentials.from_authorized_user_file(TOKEN_PATH, SCOPES)
         print("2.5...")
     if not creds or not creds.valid:
         print("3...")
@@ -73,10 +61,11 @@ def authenticate():
                 redirect_uri='http://localhost:8080'
             )
             creds = flow.run_local_server(prompt='consent', port=8080)
-        with open('token.json', 'w') as token:
+        with open(TOKEN_PATH, 'w') as token:
             token.write(creds.to_json())
     return creds
-def create_reply_message(to: str, subject: str, message_text: str, thread_id: str, original_message_id: str):
+def create_reply_message(to: str, subject: str, message_text: str, thread_id: str, original_message_id: str,
+                         headers: dict = None):
     # Convert markdown to HTML
     html_content = markdown.markdown(message_text)
     message = MIMEText(html_content, 'html', 'utf-8')
@@ -85,6 +74,8 @@ def create_reply_message(to: str, subject: str, message_text: str, thread_id: st
     message['In-Reply-To'] = original_message_id
     message['References'] = original_message_id
     message['Date'] = formatdate(localtime=True)
+    for name, value in (headers or {}).items():
+        message[name] = value
 
     raw_message = base64.urlsafe_b64encode(message.as_bytes()).decode()
     return {
@@ -92,10 +83,18 @@ def create_reply_message(to: str, subject: str, message_text: str, thread_id: st
         'threadId': thread_id
     }
 
-def send_reply_email(service, to: str, subject: str, message_text: str, thread_id: str, original_message_id: str):
-    message = create_reply_message(to, subject, message_text, thread_id, original_message_id)
+def send_reply_email(service, to: str, subject: str, message_text: str, thread_id: str, original_message_id: str,
+                     headers: dict = None):
+    """Send the reply through Gmail; the conversation log is updated separately by log_sent_reply."""
+    message = create_reply_message(to, subject, message_text, thread_id, original_message_id, headers)
     sent_message = service.users().messages().send(userId='me', body=message).execute()
-    save_message_to_json({
+    print(f"📨 Risposta inviata con ID: {sent_message['id']}")
+    #print(sent_message)
+    return sent_message
+
+def log_sent_reply(gmail_id: str, thread_id: str, subject: str, message_text: str):
+    message_store.save_message({
+        'message_id': gmail_id,
         'thread_id': thread_id,
         'subject': subject,
         'senderName': "Support Agent",
@@ -103,16 +102,68 @@ def send_reply_email(service, to: str, subject: str, message_text: str, thread_i
         'date': datetime.now().strftime("%a, %d %b %Y %H:%M:%S"),
         'text': message_text
     }, reply=True)
-    print(f"📨 Risposta inviata con ID: {sent_message['id']}")
-    #print(sent_message)
-    return sent_message
+
+def find_thread_message(service, thread_id: str, header: str, value: str):
+    """Message of a thread carrying header: value (e.g. a reply we may have sent already), or None."""
+    thread = service.users().threads().get(
+        userId='me', id=thread_id, format='metadata', metadataHeaders=[header]
+    ).execute()
+    for message in thread.get('messages', []):
+        for h in message.get('payload', {}).get('headers', []):
+            if h['name'].lower() == header.lower() and h['value'] == value:
+                return message
+    return None
 
 def get_unread_messages(service):
-    results = service.users().messages().list(userId='me', labelIds=['INBOX'], q='is:unread').execute()
-    return results.get('messages', [])
+    # Segue nextPageToken: ritorna tutti i messaggi non letti, non solo la prima pagina
+    return list(iter_unread_messages(service))
+
+
+def get_unread_messages_page(service, page_token=None, page_size=PAGE_SIZE):
+    results = service.users().messages().list(
+        userId='me',
+        labelIds=['INBOX'],
+        q='is:unread',
+        maxResults=page_size,
+        pageToken=page_token
+    ).execute()
+    return results.get('messages', []), results.get('nextPageToken')
+
+
+def iter_unread_messages(service, page_size=PAGE_SIZE):
+    page_token = None
+    while True:
+        messages, page_token = get_unread_messages_page(service, page_token, page_size)
+        yield from messages
+        if not page_token:
+            break
+
+
+def iter_parsed_messages(service, msg_ids, batch_size=BATCH_SIZE, message_format='full'):
+    """
+    Parsa i messaggi un batch alla volta e li emette appena pronti:
+    in memoria resta al massimo un batch.
+    Emette ('message', parsed) oppure ('error', {'message_id', 'error'}).
+    """
+    chunk = []
+    for msg_id in msg_ids:
+        chunk.append(msg_id)
+        if len(chunk) == batch_size:
+            yield from _parse_chunk(service, chunk, message_format)
+            chunk = []
+    if chunk:
+        yield from _parse_chunk(service, chunk, message_format)
+
+
+def _parse_chunk(service, msg_ids, message_format):
+    parsed_messages, errors = parse_messages(service, msg_ids, message_format=message_format)
+    for parsed in parsed_messages:
+        yield 'message', parsed
+    for error in errors:
+        yield 'error', error
 
 def mark_as_read(service, message_id):
-    service.users().messages().modify(
+    result = service.users().messages().modify(
         userId='me',
         id=message_id,
         body={
@@ -120,16 +171,41 @@ def mark_as_read(service, message_id):
         }
     ).execute()
     print(f"✅ Messaggio {message_id} segnato come letto.")
+    return result
+
+
+def batch_modify_labels(service, message_ids, add_label_ids=None, remove_label_ids=None):
+    """
+    Cambia le label di molti messaggi con users.messages.batchModify
+    (fino a 1000 id per chiamata). Ritorna gli id modificati.
+    """
+    message_ids = list(dict.fromkeys(message_ids))
+    for start in range(0, len(message_ids), BATCH_MODIFY_LIMIT):
+        service.users().messages().batchModify(
+            userId='me',
+            body={
+                'ids': message_ids[start:start + BATCH_MODIFY_LIMIT],
+                'addLabelIds': add_label_ids or [],
+                'removeLabelIds': remove_label_ids or []
+            }
+        ).execute()
+    print(f"✅ Label aggiornate per {len(message_ids)} messaggi.")
+    return message_ids
 
 
 def parse_message(service, msg_id):
     msg = service.users().messages().get(userId='me', id=msg_id, format='full').execute()
+    return parse_raw_message(msg)
+
 
-    payload = msg['payload']
-    headers = payload.get('headers', [])
+def get_header(headers, name):
+    return next((h['value'] for h in headers if h['name'].lower() == name.lower()), None)
 
-    subject = next((h['value'] for h in headers if h['name'] == 'Subject'), None)
-    raw_sender = next((h['value'] for h in headers if h['name'] == 'From'), "")
+
+def parse_headers(msg):
+    headers = msg['payload'].get('headers', [])
+
+    raw_sender = get_header(headers, 'From') or ""
     match = re.match(r'^(.*)\s<(.+?)>$', raw_sender)
     if match:
         senderName = match.group(1).strip()
@@ -137,36 +213,128 @@ def parse_message(service, msg_id):
     else:
         senderName = ""
         senderEmail = raw_sender.strip()
-    date = next((h['value'] for h in headers if h['name'] == 'Date'), None)
-    original_message_id = next((h['value'] for h in headers if h['name'] == 'Message-ID'), None)
-
-    parts = payload.get('parts', [])
-    text = ""
-    for part in parts:
-        if part['mimeType'] == 'text/plain':
-            data = part['body']['data']
-            text = base64.urlsafe_b64decode(data).decode('utf-8')
-            print(text)
-            break
 
-    parsed = {
+    return {
         'message_id': msg['id'],
         'thread_id': msg['threadId'],
-        'subject': subject,
+        'subject': get_header(headers, 'Subject'),
         'senderName': senderName,
         'senderEmail': senderEmail,
-        'date': date,
+        'date': get_header(headers, 'Date'),
         'snippet': msg.get('snippet', ''),
-        'text': text,
-        'original_message_id': original_message_id
+        'text': None,
+        # Gmail a volte usa 'Message-Id'
+        'original_message_id': get_header(headers, 'Message-ID'),
+        'label_ids': msg.get('labelIds', []),
+        'internal_date': msg.get('internalDate')
     }
 
-    save_message_to_json(parsed)
+
+def extract_text(payload):
+    # Primo text/plain trovato, anche dentro multipart annidati
+    if payload.get('mimeType') == 'text/plain' and payload.get('body', {}).get('data'):
+        return base64.urlsafe_b64decode(payload['body']['data']).decode('utf-8')
+    for part in payload.get('parts', []):
+        text = extract_text(part)
+        if text:
+            return text
+    return ""
+
+
+def parse_raw_message(msg):
+    parsed = parse_headers(msg)
+    parsed['text'] = extract_text(msg['payload'])
+
+    message_store.save_message(parsed)
+    if parsed['original_message_id']:
+        message_store.save_rfc822_id(parsed['original_message_id'], msg['id'])
+    remember_message(msg)
     return parsed
 
 
+def parse_metadata_message(msg):
+    # Solo header e snippet: il body si scarica quando la mail viene aperta
+    parsed = parse_headers(msg)
+    if parsed['original_message_id']:
+        message_store.save_rfc822_id(parsed['original_message_id'], msg['id'])
+    return parsed
+
 
-def get_message_by_rfc822_message_id(service, rfc822_id):
+def get_message_body(service, msg_id):
+    with _message_cache_lock:
+        msg = _message_cache.get(msg_id)
+    if msg is None:
+        msg = service.users().messages().get(userId='me', id=msg_id, format='full').execute()
+    return parse_raw_message(msg)
+
+
+def parse_messages(service, msg_ids, batch_size=BATCH_SIZE, retries=BATCH_RETRIES, message_format='full'):
+    """
+    Scarica e parsa molti messaggi usando le batch request di Gmail.
+    Ritorna (messaggi parsati nell'ordine di msg_ids, errori per messaggio):
+    un messaggio che fallisce non fa fallire gli altri.
+    Con message_format='metadata' scarica solo gli header della lista (text è None).
+    """
+    if message_format == 'metadata':
+        request_args = {'format': 'metadata', 'metadataHeaders': METADATA_HEADERS}
+        parser = parse_metadata_message
+    else:
+        request_args = {'format': 'full'}
+        parser = parse_raw_message
+
+    raw = {}
+    errors = {}
+    pending = list(dict.fromkeys(msg_ids))
+
+    for attempt in range(retries + 1):
+        retry = []
+        for start in range(0, len(pending), batch_size):
+            chunk = pending[start:start + batch_size]
+
+            def callback(request_id, response, exception):
+                if exception is None:
+                    raw[request_id] = response
+                    errors.pop(request_id, None)
+                    return
+                errors[request_id] = str(exception)
+                status = getattr(getattr(exception, 'resp', None), 'status', None)
+                # Rate limit ed errori temporanei del server si riprovano
+                if status in RETRYABLE_STATUSES:
+                    retry.append(request_id)
+
+            batch = service.new_batch_http_request(callback=callback)
+            for msg_id in chunk:
+                batch.add(
+                    service.users().messages().get(userId='me', id=msg_id, **request_args),
+                    request_id=msg_id
+                )
+            batch.execute()
+
+        if not retry or attempt == retries:
+            break
+        time.sleep(2 ** attempt)
+        pending = retry
+
+    parsed_messages = []
+    for msg_id in dict.fromkeys(msg_ids):
+        if msg_id not in raw:
+            continue
+        try:
+            parsed_messages.append(parser(raw[msg_id]))
+        except Exception as e:
+            errors[msg_id] = str(e)
+
+    failed = [{'message_id': msg_id, 'error': error} for msg_id, error in errors.items()]
+    return parsed_messages, failed
+
+
+
+def remember_message(msg):
+    with _message_cache_lock:
+        _message_cache[msg['id']] = msg
+
+
+def _search_rfc822_id(service, rfc822_id):
     query = f'rfc822msgid:{rfc822_id}'
     response = service.users().messages().list(userId='me', q=query).execute()
     messages = response.get('messages', [])
@@ -175,7 +343,48 @@ def get_message_by_rfc822_message_id(service, rfc822_id):
         return None
 
     message_id = messages[0]['id']
-    return service.users().messages().get(userId='me', id=message_id).execute()
+    message_store.save_rfc822_id(rfc822_id, message_id)
+    return message_id
+
+
+def resolve_gmail_id(service, message_id):
+    # Accetta sia id Gmail sia Message-ID RFC822 (il frontend usa questi ultimi)
+    if '@' not in message_id:
+        return message_id
+    return message_store.get_gmail_id(message_id) or _search_rfc822_id(service, message_id)
+
+
+def get_message_by_rfc822_message_id(service, rfc822_id):
+    """
+    Ritorna il messaggio Gmail completo con quel Message-ID RFC822.
+    La mappa Message-ID -> id Gmail è persistente e i messaggi recenti restano in un LRU:
+    riaprire la stessa mail non chiama Gmail.
+    """
+    message_id = message_store.get_gmail_id(rfc822_id)
+    from_index = message_id is not None
+    if not from_index:
+        message_id = _search_rfc822_id(service, rfc822_id)
+        if message_id is None:
+            return None
+
+    with _message_cache_lock:
+        cached = _message_cache.get(message_id)
+    if cached is not None:
+        return cached
+
+    try:
+        msg = service.users().messages().get(userId='me', id=message_id, format='full').execute()
+    except HttpError as e:
+        if e.resp.status != 404 or not from_index:
+            raise
+        # La mappa punta a un messaggio cancellato: si rifà la ricerca
+        message_store.forget_rfc822_id(rfc822_id)
+        message_id = _search_rfc822_id(service, rfc822_id)
+        if message_id is None:
+            return None
+        msg = service.users().messages().get(userId='me', id=message_id, format='full').execute()
+    remember_message(msg)
+    return msg
 
 
 if __name__ == '__main__':
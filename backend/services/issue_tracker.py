@@ -0,0 +1,303 @@
+import os
+import time
+import uuid
+import random
+import hashlib
+import logging
+import threading
+from datetime import datetime, timezone
+
+import numpy as np
+from github import Github, Auth
+
+from services.message_store import connect_sqlite, CONVERSATION_DIR
+
+ISSUE_DB_PATH = os.path.join(CONVERSATION_DIR, "issues.db")
+GITHUB_REPO = os.getenv("GITHUB_REPO", "bonsurha/EXAMPLE")
+# Puntando a services.fake_github si prova il flusso senza toccare GitHub
+GITHUB_API_URL = os.getenv("GITHUB_API_URL", "https://api.github.com")
+# Similarità coseno minima tra riassunti per considerare un bug già segnalato
+ISSUE_DEDUP_THRESHOLD = float(os.getenv("ISSUE_DEDUP_THRESHOLD", "0.85"))
+# Solo le issue aggiornate negli ultimi giorni sono candidate al dedup
+ISSUE_DEDUP_WINDOW_DAYS = float(os.getenv("ISSUE_DEDUP_WINDOW_DAYS", "30"))
+ISSUE_MAX_ATTEMPTS = int(os.getenv("ISSUE_MAX_ATTEMPTS", "5"))
+BACKOFF_BASE = 2.0
+BACKOFF_MAX = 300.0
+# Commento HTML invisibile su GitHub che lega issue e commenti al report che li ha creati
+REPORT_MARKER = "<!-- bug-report: {} -->"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS reports (
+    id TEXT PRIMARY KEY,
+    content_key TEXT NOT NULL UNIQUE,
+    email_content TEXT NOT NULL,
+    summary TEXT,
+    status TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at REAL NOT NULL,
+    issue_number INTEGER,
+    action TEXT,
+    last_error TEXT,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_reports_due ON reports (status, next_attempt_at);
+CREATE TABLE IF NOT EXISTS issues (
+    number INTEGER PRIMARY KEY,
+    summary TEXT NOT NULL,
+    embedding BLOB NOT NULL,
+    reports INTEGER NOT NULL DEFAULT 1,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+"""
+
+logger = logging.getLogger(__name__)
+
+
+def content_key(email_content):
+    return hashlib.sha1(" ".join(email_content.split()).lower().encode('utf-8')).hexdigest()
+
+
+class IssueTracker:
+    """
+    Background filing of bug reports as GitHub issues.
+
+    The bug_report node only enqueues the email; a worker thread summarizes it,
+    compares the summary embedding with the issues filed recently and either
+    comments on the closest one or opens a new issue. The same email is filed
+    at most once, and failed attempts are retried with exponential backoff.
+
+    Before calling GitHub the report is marked as creating/commenting, and the
+    issue or comment carries a marker with the report id: an attempt interrupted
+    between the GitHub call and the database update finds it on retry instead of
+    filing it again.
+    """
+
+    def __init__(self, embedding_model, summarize, db_path=ISSUE_DB_PATH, repo_name=GITHUB_REPO,
+                 api_url=GITHUB_API_URL, threshold=ISSUE_DEDUP_THRESHOLD,
+                 window_days=ISSUE_DEDUP_WINDOW_DAYS, max_attempts=ISSUE_MAX_ATTEMPTS):
+        self.embedding_model = embedding_model
+        self.summarize = summarize
+        self.db_path = db_path
+        self.repo_name = repo_name
+        self.api_url = api_url
+        self.threshold = threshold
+        self.window_days = window_days
+        self.max_attempts = max_attempts
+        self._local = threading.local()
+        self._client_lock = threading.Lock()
+        self._repo = None
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = connect_sqlite(self.db_path)
+            conn.executescript(SCHEMA)
+            self._local.conn = conn
+        return conn
+
+    def repo(self):
+        """GitHub repository handle, created on first use and reused afterwards."""
+        with self._client_lock:
+            if self._repo is None:
+                # retry=None: i tentativi li gestisce il worker con backoff, e il retry interno di
+                # PyGithub ripeterebbe anche le POST, aprendo issue doppie dopo un 5xx
+                # lazy=True: nessuna GET del repository finché non serve
+                client = Github(
+                    auth=Auth.Token(os.getenv("GITHUB_TOKEN", "")), base_url=self.api_url, retry=None, lazy=True
+                )
+                self._repo = client.get_repo(self.repo_name)
+            return self._repo
+
+    def enqueue(self, email_content):
+        """Queue a bug report; returns the report id (the existing one for a repeated email)."""
+        key = content_key(email_content)
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR IGNORE INTO reports (id, content_key, email_content, status, next_attempt_at, "
+                "created_at, updated_at) VALUES (?, ?, ?, 'queued', ?, ?, ?)",
+                (uuid.uuid4().hex, key, email_content, now, now, now)
+            )
+            report_id = conn.execute("SELECT id FROM reports WHERE content_key = ?", (key,)).fetchone()["id"]
+        self._wakeup.set()
+        return report_id
+
+    def status(self, report_id):
+        row = self._connect().execute(
+            "SELECT id, status, attempts, summary, issue_number, action, last_error, created_at, updated_at "
+            "FROM reports WHERE id = ?",
+            (report_id,)
+        ).fetchone()
+        return dict(row) if row else None
+
+    def _claim(self):
+        conn = self._connect()
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(
+                "SELECT * FROM reports WHERE status = 'queued' AND next_attempt_at <= ? "
+                "ORDER BY next_attempt_at LIMIT 1",
+                (now,)
+            ).fetchone()
+            if row is not None:
+                conn.execute(
+                    "UPDATE reports SET status = 'filing', attempts = attempts + 1, updated_at = ? WHERE id = ?",
+                    (now, row["id"])
+                )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return row
+
+    def _next_due_in(self):
+        row = self._connect().execute(
+            "SELECT MIN(next_attempt_at) AS due FROM reports WHERE status = 'queued'"
+        ).fetchone()
+        if row["due"] is None:
+            return None
+        return max(0.0, row["due"] - time.time())
+
+    def _embed(self, text):
+        vector = np.array(self.embedding_model.embed_query(text), dtype='float32')
+        return vector / (np.linalg.norm(vector) or 1.0)
+
+    def find_duplicate(self, vector):
+        """Number and similarity of the closest recent issue above the threshold, or (None, score)."""
+        since = time.time() - self.window_days * 86400
+        rows = self._connect().execute(
+            "SELECT number, embedding FROM issues WHERE updated_at >= ?", (since,)
+        ).fetchall()
+        if not rows:
+            return None, 0.0
+        matrix = np.vstack([np.frombuffer(row["embedding"], dtype='float32') for row in rows])
+        similarities = matrix @ vector
+        best = int(np.argmax(similarities))
+        score = float(similarities[best])
+        return (rows[best]["number"] if score >= self.threshold else None), score
+
+    def _file(self, row):
+        summary = row["summary"]
+        if summary is None:
+            summary = self.summarize(row["email_content"])
+            if summary.startswith("Error:"):
+                raise RuntimeError(summary)
+            # Il riassunto resta salvato: un nuovo tentativo non richiama l'LLM
+            with self._connect() as conn:
+                conn.execute("UPDATE reports SET summary = ? WHERE id = ?", (summary, row["id"]))
+
+        vector = self._embed(summary)
+        marker = REPORT_MARKER.format(row["id"])
+        if row["action"] == "creating":
+            issue = self._find_issue(marker, row["created_at"])
+            if issue is not None:
+                logger.info(f"Bug report {row['id']} was already filed as issue #{issue.number}")
+                self._save_issue(issue.number, summary, vector)
+                return issue.number, "created"
+
+        if row["action"] == "commenting":
+            number, score = row["issue_number"], None
+        else:
+            number, score = self.find_duplicate(vector)
+        if number is not None:
+            issue = self.repo().get_issue(number)
+            if row["action"] != "commenting" or not any(marker in (c.body or "") for c in issue.get_comments()):
+                self._mark_pending(row["id"], "commenting", number)
+                issue.create_comment(f"+1, reported again:\n\n{summary}\n\n{marker}")
+            with self._connect() as conn:
+                conn.execute("UPDATE issues SET reports = reports + 1, updated_at = ? WHERE number = ?",
+                             (time.time(), number))
+            logger.info(f"Bug report {row['id']} added to issue #{number}"
+                        + (f" (similarity {score:.2f})" if score is not None else ""))
+            return number, "commented"
+
+        self._mark_pending(row["id"], "creating")
+        issue = self.repo().create_issue(title="Bug Report", body=f"{summary}\n\n{marker}", labels=["bug", "triage"])
+        self._save_issue(issue.number, summary, vector)
+        logger.info(f"Bug report {row['id']} filed as issue #{issue.number}")
+        return issue.number, "created"
+
+    def _mark_pending(self, report_id, action, issue_number=None):
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE reports SET action = ?, issue_number = ?, updated_at = ? WHERE id = ?",
+                (action, issue_number, time.time(), report_id)
+            )
+
+    def _find_issue(self, marker, since):
+        """Issue opened by an earlier attempt of the same report, found by its marker."""
+        for issue in self.repo().get_issues(state="all", since=datetime.fromtimestamp(since, timezone.utc)):
+            if marker in (issue.body or ""):
+                return issue
+        return None
+
+    def _save_issue(self, number, summary, vector):
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO issues (number, summary, embedding, created_at, updated_at) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (number, summary, vector.tobytes(), now, now)
+            )
+
+    def _process(self, row):
+        try:
+            number, action = self._file(row)
+        except Exception as e:
+            with self._connect() as conn:
+                if row["attempts"] + 1 < self.max_attempts:
+                    delay = min(BACKOFF_MAX, BACKOFF_BASE ** (row["attempts"] + 1)) * random.uniform(0.8, 1.2)
+                    logger.warning(f"Bug report {row['id']} failed ({e}), retry in {delay:.0f}s")
+                    conn.execute(
+                        "UPDATE reports SET status = 'queued', last_error = ?, next_attempt_at = ?, updated_at = ? "
+                        "WHERE id = ?",
+                        (str(e), time.time() + delay, time.time(), row["id"])
+                    )
+                else:
+                    logger.error(f"Bug report {row['id']} failed permanently: {e}")
+                    conn.execute(
+                        "UPDATE reports SET status = 'failed', last_error = ?, updated_at = ? WHERE id = ?",
+                        (str(e), time.time(), row["id"])
+                    )
+            return
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE reports SET status = 'filed', issue_number = ?, action = ?, last_error = NULL, "
+                "updated_at = ? WHERE id = ?",
+                (number, action, time.time(), row["id"])
+            )
+
+    def _worker(self):
+        # Un solo worker: due segnalazioni dello stesso bug non aprono due issue in parallelo
+        while not self._stop.is_set():
+            try:
+                row = self._claim()
+                if row is not None:
+                    self._process(row)
+                    continue
+                self._wakeup.clear()
+                due = self._next_due_in()
+            except Exception as e:
+                logger.error(f"Issue tracker worker error: {e}")
+                due = None
+            self._wakeup.wait(timeout=5.0 if due is None else due)
+
+    def start(self):
+        with self._connect() as conn:
+            conn.execute("UPDATE reports SET status = 'queued' WHERE status = 'filing'")
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._worker, name="issue-tracker", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+            self._thread = None
@@ -0,0 +1,185 @@
+import os
+import json
+import time
+import hashlib
+import logging
+import threading
+
+from cachetools import LRUCache
+
+from services.message_store import connect_sqlite
+
+LLM_CACHE_ENABLED = os.getenv("LLM_CACHE_ENABLED", "true").lower() == "true"
+LLM_CACHE_PATH = os.path.join("cache", "llm_cache.db")
+LLM_CACHE_MEMORY_ITEMS = int(os.getenv("LLM_CACHE_MEMORY_ITEMS", "512"))
+LLM_CACHE_TTL = float(os.getenv("LLM_CACHE_TTL", str(7 * 24 * 60 * 60)))
+LLM_CACHE_MAX_BYTES = int(os.getenv("LLM_CACHE_MAX_BYTES", str(100 * 1024 * 1024)))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS llm_cache (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    expires_at REAL NOT NULL,
+    last_access REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_llm_cache_access ON llm_cache (last_access);
+"""
+
+logger = logging.getLogger(__name__)
+
+
+def cache_key(model, prompt, params=None, kind="invoke"):
+    payload = json.dumps(
+        {"model": model, "prompt": prompt, "params": params or {}, "kind": kind},
+        sort_keys=True,
+        ensure_ascii=False
+    )
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class LLMCache:
+    """
+    Content-addressed cache of LLM responses, keyed on model, prompt and parameters.
+    Responses are stored under the model that produced them; a lookup accepts
+    the whole fallback chain and returns the first model's answer it finds.
+
+    A memory LRU sits in front of a SQLite tier with TTL and size-based eviction
+    (least recently used entries go first). Streamed responses are stored as the
+    list of chunks and replayed chunk by chunk; a stream is stored only once it
+    has been consumed to the end, so errors and aborted streams are never cached.
+    """
+
+    def __init__(self, db_path=LLM_CACHE_PATH, memory_items=LLM_CACHE_MEMORY_ITEMS,
+                 ttl=LLM_CACHE_TTL, max_bytes=LLM_CACHE_MAX_BYTES, enabled=LLM_CACHE_ENABLED):
+        self.db_path = db_path
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.enabled = enabled
+        self._memory = LRUCache(maxsize=memory_items)
+        self._memory_lock = threading.Lock()
+        self._local = threading.local()
+        self._counters = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "stores": 0, "evictions": 0}
+        self._counters_lock = threading.Lock()
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = connect_sqlite(self.db_path)
+            conn.executescript(SCHEMA)
+            self._local.conn = conn
+        return conn
+
+    def _count(self, name, amount=1):
+        with self._counters_lock:
+            self._counters[name] += amount
+
+    def stats(self):
+        with self._counters_lock:
+            stats = dict(self._counters)
+        lookups = stats["memory_hits"] + stats["disk_hits"] + stats["misses"]
+        stats["hit_rate"] = (stats["memory_hits"] + stats["disk_hits"]) / lookups if lookups else 0.0
+        return stats
+
+    def get(self, key):
+        return self.get_first([key])
+
+    def get_first(self, keys):
+        """Value of the first key found, counted as a single lookup."""
+        for key in keys:
+            value, tier = self._lookup(key)
+            if value is not None:
+                self._count(tier)
+                return value
+        self._count("misses")
+        return None
+
+    def _lookup(self, key):
+        now = time.time()
+        with self._memory_lock:
+            entry = self._memory.get(key)
+        if entry is not None:
+            value, expires_at = entry
+            if expires_at > now:
+                return value, "memory_hits"
+            with self._memory_lock:
+                self._memory.pop(key, None)
+
+        conn = self._connect()
+        row = conn.execute("SELECT value, expires_at FROM llm_cache WHERE key = ?", (key,)).fetchone()
+        if row is None or row["expires_at"] <= now:
+            return None, None
+        with conn:
+            conn.execute("UPDATE llm_cache SET last_access = ? WHERE key = ?", (now, key))
+        value = json.loads(row["value"])
+        with self._memory_lock:
+            self._memory[key] = (value, row["expires_at"])
+        return value, "disk_hits"
+
+    def put(self, key, value):
+        now = time.time()
+        expires_at = now + self.ttl
+        serialized = json.dumps(value, ensure_ascii=False)
+        with self._memory_lock:
+            self._memory[key] = (value, expires_at)
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO llm_cache (key, value, size, expires_at, last_access) VALUES (?, ?, ?, ?, ?)",
+                (key, serialized, len(serialized), expires_at, now)
+            )
+        self._count("stores")
+        self._evict()
+
+    def _evict(self):
+        with self._connect() as conn:
+            expired = conn.execute("DELETE FROM llm_cache WHERE expires_at <= ?", (time.time(),)).rowcount
+            total = conn.execute("SELECT COALESCE(SUM(size), 0) AS total FROM llm_cache").fetchone()["total"]
+            evicted = 0
+            if total > self.max_bytes:
+                # Via le voci usate meno di recente finché si rientra nel limite
+                for row in conn.execute("SELECT key, size FROM llm_cache ORDER BY last_access").fetchall():
+                    if total <= self.max_bytes:
+                        break
+                    conn.execute("DELETE FROM llm_cache WHERE key = ?", (row["key"],))
+                    total -= row["size"]
+                    evicted += 1
+        if expired or evicted:
+            self._count("evictions", expired + evicted)
+
+    def invoke(self, models, prompt, params, compute):
+        """
+        Return the response cached for any of models (in order of preference), or
+        compute() -> (model, response) and cache it under the model that answered.
+        """
+        if not self.enabled:
+            return compute()[1]
+        cached = self.get_first([cache_key(model, prompt, params, "invoke") for model in models])
+        if cached is not None:
+            return cached
+        model, value = compute()
+        self.put(cache_key(model, prompt, params, "invoke"), value)
+        return value
+
+    def stream(self, models, prompt, params, open_stream):
+        """
+        Replay a cached stream chunk by chunk, or record the (model, chunk) pairs
+        returned by open_stream() under the model that answered.
+        """
+        if not self.enabled:
+            for _, chunk in open_stream():
+                yield chunk
+            return
+        cached = self.get_first([cache_key(model, prompt, params, "stream") for model in models])
+        if cached is not None:
+            yield from cached
+            return
+        # Stream vuoto: si registra sotto il modello preferito
+        answered = models[0]
+        chunks = []
+        for answered, chunk in open_stream():
+            chunks.append(chunk)
+            yield chunk
+        self.put(cache_key(answered, prompt, params, "stream"), chunks)
+
+
+llm_cache = LLMCache()
@@ -0,0 +1,439 @@
+import os
+import json
+import time
+import queue
+import logging
+import threading
+import importlib.util
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from services.llm_backend import LLMBackend, GeminiBackend, ReplayBackend, LLM_TEMPERATURE
+from services.metrics import registry, quantile
+
+# router (default) | gemini (un solo modello) | replay (offline) | record (Gemini + registrazione)
+LLM_BACKEND = os.getenv("LLM_BACKEND", "router")
+
+# Stessi identificativi di ai_agents/orchestrator.py (provider/modello)
+MODEL_GEMINI_1_5_FLASH = "gemini-1.5-flash"
+MODEL_GEMINI_2_0_FLASH = "gemini-2.0-flash"
+MODEL_GPT_4O = "openai/gpt-4o"
+MODEL_CLAUDE_SONNET = "anthropic/claude-3-sonnet-20240229"
+MODEL_DEEPSEEK_CHAT = "deepseek/deepseek-chat"
+
+# Catene di modelli in ordine di preferenza: il primo risponde, gli altri fanno da fallback
+LLM_FAST_MODELS = os.getenv("LLM_FAST_MODELS", f"{MODEL_GEMINI_1_5_FLASH},{MODEL_DEEPSEEK_CHAT}")
+LLM_STRONG_MODELS = os.getenv(
+    "LLM_STRONG_MODELS", f"{MODEL_GEMINI_2_0_FLASH},{MODEL_GPT_4O},{MODEL_CLAUDE_SONNET},{MODEL_GEMINI_1_5_FLASH}"
+)
+# Categorizzazione e controlli brevi sul modello veloce, testi per il cliente su quello forte
+TASK_TIERS = {
+    "categorize": "fast",
+    "compliance": "fast",
+    "bug_summary": "fast",
+    "summary": "fast",
+    "draft": "strong",
+}
+# Override per task, es. {"summary": ["openai/gpt-4o"]}
+LLM_ROUTES = os.getenv("LLM_ROUTES")
+
+# Seconda richiesta se il primo token non arriva entro hedge_factor * p95 del provider
+LLM_HEDGE_ENABLED = os.getenv("LLM_HEDGE_ENABLED", "false").lower() == "true"
+LLM_HEDGE_FACTOR = float(os.getenv("LLM_HEDGE_FACTOR", "1.0"))
+# Finché non ci sono abbastanza campioni si usa una scadenza fissa
+LLM_HEDGE_MIN_SAMPLES = int(os.getenv("LLM_HEDGE_MIN_SAMPLES", "20"))
+LLM_HEDGE_DEFAULT_MS = float(os.getenv("LLM_HEDGE_DEFAULT_MS", "3000"))
+LLM_STATS_WINDOW = int(os.getenv("LLM_STATS_WINDOW", "500"))
+# Thread condivisi dalle richieste hedged (senza hedging il provider gira nel thread del chiamante)
+LLM_HEDGE_WORKERS = int(os.getenv("LLM_HEDGE_WORKERS", "16"))
+
+# provider: (variabile con la chiave, modulo langchain necessario)
+PROVIDERS = {
+    "gemini": ("GOOGLE_API_KEY", "langchain_google_genai"),
+    "openai": ("OPENAI_API_KEY", "langchain_openai"),
+    "deepseek": ("DEEPSEEK_API_KEY", "langchain_openai"),
+    "anthropic": ("ANTHROPIC_API_KEY", "langchain_anthropic"),
+}
+DEEPSEEK_BASE_URL = "https://api.deepseek.com"
+
+provider_first_token_seconds = registry.histogram(
+    "llm_provider_first_token_seconds", "Time to first token (whole answer for invoke) per provider model",
+    ("model",))
+provider_requests = registry.counter(
+    "llm_provider_requests_total", "LLM requests per provider model and outcome (won, lost, error)",
+    ("model", "outcome"))
+
+logger = logging.getLogger(__name__)
+
+hedge_executor = ThreadPoolExecutor(max_workers=LLM_HEDGE_WORKERS, thread_name_prefix="llm-hedge")
+
+
+def split_spec(spec):
+    """'openai/gpt-4o' -> ('openai', 'gpt-4o'); names without a provider are Gemini models."""
+    provider, _, name = spec.partition("/")
+    return (provider, name) if name else ("gemini", spec)
+
+
+class ChatBackend(LLMBackend):
+    """LangChain chat model (OpenAI, DeepSeek, Anthropic), created on the first call."""
+
+    def __init__(self, spec, temperature=LLM_TEMPERATURE):
+        self.model = spec
+        self.temperature = temperature
+        self._client = None
+        self._lock = threading.Lock()
+
+    def client(self):
+        with self._lock:
+            if self._client is None:
+                provider, name = split_spec(self.model)
+                if provider == "anthropic":
+                    from langchain_anthropic import ChatAnthropic
+                    self._client = ChatAnthropic(model=name, temperature=self.temperature)
+                else:
+                    from langchain_openai import ChatOpenAI
+                    kwargs = {"base_url": DEEPSEEK_BASE_URL, "api_key": os.getenv("DEEPSEEK_API_KEY")} \
+                        if provider == "deepseek" else {}
+                    self._client = ChatOpenAI(model=name, temperature=self.temperature, **kwargs)
+            return self._client
+
+    def invoke(self, prompt):
+        return self.client().invoke(prompt).content.strip()
+
+    def stream(self, prompt):
+        for chunk in self.client().stream(prompt):
+            if chunk.content:
+                yield chunk.content
+
+
+def create_provider(spec):
+    """Backend for a model spec, or None when its API key or langchain package is missing."""
+    provider, name = split_spec(spec)
+    if provider not in PROVIDERS:
+        raise ValueError(f"Unknown LLM provider in {spec}")
+    key_env, module = PROVIDERS[provider]
+    if not os.getenv(key_env) or importlib.util.find_spec(module) is None:
+        logger.info(f"LLM provider {spec} not configured, skipped")
+        return None
+    if provider == "gemini":
+        return GeminiBackend(name)
+    return ChatBackend(spec)
+
+
+def task_routes():
+    tiers = {
+        "fast": [spec.strip() for spec in LLM_FAST_MODELS.split(",") if spec.strip()],
+        "strong": [spec.strip() for spec in LLM_STRONG_MODELS.split(",") if spec.strip()],
+    }
+    routes = {task: tiers[tier] for task, tier in TASK_TIERS.items()}
+    routes["default"] = tiers["fast"]
+    if LLM_ROUTES:
+        overrides = json.loads(LLM_ROUTES)
+        if not isinstance(overrides, dict) or not all(isinstance(chain, list) for chain in overrides.values()):
+            raise ValueError(f"LLM_ROUTES must map tasks to lists of models: {LLM_ROUTES}")
+        routes.update(overrides)
+    return routes
+
+
+class ProviderStats:
+    """Recent first-token and total latencies of one provider, with request outcomes."""
+
+    def __init__(self, window=LLM_STATS_WINDOW):
+        self.first_token = deque(maxlen=window)
+        self.total = deque(maxlen=window)
+        self.outcomes = {"won": 0, "lost": 0, "error": 0}
+        self._lock = threading.Lock()
+
+    def record(self, outcome, first_token=None, total=None):
+        with self._lock:
+            self.outcomes[outcome] += 1
+            if first_token is not None:
+                self.first_token.append(first_token)
+            if total is not None:
+                self.total.append(total)
+
+    def p95_first_token(self, min_samples):
+        with self._lock:
+            if len(self.first_token) < min_samples:
+                return None
+            return quantile(sorted(self.first_token), 0.95)
+
+    def snapshot(self):
+        with self._lock:
+            first_token, total = sorted(self.first_token), sorted(self.total)
+            outcomes = dict(self.outcomes)
+        return {
+            **outcomes,
+            **{f"first_token_p{int(q * 100)}_ms": quantile(first_token, q) * 1000 if first_token else None
+               for q in (0.5, 0.95, 0.99)},
+            **{f"total_p{int(q * 100)}_ms": quantile(total, q) * 1000 if total else None
+               for q in (0.5, 0.95, 0.99)},
+        }
+
+
+class Attempt:
+    def __init__(self, provider):
+        self.provider = provider
+        self.started = time.perf_counter()
+        self.first_token = None
+        self.cancelled = False
+
+
+class RoutedBackend(LLMBackend):
+    """The chain of providers for one task, seen by call_gemini as a single backend."""
+
+    def __init__(self, router, task, providers):
+        self.router = router
+        self.task = task
+        self.providers = providers
+        self.model = providers[0].model
+        self.temperature = providers[0].temperature
+
+    @property
+    def models(self):
+        return [provider.model for provider in self.providers]
+
+    def invoke(self, prompt):
+        return self.invoke_answered(prompt)[1]
+
+    def stream(self, prompt):
+        for _, chunk in self.stream_answered(prompt):
+            yield chunk
+
+    def invoke_answered(self, prompt):
+        answers = list(self.router.run(self.providers, prompt, stream=False))
+        return answers[0][0], "".join(chunk for _, chunk in answers)
+
+    def stream_answered(self, prompt):
+        return self.router.run(self.providers, prompt, stream=True)
+
+
+class LLMRouter(LLMBackend):
+    """
+    Per-task model routing with fallback and optional hedged requests.
+
+    Each task maps to a chain of providers. The first provider gets the request;
+    an error before the first token moves on to the next one. With hedging
+    enabled, a provider that has not produced its first token (its whole answer
+    for invoke) within hedge_factor times its recent p95 gets a second request
+    sent to the next provider in the chain, and whichever answers first wins.
+    The slower request is abandoned and its chunks discarded. Hedged requests
+    run on a shared pool; without hedging the providers are called in the
+    caller's thread. Chunks are reported with the model that produced them.
+    """
+
+    def __init__(self, providers, routes, hedge=LLM_HEDGE_ENABLED, hedge_factor=LLM_HEDGE_FACTOR,
+                 hedge_min_samples=LLM_HEDGE_MIN_SAMPLES, hedge_default_ms=LLM_HEDGE_DEFAULT_MS):
+        self.providers = providers
+        self.hedge = hedge
+        self.hedge_factor = hedge_factor
+        self.hedge_min_samples = hedge_min_samples
+        self.hedge_default_ms = hedge_default_ms
+        self._stats = {provider.model: ProviderStats() for provider in providers.values()}
+        self._routes = {}
+        for task, chain in routes.items():
+            available = [providers[spec] for spec in chain if spec in providers]
+            if available:
+                self._routes[task] = RoutedBackend(self, task, available)
+            else:
+                logger.warning(f"No configured LLM provider for task {task}: {chain}")
+        if "default" not in self._routes:
+            raise ValueError("The default LLM route has no configured provider")
+        default = self._routes["default"]
+        self.model = default.model
+        self.temperature = default.temperature
+
+    def for_task(self, task):
+        return self._routes.get(task) or self._routes["default"]
+
+    def invoke(self, prompt):
+        return self.for_task("default").invoke(prompt)
+
+    def stream(self, prompt):
+        return self.for_task("default").stream(prompt)
+
+    @property
+    def models(self):
+        return self.for_task("default").models
+
+    def invoke_answered(self, prompt):
+        return self.for_task("default").invoke_answered(prompt)
+
+    def stream_answered(self, prompt):
+        return self.for_task("default").stream_answered(prompt)
+
+    def hedge_delay(self, provider):
+        p95 = self._stats[provider.model].p95_first_token(self.hedge_min_samples)
+        return p95 * self.hedge_factor if p95 is not None else self.hedge_default_ms / 1000
+
+    def _launch(self, provider, prompt, stream, events):
+        attempt = Attempt(provider)
+
+        def work():
+            try:
+                chunks = provider.stream(prompt) if stream else [provider.invoke(prompt)]
+                for chunk in chunks:
+                    if attempt.cancelled:
+                        break
+                    if attempt.first_token is None:
+                        attempt.first_token = time.perf_counter() - attempt.started
+                    events.put((attempt, "chunk", chunk))
+                events.put((attempt, "done", None))
+            except Exception as e:
+                events.put((attempt, "error", e))
+
+        hedge_executor.submit(work)
+        return attempt
+
+    def run(self, providers, prompt, stream):
+        """Yield (model, chunk) pairs from the first provider in the chain to answer."""
+        if not self.hedge or len(providers) == 1:
+            yield from self._run_inline(providers, prompt, stream)
+            return
+        events = queue.Queue()
+        pending = list(providers)
+        active = [self._launch(pending.pop(0), prompt, stream, events)]
+        try:
+            yield from self._collect(events, pending, active, prompt, stream)
+        finally:
+            # Stream abbandonato dal client: i thread smettono di leggere dai provider
+            for attempt in active:
+                attempt.cancelled = True
+
+    def _run_inline(self, providers, prompt, stream):
+        # Senza hedging i provider si provano uno dopo l'altro nel thread del chiamante
+        for index, provider in enumerate(providers):
+            model = provider.model
+            started = time.perf_counter()
+            first_token = None
+            try:
+                for chunk in provider.stream(prompt) if stream else [provider.invoke(prompt)]:
+                    if first_token is None:
+                        first_token = time.perf_counter() - started
+                        provider_first_token_seconds.observe(first_token, model=model)
+                    yield model, chunk
+            except Exception as e:
+                self._stats[model].record("error")
+                provider_requests.inc(model=model, outcome="error")
+                # Testo già inviato al client: un fallback lo duplicherebbe
+                if first_token is not None or index == len(providers) - 1:
+                    raise
+                logger.warning(f"LLM provider {model} failed: {e}")
+                continue
+            self._stats[model].record("won", first_token=first_token or 0.0, total=time.perf_counter() - started)
+            provider_requests.inc(model=model, outcome="won")
+            return
+
+    def _collect(self, events, pending, active, prompt, stream):
+        hedge_at = time.perf_counter() + self.hedge_delay(active[0].provider) if self.hedge else None
+        winner = None
+        while True:
+            timeout = None
+            if winner is None and hedge_at is not None and pending:
+                timeout = max(0.0, hedge_at - time.perf_counter())
+            try:
+                attempt, kind, payload = events.get(timeout=timeout)
+            except queue.Empty:
+                logger.info(f"Hedging {active[0].provider.model} with {pending[0].model}")
+                active.append(self._launch(pending.pop(0), prompt, stream, events))
+                hedge_at = None
+                continue
+
+            if attempt.cancelled:
+                continue
+            model = attempt.provider.model
+            if kind == "error":
+                self._stats[model].record("error")
+                provider_requests.inc(model=model, outcome="error")
+                active.remove(attempt)
+                if attempt is winner:
+                    # Testo già inviato al client: un fallback lo duplicherebbe
+                    raise payload
+                logger.warning(f"LLM provider {model} failed: {payload}")
+                if not active:
+                    if not pending:
+                        raise payload
+                    active.append(self._launch(pending.pop(0), prompt, stream, events))
+                    if self.hedge:
+                        hedge_at = time.perf_counter() + self.hedge_delay(active[0].provider)
+                continue
+
+            if winner is None:
+                winner = attempt
+                first_token = attempt.first_token if kind == "chunk" else time.perf_counter() - attempt.started
+                provider_first_token_seconds.observe(first_token, model=model)
+                for other in active:
+                    if other is not winner:
+                        other.cancelled = True
+                        self._stats[other.provider.model].record("lost")
+                        provider_requests.inc(model=other.provider.model, outcome="lost")
+            if attempt is not winner:
+                continue
+            if kind == "chunk":
+                yield model, payload
+            else:
+                self._stats[model].record(
+                    "won", first_token=winner.first_token or 0.0, total=time.perf_counter() - winner.started
+                )
+                provider_requests.inc(model=model, outcome="won")
+                return
+
+    def stats(self):
+        return {
+            "hedge": self.hedge,
+            "routes": {task: [p.model for p in routed.providers] for task, routed in self._routes.items()},
+            "providers": {name: stats.snapshot() for name, stats in self._stats.items()},
+        }
+
+
+def create_router(hedge=LLM_HEDGE_ENABLED):
+    # Una configurazione sbagliata non deve impedire l'import di lang: si ripiega su Gemini
+    try:
+        routes = task_routes()
+        providers = {}
+        for spec in {spec for chain in routes.values() for spec in chain}:
+            try:
+                provider = create_provider(spec)
+            except ValueError as e:
+                # Refuso in LLM_FAST_MODELS, LLM_STRONG_MODELS o LLM_ROUTES: il modello si salta
+                logger.warning(f"{e}, skipped")
+                continue
+            if provider is not None:
+                providers[spec] = provider
+        return LLMRouter(providers, routes, hedge=hedge)
+    except ValueError as e:
+        # Nessuna chiave configurata: come prima, l'errore arriva alla prima chiamata e non all'import
+        logger.warning(f"{e}, using Gemini only")
+        return GeminiBackend()
+
+
+def create_fake_router(first_token_ms, token_ms=0.0, error_rates=None, slow_rates=None, hedge=True, **kwargs):
+    """
+    Router over ReplayBackend providers, one per configured model, for offline runs.
+    first_token_ms, error_rates and slow_rates map model specs to the simulated behaviour.
+    """
+    routes = task_routes()
+    providers = {}
+    for seed, spec in enumerate(sorted({spec for chain in routes.values() for spec in chain})):
+        fake = ReplayBackend(
+            model=spec,
+            first_token_ms=first_token_ms.get(spec, 0.0),
+            token_ms=token_ms,
+            error_rate=(error_rates or {}).get(spec, 0.0),
+            slow_rate=(slow_rates or {}).get(spec, 0.0),
+            seed=seed,
+        )
+        providers[spec] = fake
+    return LLMRouter(providers, routes, hedge=hedge, **kwargs)
+
+
+def create_llm_backend(kind=LLM_BACKEND):
+    if kind == "router":
+        return create_router()
+    if kind == "replay":
+        return ReplayBackend()
+    if kind == "record":
+        return ReplayBackend(record_from=GeminiBackend())
+    if kind != "gemini":
+        raise ValueError(f"Unknown LLM_BACKEND: {kind}")
+    return GeminiBackend()
@@ -0,0 +1,223 @@
+import os
+import json
+import time
+import logging
+import threading
+
+from googleapiclient.errors import HttpError
+
+from services.gmail_service import iter_unread_messages, parse_messages
+
+CACHE_PATH = os.path.join("cache", "mailbox.json")
+# Intervallo minimo tra due chiamate a history.list (secondi)
+SYNC_MIN_INTERVAL = float(os.getenv("MAIL_SYNC_MIN_INTERVAL", "2"))
+# 'metadata' tiene in cache solo header e snippet; il body si chiede a /messages/{id}/body
+SYNC_FORMAT = os.getenv("MAIL_SYNC_FORMAT", "full")
+
+logger = logging.getLogger(__name__)
+
+
+def is_unread_inbox(label_ids):
+    return 'INBOX' in label_ids and 'UNREAD' in label_ids
+
+
+def message_order_key(message):
+    # Ordine totale: a parità di data decide l'id, così il cursore non salta né ripete messaggi
+    return int(message.get('internal_date') or 0), message['message_id']
+
+
+def format_cursor(message):
+    internal_date, message_id = message_order_key(message)
+    return f"{internal_date}.{message_id}"
+
+
+def parse_cursor(cursor):
+    """(internal_date, message_id) of a page cursor; ValueError if it is malformed."""
+    internal_date, separator, message_id = cursor.partition(".")
+    if not separator or not message_id:
+        raise ValueError(f"Invalid page token: {cursor}")
+    return int(internal_date), message_id
+
+
+class MailboxSync:
+    """
+    Local cache of the unread inbox kept in sync through the Gmail history API.
+
+    The first sync lists and downloads every unread message and stores the mailbox
+    historyId; later syncs only apply the added, deleted and relabeled messages
+    reported by users.history.list since that id.
+    """
+
+    def __init__(self, cache_path=CACHE_PATH, min_interval=SYNC_MIN_INTERVAL, message_format=SYNC_FORMAT):
+        self.cache_path = cache_path
+        self.min_interval = min_interval
+        self.message_format = message_format
+        self.history_id = None
+        self.messages = {}
+        self._last_sync = 0.0
+        self._lock = threading.Lock()
+        self._sync_lock = threading.Lock()
+        self._listeners = []
+        self._load()
+
+    def _load(self):
+        if not os.path.exists(self.cache_path):
+            return
+        try:
+            with open(self.cache_path, 'r') as f:
+                data = json.load(f)
+            self.history_id = data.get("history_id")
+            self.messages = data.get("messages", {})
+        except (OSError, ValueError) as e:
+            logger.warning(f"Mailbox cache not readable, doing a full sync: {e}")
+            self.history_id = None
+            self.messages = {}
+
+    def _save(self):
+        os.makedirs(os.path.dirname(self.cache_path) or ".", exist_ok=True)
+        tmp_path = self.cache_path + ".tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump({"history_id": self.history_id, "messages": self.messages}, f, ensure_ascii=False)
+        os.replace(tmp_path, self.cache_path)
+
+    def sync(self, service, force=False):
+        """Bring the cache up to date; returns the messages that entered the unread inbox."""
+        # _sync_lock serializza le sync durante le chiamate a Gmail; _lock protegge solo lo stato in memoria
+        with self._sync_lock:
+            if not force and time.monotonic() - self._last_sync < self.min_interval:
+                return []
+            with self._lock:
+                known_ids = set(self.messages)
+                history_id = self.history_id
+            # Prima sync (o cache illeggibile): tutti i non letti risultano "aggiunti"
+            initial = history_id is None
+            if initial:
+                self._full_sync(service)
+            else:
+                try:
+                    self._incremental_sync(service, history_id, known_ids)
+                except HttpError as e:
+                    # historyId troppo vecchio: Gmail risponde 404 e serve una sync completa
+                    if e.resp.status != 404:
+                        raise
+                    logger.info("History id expired, falling back to full sync")
+                    self._full_sync(service)
+            self._last_sync = time.monotonic()
+            with self._lock:
+                added = [message for msg_id, message in self.messages.items() if msg_id not in known_ids]
+        for listener in self._listeners:
+            try:
+                listener(added, initial)
+            except Exception as e:
+                logger.error(f"Mailbox sync listener failed: {e}")
+        return added
+
+    def add_listener(self, listener):
+        """
+        Call listener(added_messages, initial) after every sync. initial is True for
+        the first sync of an empty cache, where every unread message counts as added.
+        """
+        self._listeners.append(listener)
+
+    def _full_sync(self, service):
+        # historyId preso prima del listing: le modifiche successive arrivano con la prossima sync
+        history_id = service.users().getProfile(userId='me').execute()['historyId']
+        msg_ids = [msg['id'] for msg in iter_unread_messages(service)]
+        parsed_messages, errors = parse_messages(service, msg_ids, message_format=self.message_format)
+        for error in errors:
+            logger.warning(f"Full sync could not fetch {error['message_id']}: {error['error']}")
+        with self._lock:
+            self.messages = {parsed['message_id']: parsed for parsed in parsed_messages}
+            self.history_id = history_id
+            self._save()
+        logger.info(f"Full mailbox sync: {len(parsed_messages)} unread messages")
+
+    def _incremental_sync(self, service, start_history_id, known_ids):
+        # Ultimo stato noto delle label per ogni messaggio toccato (None = cancellato)
+        changes = {}
+        history_id = start_history_id
+        page_token = None
+        while True:
+            response = service.users().history().list(
+                userId='me',
+                startHistoryId=start_history_id,
+                historyTypes=['messageAdded', 'messageDeleted', 'labelAdded', 'labelRemoved'],
+                pageToken=page_token
+            ).execute()
+            for record in response.get('history', []):
+                for key in ('messagesAdded', 'labelsAdded', 'labelsRemoved'):
+                    for event in record.get(key, []):
+                        message = event['message']
+                        changes[message['id']] = message.get('labelIds', [])
+                for event in record.get('messagesDeleted', []):
+                    changes[event['message']['id']] = None
+            history_id = response.get('historyId', history_id)
+            page_token = response.get('nextPageToken')
+            if not page_token:
+                break
+
+        to_fetch = [
+            msg_id for msg_id, label_ids in changes.items()
+            if label_ids is not None and is_unread_inbox(label_ids) and msg_id not in known_ids
+        ]
+        parsed_messages, errors = [], []
+        if to_fetch:
+            parsed_messages, errors = parse_messages(service, to_fetch, message_format=self.message_format)
+
+        with self._lock:
+            for msg_id, label_ids in changes.items():
+                if label_ids is None or not is_unread_inbox(label_ids):
+                    self.messages.pop(msg_id, None)
+                elif msg_id in self.messages:
+                    self.messages[msg_id]['label_ids'] = label_ids
+            for parsed in parsed_messages:
+                self.messages[parsed['message_id']] = parsed
+            if errors:
+                # Senza avanzare l'historyId i messaggi mancanti verranno ripresi alla prossima sync
+                logger.warning(f"Incremental sync could not fetch {len(errors)} messages")
+            else:
+                self.history_id = history_id
+            self._save()
+
+    def unread_messages(self):
+        """Cached unread messages, newest first."""
+        with self._lock:
+            messages = list(self.messages.values())
+        messages.sort(key=message_order_key, reverse=True)
+        return messages
+
+    def unread_page(self, cursor=None, page_size=100):
+        """
+        One page of cached unread messages, newest first, and the cursor of the next
+        page (None on the last one). The cursor is the (date, id) of the last message
+        returned, so messages read, relabeled or arriving in between do not shift
+        the following pages.
+        """
+        messages = self.unread_messages()
+        if cursor:
+            after = parse_cursor(cursor)
+            messages = [message for message in messages if message_order_key(message) < after]
+        page = messages[:page_size]
+        return page, (format_cursor(page[-1]) if len(messages) > page_size else None)
+
+    def apply_label_changes(self, msg_ids, add_label_ids=(), remove_label_ids=()):
+        """
+        Apply label changes we made ourselves, so the next sync finds the cache
+        already up to date. Messages that leave the unread inbox are dropped;
+        the ones that enter it are picked up by the next history sync.
+        """
+        with self._lock:
+            for msg_id in msg_ids:
+                cached = self.messages.get(msg_id)
+                if cached is None:
+                    continue
+                label_ids = [l for l in cached.get('label_ids', []) if l not in remove_label_ids]
+                label_ids += [l for l in add_label_ids if l not in label_ids]
+                if is_unread_inbox(label_ids):
+                    cached['label_ids'] = label_ids
+                else:
+                    del self.messages[msg_id]
+            self._save()
+
+
+mailbox_sync = MailboxSync()
@@ -0,0 +1,203 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from datetime import datetime
+
+CONVERSATION_DIR = "conversations"
+DB_PATH = os.path.join(CONVERSATION_DIR, "conversations.db")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS threads (
+    thread_id TEXT PRIMARY KEY,
+    subject TEXT
+);
+CREATE TABLE IF NOT EXISTS messages (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    thread_id TEXT NOT NULL,
+    message_key TEXT NOT NULL,
+    day TEXT NOT NULL,
+    sender TEXT,
+    email TEXT,
+    date TEXT,
+    text TEXT,
+    UNIQUE (thread_id, message_key)
+);
+CREATE INDEX IF NOT EXISTS idx_messages_day ON messages (day, thread_id);
+CREATE TABLE IF NOT EXISTS triage (
+    message_id TEXT PRIMARY KEY,
+    problem_type TEXT,
+    summary TEXT,
+    draft_chunks TEXT,
+    updated_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS rfc822_index (
+    rfc822_id TEXT PRIMARY KEY,
+    gmail_id TEXT NOT NULL
+);
+"""
+
+
+def connect_sqlite(db_path):
+    # Apertura lazy: importare il modulo non crea file
+    os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+    conn = sqlite3.connect(db_path, timeout=30)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
+
+def normalize_rfc822_id(rfc822_id):
+    # Il frontend può passare il Message-ID con o senza parentesi angolari
+    return rfc822_id.strip().strip('<>')
+
+
+class MessageStore:
+    """
+    SQLite (WAL) store for the support conversations.
+
+    Messages are keyed by (thread_id, message id): duplicates are dropped by the
+    unique index, and each write is a single small transaction instead of a rewrite
+    of the daily JSON file. Each thread gets its own connection.
+    """
+
+    def __init__(self, db_path=DB_PATH):
+        self.db_path = db_path
+        self._local = threading.local()
+        self._schema_ready = False
+        self._schema_lock = threading.Lock()
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = connect_sqlite(self.db_path)
+            with self._schema_lock:
+                if not self._schema_ready:
+                    conn.executescript(SCHEMA)
+                    self._schema_ready = True
+            self._local.conn = conn
+        return conn
+
+    def save_message(self, parsed_message, reply=False):
+        entry = {
+            "from": parsed_message['senderName'] if not reply else "Support Agent",
+            "email": parsed_message['senderEmail'] if not reply else "support@fitapp.com",
+            "date": parsed_message['date'],
+            "text": parsed_message['text']
+        }
+        message_key = parsed_message.get('message_id')
+        if not message_key:
+            # Nessun id Gmail: si deduplica sul contenuto come faceva il JSON
+            message_key = hashlib.sha1(json.dumps(entry, sort_keys=True).encode('utf-8')).hexdigest()
+        day = datetime.today().strftime("%Y-%m-%d")
+
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR IGNORE INTO threads (thread_id, subject) VALUES (?, ?)",
+                (parsed_message['thread_id'], parsed_message['subject'])
+            )
+            conn.execute(
+                "INSERT OR IGNORE INTO messages (thread_id, message_key, day, sender, email, date, text) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (parsed_message['thread_id'], message_key, day,
+                 entry["from"], entry["email"], entry["date"], entry["text"])
+            )
+
+    def get_thread(self, thread_id):
+        conn = self._connect()
+        thread = conn.execute("SELECT subject FROM threads WHERE thread_id = ?", (thread_id,)).fetchone()
+        if thread is None:
+            return None
+        rows = conn.execute(
+            "SELECT sender, email, date, text FROM messages WHERE thread_id = ? ORDER BY seq",
+            (thread_id,)
+        ).fetchall()
+        return {"subject": thread["subject"], "messages": [self._entry(row) for row in rows]}
+
+    def get_day_conversations(self, day=None):
+        """Conversations saved on `day` (YYYY-MM-DD), in the daily JSON format."""
+        day = day or datetime.today().strftime("%Y-%m-%d")
+        rows = self._connect().execute(
+            "SELECT m.thread_id, t.subject, m.sender, m.email, m.date, m.text "
+            "FROM messages m JOIN threads t ON t.thread_id = m.thread_id "
+            "WHERE m.day = ? ORDER BY m.seq",
+            (day,)
+        ).fetchall()
+
+        data = {}
+        for row in rows:
+            thread = data.setdefault(row["thread_id"], {"subject": row["subject"], "messages": []})
+            thread["messages"].append(self._entry(row))
+        return data
+
+    def export_day_to_json(self, day=None, json_path=None):
+        """Write the conversations of `day` to conversations/conversations_<day>.json."""
+        day = day or datetime.today().strftime("%Y-%m-%d")
+        json_path = json_path or os.path.join(os.path.dirname(self.db_path), f"conversations_{day}.json")
+        with open(json_path, 'w') as f:
+            json.dump(self.get_day_conversations(day), f, indent=2, ensure_ascii=False)
+        return json_path
+
+    def save_rfc822_id(self, rfc822_id, gmail_id):
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO rfc822_index (rfc822_id, gmail_id) VALUES (?, ?)",
+                (normalize_rfc822_id(rfc822_id), gmail_id)
+            )
+
+    def get_gmail_id(self, rfc822_id):
+        row = self._connect().execute(
+            "SELECT gmail_id FROM rfc822_index WHERE rfc822_id = ?",
+            (normalize_rfc822_id(rfc822_id),)
+        ).fetchone()
+        return row["gmail_id"] if row else None
+
+    def forget_rfc822_id(self, rfc822_id):
+        with self._connect() as conn:
+            conn.execute("DELETE FROM rfc822_index WHERE rfc822_id = ?", (normalize_rfc822_id(rfc822_id),))
+
+    def save_triage(self, message_id, problem_type=None, summary=None, draft_chunks=None):
+        # Upsert parziale: i campi None non sovrascrivono quelli già calcolati
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT INTO triage (message_id, problem_type, summary, draft_chunks, updated_at) "
+                "VALUES (?, ?, ?, ?, ?) ON CONFLICT (message_id) DO UPDATE SET "
+                "problem_type = COALESCE(excluded.problem_type, problem_type), "
+                "summary = COALESCE(excluded.summary, summary), "
+                "draft_chunks = COALESCE(excluded.draft_chunks, draft_chunks), "
+                "updated_at = excluded.updated_at",
+                (message_id, problem_type, summary,
+                 json.dumps(draft_chunks, ensure_ascii=False) if draft_chunks is not None else None,
+                 time.time())
+            )
+
+    def get_triage(self, message_id):
+        row = self._connect().execute(
+            "SELECT problem_type, summary, draft_chunks FROM triage WHERE message_id = ?",
+            (message_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        return {
+            "problem_type": row["problem_type"],
+            "summary": row["summary"],
+            "draft_chunks": json.loads(row["draft_chunks"]) if row["draft_chunks"] else None
+        }
+
+    @staticmethod
+    def _entry(row):
+        return {"from": row["sender"], "email": row["email"], "date": row["date"], "text": row["text"]}
+
+
+message_store = MessageStore()
+
+
+if __name__ == '__main__':
+    import sys
+
+    # Esporta nel vecchio formato JSON: python -m services.message_store [YYYY-MM-DD]
+    path = message_store.export_day_to_json(sys.argv[1] if len(sys.argv) > 1 else None)
+    print(f"✅ Conversazioni esportate in {path}")
@@ -0,0 +1,291 @@
+import os
+import re
+import time
+import bisect
+import logging
+import threading
+import contextvars
+from collections import deque
+from contextlib import contextmanager
+
+from starlette.routing import Match
+
+# Campioni recenti per serie su cui si calcolano p50/p95/p99
+METRICS_WINDOW = int(os.getenv("METRICS_WINDOW", "1024"))
+QUANTILES = (0.5, 0.95, 0.99)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+# Prezzi USD per milione di token (input, output)
+MODEL_PRICES = {
+    "gemini-1.5-flash": (
+        float(os.getenv("GEMINI_INPUT_COST_PER_MTOK", "0.075")),
+        float(os.getenv("GEMINI_OUTPUT_COST_PER_MTOK", "0.30")),
+    ),
+    "gemini-2.0-flash": (0.10, 0.40),
+    "openai/gpt-4o": (2.50, 10.00),
+    "anthropic/claude-3-sonnet-20240229": (3.00, 15.00),
+    "deepseek/deepseek-chat": (0.27, 1.10),
+}
+
+logger = logging.getLogger(__name__)
+
+# Etichette della richiesta in corso (route, problem_type); il dict è condiviso dalle
+# copie del contesto, così i nodi del grafo possono aggiornare problem_type
+_labels = contextvars.ContextVar("metric_labels", default=None)
+
+
+def current_labels():
+    labels = _labels.get() or {}
+    return {"route": labels.get("route") or "background", "problem_type": labels.get("problem_type") or "none"}
+
+
+@contextmanager
+def labelled(**labels):
+    """Set the request labels for the metrics recorded inside the block."""
+    token = _labels.set({**(_labels.get() or {}), **labels})
+    try:
+        yield
+    finally:
+        _labels.reset(token)
+
+
+def set_label(key, value, allowed=None):
+    """
+    Update a label of the current request. With `allowed`, values outside that set
+    are recorded as "other", so free text (e.g. raw LLM output) cannot create new series.
+    """
+    labels = _labels.get()
+    if labels is not None and value:
+        labels[key] = value if allowed is None or value in allowed else "other"
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for v in labels.values())
+    return "{" + ",".join(f'{k}="{v}"' for k, v in zip(labels, escaped)) + "}"
+
+
+def quantile(sorted_values, q):
+    if not sorted_values:
+        return float("nan")
+    index = q * (len(sorted_values) - 1)
+    low = int(index)
+    high = min(low + 1, len(sorted_values) - 1)
+    return sorted_values[low] + (sorted_values[high] - sorted_values[low]) * (index - low)
+
+
+class Histogram:
+    """
+    Prometheus histogram (cumulative buckets, sum, count) that also keeps the last
+    `window` samples of each series to export p50/p95/p99 as a gauge.
+    """
+
+    def __init__(self, name, documentation, labelnames, buckets=LATENCY_BUCKETS, window=METRICS_WINDOW):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self.window = window
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = {
+                    "buckets": [0] * len(self.buckets), "sum": 0.0, "count": 0,
+                    "recent": deque(maxlen=self.window),
+                }
+            position = bisect.bisect_left(self.buckets, value)
+            if position < len(self.buckets):
+                series["buckets"][position] += 1
+            series["sum"] += value
+            series["count"] += 1
+            series["recent"].append(value)
+
+    def samples(self):
+        """Recent samples of every series as [(labels, sorted values)]."""
+        with self._lock:
+            return [(dict(zip(self.labelnames, key)), sorted(s["recent"])) for key, s in self._series.items()]
+
+    def render(self):
+        with self._lock:
+            snapshot = [(key, list(s["buckets"]), s["sum"], s["count"], sorted(s["recent"]))
+                        for key, s in self._series.items()]
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        quantile_lines = [f"# HELP {self.name}_quantile {self.documentation} (last {self.window} samples)",
+                          f"# TYPE {self.name}_quantile gauge"]
+        for key, buckets, total, count, recent in snapshot:
+            labels = dict(zip(self.labelnames, key))
+            cumulative = 0
+            for bound, hits in zip(self.buckets, buckets):
+                cumulative += hits
+                lines.append(f"{self.name}_bucket{format_labels({**labels, 'le': repr(bound)})} {cumulative}")
+            lines.append(f"{self.name}_bucket{format_labels({**labels, 'le': '+Inf'})} {count}")
+            lines.append(f"{self.name}_sum{format_labels(labels)} {total}")
+            lines.append(f"{self.name}_count{format_labels(labels)} {count}")
+            for q in QUANTILES:
+                quantile_lines.append(
+                    f"{self.name}_quantile{format_labels({**labels, 'quantile': str(q)})} {quantile(recent, q)}"
+                )
+        return lines + quantile_lines
+
+
+class Counter:
+    def __init__(self, name, documentation, labelnames):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1.0, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def render(self):
+        with self._lock:
+            snapshot = list(self._values.items())
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        for key, value in snapshot:
+            lines.append(f"{self.name}{format_labels(dict(zip(self.labelnames, key)))} {value}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+
+    def histogram(self, *args, **kwargs):
+        metric = Histogram(*args, **kwargs)
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, *args, **kwargs):
+        metric = Counter(*args, **kwargs)
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        """Prometheus text exposition format (version 0.0.4)."""
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+request_seconds = registry.histogram(
+    "request_duration_seconds", "HTTP request or websocket session duration", ("route", "problem_type"))
+node_seconds = registry.histogram(
+    "graph_node_duration_seconds", "LangGraph node execution time", ("node", "route", "problem_type"))
+llm_seconds = registry.histogram(
+    "llm_request_duration_seconds", "LLM call total time", ("model", "route", "problem_type"))
+llm_ttft_seconds = registry.histogram(
+    "llm_time_to_first_token_seconds", "LLM time to first streamed chunk", ("model", "route", "problem_type"))
+llm_tokens = registry.counter(
+    "llm_tokens_total", "LLM tokens (estimated, ~4 characters per token)", ("model", "kind", "route", "problem_type"))
+llm_cost = registry.counter(
+    "llm_cost_usd_total", "Estimated LLM cost in USD", ("model", "route", "problem_type"))
+rag_seconds = registry.histogram(
+    "rag_search_duration_seconds", "RAG retrieval time", ("operation", "route", "problem_type"))
+gmail_seconds = registry.histogram(
+    "gmail_api_duration_seconds", "Gmail API HTTP request time", ("method", "operation", "status"))
+
+
+@contextmanager
+def span(histogram, name=None, **labels):
+    """Time the block into histogram, with the current request labels unless overridden."""
+    labels = {**current_labels(), **labels}
+    started = time.perf_counter()
+    try:
+        yield labels
+    finally:
+        elapsed = time.perf_counter() - started
+        histogram.observe(elapsed, **labels)
+        logger.debug(f"span {name or histogram.name} {labels} {elapsed * 1000:.1f}ms")
+
+
+def estimate_tokens(text):
+    return (len(text) + 3) // 4
+
+
+def record_llm_usage(model, prompt, completion, labels):
+    prompt_tokens = estimate_tokens(prompt)
+    completion_tokens = estimate_tokens(completion)
+    llm_tokens.inc(prompt_tokens, model=model, kind="prompt", **labels)
+    llm_tokens.inc(completion_tokens, model=model, kind="completion", **labels)
+    input_price, output_price = MODEL_PRICES.get(model, (0.0, 0.0))
+    llm_cost.inc((prompt_tokens * input_price + completion_tokens * output_price) / 1_000_000, model=model, **labels)
+
+
+def timed_llm_call(model, prompt, call):
+    """
+    Run a blocking LLM call returning (model, response), recording latency, tokens
+    and cost under the model that answered (the requested one if the call fails).
+    """
+    with span(llm_seconds, name="llm", model=model) as labels:
+        model, response = call()
+        # L'istogramma viene osservato all'uscita: vale il modello che ha risposto davvero
+        labels["model"] = model
+    record_llm_usage(model, prompt, response, {k: labels[k] for k in ("route", "problem_type")})
+    return model, response
+
+
+def timed_llm_stream(model, prompt, open_stream):
+    """
+    Wrap an LLM stream of (model, chunk) pairs, recording time to first token,
+    total time, tokens and cost under the model that answered.
+    """
+    labels = current_labels()
+    started = time.perf_counter()
+    chunks = []
+    for model, chunk in open_stream():
+        if not chunks:
+            llm_ttft_seconds.observe(time.perf_counter() - started, model=model, **labels)
+        chunks.append(chunk)
+        yield model, chunk
+    llm_seconds.observe(time.perf_counter() - started, model=model, **labels)
+    record_llm_usage(model, prompt, "".join(chunks), labels)
+
+
+class MetricsMiddleware:
+    """
+    ASGI middleware that labels each request with its route template and records
+    its duration (for websockets, the whole session) by route and problem_type.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    def _route(self, scope):
+        for route in scope["app"].router.routes:
+            match, _ = route.matches(scope)
+            if match == Match.FULL:
+                return route.path
+        return "unmatched"
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] not in ("http", "websocket"):
+            return await self.app(scope, receive, send)
+        route = self._route(scope)
+        with labelled(route=route):
+            started = time.perf_counter()
+            try:
+                await self.app(scope, receive, send)
+            finally:
+                if route != "/metrics":
+                    request_seconds.observe(time.perf_counter() - started, **current_labels())
+
+
+GMAIL_ID = re.compile(r'/[0-9a-fA-F]{12,}(?=/|$)')
+
+
+def gmail_operation(uri):
+    """Gmail endpoint with message/thread ids replaced, e.g. /gmail/v1/users/me/messages/{id}."""
+    path = re.sub(r'^https?://[^/]+', '', uri).split("?")[0]
+    return GMAIL_ID.sub("/{id}", path)
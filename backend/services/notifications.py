@@ -0,0 +1,178 @@
+import os
+import json
+import time
+import base64
+import asyncio
+import logging
+import threading
+
+from services.gmail_client import gmail_clients
+from services.mail_sync import mailbox_sync
+
+# Topic Pub/Sub configurato per users.watch (projects/<id>/topics/<nome>)
+PUBSUB_TOPIC = os.getenv("GMAIL_PUBSUB_TOPIC")
+# Token atteso come ?token=... sulle push di Pub/Sub
+PUBSUB_VERIFICATION_TOKEN = os.getenv("PUBSUB_VERIFICATION_TOKEN")
+# La watch scade dopo 7 giorni: Google consiglia di rinnovarla ogni giorno
+WATCH_RENEW_SECONDS = 24 * 60 * 60
+# Eventi in attesa per ogni client prima di scartare i più vecchi
+CLIENT_QUEUE_SIZE = 100
+# Secondi senza eventi dopo cui si manda un commento SSE per tenere viva la connessione
+SSE_KEEPALIVE_SECONDS = 15
+
+logger = logging.getLogger(__name__)
+
+
+def start_watch(service, topic_name=PUBSUB_TOPIC):
+    response = service.users().watch(
+        userId='me',
+        body={'topicName': topic_name, 'labelIds': ['INBOX'], 'labelFilterBehavior': 'INCLUDE'}
+    ).execute()
+    logger.info(f"Gmail watch active until {response.get('expiration')}")
+    return response
+
+
+def decode_push_envelope(envelope):
+    """Decode a Pub/Sub push body into Gmail's {'emailAddress', 'historyId'} payload."""
+    data = envelope.get('message', {}).get('data')
+    if not data:
+        return None
+    return json.loads(base64.b64decode(data).decode('utf-8'))
+
+
+class NotificationHub:
+    """
+    Turns Gmail change notifications into new-message events for connected clients.
+
+    Every notification (from Pub/Sub push or from a LocalNotificationSource) triggers
+    one history sync of the mailbox cache. The messages that entered the unread inbox
+    in any sync, whoever ran it, are broadcast to each subscriber's queue, except on
+    the initial full sync. Notifications arriving while a sync is running are
+    coalesced into a single follow-up sync.
+    """
+
+    def __init__(self, sync=mailbox_sync, clients=gmail_clients):
+        self.sync = sync
+        self.clients = clients
+        self._subscribers = set()
+        self._loop = None
+        self._pending = threading.Event()
+        self._syncing = threading.Lock()
+        # Anche /unread-mails e il pre-triage sincronizzano: i nuovi messaggi si pubblicano da qui
+        sync.add_listener(self._publish_added)
+
+    def bind_loop(self, loop):
+        self._loop = loop
+
+    def subscribe(self):
+        queue = asyncio.Queue(maxsize=CLIENT_QUEUE_SIZE)
+        self._subscribers.add(queue)
+        return queue
+
+    def unsubscribe(self, queue):
+        self._subscribers.discard(queue)
+
+    def _deliver(self, event):
+        for queue in list(self._subscribers):
+            if queue.full():
+                # Client lento: si perde l'evento più vecchio, non si blocca il broadcast
+                queue.get_nowait()
+            queue.put_nowait(event)
+
+    def publish(self, event):
+        """Thread-safe broadcast of an event to every subscriber."""
+        if self._loop is None:
+            return
+        self._loop.call_soon_threadsafe(self._deliver, event)
+
+    def _publish_added(self, added, initial=False):
+        if initial:
+            # La prima sync elenca tutta la posta non letta, non mail appena arrivate
+            logger.info(f"Initial mailbox sync: {len(added)} unread messages not broadcast")
+            return
+        for message in added:
+            self.publish({"type": "new_message", "data": message, "received_at": time.time()})
+
+    def event_stream(self, keepalive=SSE_KEEPALIVE_SECONDS):
+        """Subscribe now and return the events as Server-Sent Events text (async generator)."""
+        queue = self.subscribe()
+
+        async def generate():
+            try:
+                while True:
+                    try:
+                        event = await asyncio.wait_for(queue.get(), timeout=keepalive)
+                    except asyncio.TimeoutError:
+                        yield ": keepalive\n\n"
+                        continue
+                    yield f"event: {event['type']}\ndata: {json.dumps(event, ensure_ascii=False)}\n\n"
+            finally:
+                self.unsubscribe(queue)
+
+        return generate()
+
+    def handle_notification(self, notification=None):
+        """Sync the mailbox after a change notification (blocking, run it off the loop)."""
+        self._pending.set()
+        while self._pending.is_set():
+            if not self._syncing.acquire(blocking=False):
+                # Una sync è già in corso: chi la tiene ricontrolla _pending dopo il rilascio
+                return
+            try:
+                while self._pending.is_set():
+                    self._pending.clear()
+                    with self.clients.service() as service:
+                        self.sync.sync(service, force=True)
+            finally:
+                self._syncing.release()
+            # Una notifica arrivata tra l'ultimo controllo e il rilascio ha trovato il lock
+            # occupato: il giro esterno la recupera
+
+
+class LocalNotificationSource:
+    """
+    Offline stand-in for the Pub/Sub subscription: anything calling publish()
+    behaves like a Gmail push for the given history id.
+    """
+
+    def __init__(self, hub):
+        self.hub = hub
+
+    def publish(self, history_id=None, email_address="me"):
+        self.hub.handle_notification({"emailAddress": email_address, "historyId": history_id})
+
+
+class WatchRenewer:
+    """Keeps the Gmail users.watch registration alive while the app runs."""
+
+    def __init__(self, topic_name=PUBSUB_TOPIC, clients=gmail_clients, interval=WATCH_RENEW_SECONDS):
+        self.topic_name = topic_name
+        self.clients = clients
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                with self.clients.service() as service:
+                    start_watch(service, self.topic_name)
+            except Exception as e:
+                logger.error(f"Gmail watch registration failed: {e}")
+            self._stop.wait(self.interval)
+
+    def start(self):
+        if not self.topic_name:
+            logger.info("GMAIL_PUBSUB_TOPIC not set: push notifications only from the local source")
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="gmail-watch", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+
+notification_hub = NotificationHub()
+local_notifications = LocalNotificationSource(notification_hub)
+watch_renewer = WatchRenewer()
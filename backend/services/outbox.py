@@ -0,0 +1,213 @@
+import os
+import time
+import uuid
+import random
+import logging
+import threading
+
+from googleapiclient.errors import HttpError
+
+from services.message_store import connect_sqlite, CONVERSATION_DIR
+from services.concurrency import RateLimiter
+from services.gmail_service import send_reply_email, log_sent_reply, find_thread_message
+from services.gmail_client import gmail_clients
+
+OUTBOX_DB_PATH = os.path.join(CONVERSATION_DIR, "outbox.db")
+OUTBOX_WORKERS = int(os.getenv("OUTBOX_WORKERS", "2"))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "6"))
+# messages.send costa 100 unità e il limite per utente è 250 unità/s: circa 2 invii al secondo
+OUTBOX_SENDS_PER_SECOND = float(os.getenv("OUTBOX_SENDS_PER_SECOND", "2"))
+BACKOFF_BASE = 2.0
+BACKOFF_MAX = 300.0
+RETRYABLE_STATUSES = (403, 429, 500, 502, 503, 504)
+# Header con l'id della riga: un nuovo tentativo trova la risposta già inviata nel thread
+OUTBOX_HEADER = "X-Outbox-Id"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS outbox (
+    id TEXT PRIMARY KEY,
+    to_addr TEXT NOT NULL,
+    subject TEXT,
+    message_text TEXT,
+    thread_id TEXT,
+    original_message_id TEXT,
+    status TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at REAL NOT NULL,
+    gmail_id TEXT,
+    last_error TEXT,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_outbox_due ON outbox (status, next_attempt_at);
+"""
+
+logger = logging.getLogger(__name__)
+
+
+class Outbox:
+    """
+    Durable queue of replies to send.
+
+    /reply-mail only inserts a row; a small pool of worker threads sends the mails
+    through Gmail, respecting the sending rate and retrying transient errors with
+    exponential backoff. The conversation log is updated only once Gmail has
+    accepted the message.
+
+    Each mail carries an X-Outbox-Id header. Before any new attempt of a row that
+    was already tried (a failure with unknown outcome, or a crash while sending)
+    the thread is searched for it, so the customer never gets the reply twice.
+    """
+
+    def __init__(self, db_path=OUTBOX_DB_PATH, workers=OUTBOX_WORKERS,
+                 sends_per_second=OUTBOX_SENDS_PER_SECOND, max_attempts=OUTBOX_MAX_ATTEMPTS):
+        self.db_path = db_path
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.rate_limiter = RateLimiter(sends_per_second, burst=max(1, int(sends_per_second)))
+        self._local = threading.local()
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._threads = []
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = connect_sqlite(self.db_path)
+            conn.executescript(SCHEMA)
+            self._local.conn = conn
+        return conn
+
+    def enqueue(self, to, subject, message_text, thread_id, original_message_id):
+        outbox_id = uuid.uuid4().hex
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT INTO outbox (id, to_addr, subject, message_text, thread_id, original_message_id, "
+                "status, next_attempt_at, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, 'queued', ?, ?, ?)",
+                (outbox_id, to, subject, message_text, thread_id, original_message_id, now, now, now)
+            )
+        self._wakeup.set()
+        return outbox_id
+
+    def status(self, outbox_id):
+        row = self._connect().execute(
+            "SELECT id, status, attempts, gmail_id, last_error, created_at, updated_at FROM outbox WHERE id = ?",
+            (outbox_id,)
+        ).fetchone()
+        return dict(row) if row else None
+
+    def _claim(self):
+        conn = self._connect()
+        now = time.time()
+        # BEGIN IMMEDIATE: un solo worker alla volta può prendere la stessa riga
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(
+                "SELECT * FROM outbox WHERE status = 'queued' AND next_attempt_at <= ? "
+                "ORDER BY next_attempt_at LIMIT 1",
+                (now,)
+            ).fetchone()
+            if row is not None:
+                conn.execute(
+                    "UPDATE outbox SET status = 'sending', attempts = attempts + 1, updated_at = ? WHERE id = ?",
+                    (now, row["id"])
+                )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return row
+
+    def _next_due_in(self):
+        row = self._connect().execute(
+            "SELECT MIN(next_attempt_at) AS due FROM outbox WHERE status = 'queued'"
+        ).fetchone()
+        if row["due"] is None:
+            return None
+        return max(0.0, row["due"] - time.time())
+
+    def _finish(self, outbox_id, status, gmail_id=None, error=None, next_attempt_at=None):
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE outbox SET status = ?, gmail_id = COALESCE(?, gmail_id), last_error = ?, "
+                "next_attempt_at = COALESCE(?, next_attempt_at), updated_at = ? WHERE id = ?",
+                (status, gmail_id, error, next_attempt_at, time.time(), outbox_id)
+            )
+
+    def _already_sent(self, service, row):
+        if not row["attempts"] or not row["thread_id"]:
+            return None
+        return find_thread_message(service, row["thread_id"], OUTBOX_HEADER, row["id"])
+
+    def _send(self, row):
+        self.rate_limiter.acquire()
+        try:
+            with gmail_clients.service() as service:
+                sent = self._already_sent(service, row)
+                if sent is not None:
+                    logger.info(f"Outbox {row['id']} was already sent as {sent['id']}")
+                else:
+                    sent = send_reply_email(
+                        service,
+                        to=row["to_addr"],
+                        subject=row["subject"],
+                        message_text=row["message_text"],
+                        thread_id=row["thread_id"],
+                        original_message_id=row["original_message_id"],
+                        headers={OUTBOX_HEADER: row["id"]}
+                    )
+        except Exception as e:
+            status = getattr(getattr(e, 'resp', None), 'status', None)
+            retryable = not isinstance(e, HttpError) or status in RETRYABLE_STATUSES
+            if retryable and row["attempts"] + 1 < self.max_attempts:
+                delay = min(BACKOFF_MAX, BACKOFF_BASE ** (row["attempts"] + 1)) * random.uniform(0.8, 1.2)
+                logger.warning(f"Outbox {row['id']} failed ({e}), retry in {delay:.0f}s")
+                self._finish(row["id"], "queued", error=str(e), next_attempt_at=time.time() + delay)
+            else:
+                logger.error(f"Outbox {row['id']} failed permanently: {e}")
+                self._finish(row["id"], "failed", error=str(e))
+            return
+        # Gmail ha accettato la mail: prima si registra l'invio, e nessun errore successivo la rimette in coda
+        self._finish(row["id"], "sent", gmail_id=sent["id"])
+        try:
+            log_sent_reply(sent["id"], row["thread_id"], row["subject"], row["message_text"])
+        except Exception as e:
+            logger.error(f"Outbox {row['id']} sent but not saved in the conversation log: {e}")
+
+    def _worker(self):
+        while not self._stop.is_set():
+            # Un errore SQLite non deve fermare il thread: si riprova al giro successivo
+            try:
+                row = self._claim()
+                if row is not None:
+                    self._send(row)
+                    continue
+                self._wakeup.clear()
+                due = self._next_due_in()
+            except Exception as e:
+                logger.error(f"Outbox worker error: {e}")
+                due = None
+            # due == 0.0 vuol dire un invio già scaduto: si riparte subito, non tra 5 secondi
+            self._wakeup.wait(timeout=5.0 if due is None else due)
+
+    def start(self):
+        # Invii rimasti a metà per un crash tornano in coda: hanno attempts > 0, quindi prima
+        # di reinviarli _send cerca nel thread la mail con il loro X-Outbox-Id
+        with self._connect() as conn:
+            conn.execute("UPDATE outbox SET status = 'queued' WHERE status = 'sending'")
+        self._stop.clear()
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._worker, name=f"outbox-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        self._stop.set()
+        self._wakeup.set()
+        for thread in self._threads:
+            thread.join(timeout=5)
+        self._threads = []
+
+
+outbox = Outbox()
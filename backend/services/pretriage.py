@@ -0,0 +1,145 @@
+import os
+import queue
+import logging
+import itertools
+import threading
+
+from lang import classify_email, summary_email, process_email, EmailState
+from services.category_classifier import CATEGORIES
+from services.gmail_client import gmail_clients
+from services.gmail_service import get_message_body
+from services.message_store import message_store, normalize_rfc822_id
+from services.mail_sync import mailbox_sync
+from services.metrics import labelled
+from utils.priority_calculator import calculate_priority
+
+# Opt-in: ogni mail in arrivo costa una o più chiamate Gemini anche se non viene mai aperta
+PRETRIAGE_ENABLED = os.getenv("PRETRIAGE_ENABLED", "false").lower() == "true"
+PRETRIAGE_WORKERS = int(os.getenv("PRETRIAGE_WORKERS", "2"))
+PRETRIAGE_QUEUE_SIZE = int(os.getenv("PRETRIAGE_QUEUE_SIZE", "500"))
+# Esegue anche l'intero grafo (bozza compresa). Attenzione: bug_report apre issue su GitHub
+PRETRIAGE_FULL_GRAPH = os.getenv("PRETRIAGE_FULL_GRAPH", "false").lower() == "true"
+
+logger = logging.getLogger(__name__)
+
+
+def sender_header(message):
+    return f"{message['senderName']} <{message['senderEmail']}>" if message['senderName'] else message['senderEmail']
+
+
+def summary_text(message):
+    return f"""Subject: {message['subject']}
+                From: {sender_header(message)}
+                Date: {message['date']}
+
+                {message['text']}"""
+
+
+class PreTriage:
+    """
+    Background categorization and summary of unread mail.
+
+    Messages arriving after startup are queued by priority (urgent keywords, then
+    newest first) in a bounded queue; the initial full sync of the mailbox is not
+    pre-triaged. Workers run classify_email and summary_email (and optionally the
+    whole process_email graph) and store the results by Gmail id, so opening a mail
+    replays them instead of waiting on Gemini.
+    """
+
+    def __init__(self, workers=PRETRIAGE_WORKERS, queue_size=PRETRIAGE_QUEUE_SIZE, full_graph=PRETRIAGE_FULL_GRAPH):
+        self.workers = workers
+        self.full_graph = full_graph
+        self._queue = queue.PriorityQueue(maxsize=queue_size)
+        self._queued = set()
+        self._lock = threading.Lock()
+        self._counter = itertools.count()
+        self._stop = threading.Event()
+        self._threads = []
+        self._listening = False
+
+    def submit(self, messages, initial=False):
+        # Gira nel thread di chi ha fatto la sync: solo accodamento, i controlli li fa il worker
+        if initial:
+            return
+        for message in messages:
+            message_id = message['message_id']
+            with self._lock:
+                if message_id in self._queued:
+                    continue
+                try:
+                    # Il contatore evita di confrontare i dict a parità di priorità
+                    self._queue.put_nowait((calculate_priority(message), next(self._counter), message))
+                except queue.Full:
+                    logger.warning(f"Pre-triage queue full, {message_id} will be processed on open")
+                    continue
+                self._queued.add(message_id)
+
+    def _process(self, message):
+        message_id = message['message_id']
+        triage = message_store.get_triage(message_id)
+        if triage and triage["summary"] and (triage["draft_chunks"] or not self.full_graph):
+            return
+        if message.get('text') is None:
+            # Cache in modalità metadata: serve il body
+            with gmail_clients.service() as service:
+                message = {**message, 'text': get_message_body(service, message_id)['text']}
+
+        problem_type = classify_email(message['subject'], message['text'])
+        if problem_type not in CATEGORIES:
+            raise RuntimeError(problem_type)
+        message_store.save_triage(message_id, problem_type=problem_type)
+
+        summary = "".join(summary_email(summary_text(message)))
+        message_store.save_triage(message_id, summary=summary)
+
+        if self.full_graph:
+            sender = sender_header(message)
+            state = EmailState(
+                subject=message['subject'],
+                username=sender.split(" ")[0] if " " in sender else sender,
+                email_content=message['text'],
+                destination_email=sender,
+                problem_type=problem_type,
+                is_reply=False
+            )
+            # Stesso checkpoint della websocket /draft: il run non viene ripetuto all'apertura
+            thread_id = normalize_rfc822_id(message['original_message_id']) if message.get('original_message_id') else message_id
+            draft_chunks = [chunk["custom_key"] for chunk in process_email(state, thread_id=thread_id)]
+            message_store.save_triage(message_id, draft_chunks=draft_chunks)
+
+    def _worker(self):
+        while not self._stop.is_set():
+            try:
+                _, _, message = self._queue.get(timeout=1)
+            except queue.Empty:
+                continue
+            try:
+                with labelled(route="pretriage"):
+                    self._process(message)
+            except Exception as e:
+                logger.error(f"Pre-triage of {message['message_id']} failed: {e}")
+            finally:
+                with self._lock:
+                    self._queued.discard(message['message_id'])
+                self._queue.task_done()
+
+    def start(self):
+        if not PRETRIAGE_ENABLED:
+            return
+        if not self._listening:
+            mailbox_sync.add_listener(self.submit)
+            self._listening = True
+        self._stop.clear()
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._worker, name=f"pretriage-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        self._stop.set()
+        for thread in self._threads:
+            thread.join(timeout=5)
+        self._threads = []
+
+
+pretriage = PreTriage()
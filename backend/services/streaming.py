@@ -0,0 +1,128 @@
+import os
+import time
+import asyncio
+import logging
+from contextlib import aclosing
+
+from services.concurrency import iterate_blocking
+
+# Coalescenza opzionale: si invia quando il buffer supera questi caratteri...
+COALESCE_CHARS = int(os.getenv("STREAM_COALESCE_CHARS", "0"))
+# ...o quando il chunk più vecchio nel buffer ha più di questi millisecondi
+COALESCE_MS = float(os.getenv("STREAM_COALESCE_MS", "0"))
+# Chunk in attesa di invio prima di bloccare il producer (backpressure)
+MAX_PENDING_CHUNKS = int(os.getenv("STREAM_MAX_PENDING_CHUNKS", "64"))
+
+logger = logging.getLogger(__name__)
+
+_END = object()
+
+
+class StreamStats:
+    def __init__(self, name):
+        self.name = name
+        self.started = time.perf_counter()
+        self.first_chunk_at = None
+        self.chunks = 0
+        self.messages = 0
+        self.chars = 0
+
+    @property
+    def time_to_first_chunk(self):
+        if self.first_chunk_at is None:
+            return None
+        return self.first_chunk_at - self.started
+
+    def as_dict(self):
+        return {
+            "stream": self.name,
+            "ttfc_s": self.time_to_first_chunk,
+            "duration_s": time.perf_counter() - self.started,
+            "chunks": self.chunks,
+            "messages": self.messages,
+            "chars": self.chars,
+        }
+
+
+async def _produce(source, queue):
+    async with aclosing(iterate_blocking(source)) as chunks:
+        try:
+            async for chunk in chunks:
+                # Con la coda piena il producer aspetta: niente buffer illimitati se il client è lento
+                await queue.put(chunk)
+        except asyncio.CancelledError:
+            # Cancellato dal consumer che se ne va: nessuno leggerebbe la sentinella, e con la
+            # coda piena put() resterebbe bloccato per sempre
+            raise
+        except Exception:
+            await queue.put(_END)
+            raise
+    await queue.put(_END)
+
+
+async def stream_to_websocket(websocket, source, name="stream", transform=None,
+                              coalesce_chars=COALESCE_CHARS, coalesce_ms=COALESCE_MS,
+                              max_pending=MAX_PENDING_CHUNKS):
+    """
+    Forward the chunks of a synchronous generator to a websocket as soon as they arrive.
+
+    With coalesce_chars/coalesce_ms set, small chunks are merged until the buffer
+    reaches that size or the oldest buffered chunk is that old. The producer runs
+    on the blocking executor and is paused when max_pending chunks are waiting, so
+    a slow client applies backpressure all the way to the LLM stream.
+    Returns the StreamStats of the run (time to first chunk, duration...).
+    """
+    stats = StreamStats(name)
+    queue = asyncio.Queue(maxsize=max_pending)
+    producer = asyncio.create_task(_produce(source, queue))
+    coalesce = coalesce_chars > 0 or coalesce_ms > 0
+    buffer = []
+    buffered_chars = 0
+    buffer_started = None
+
+    async def flush():
+        nonlocal buffer, buffered_chars, buffer_started
+        if buffer:
+            # send_text aspetta che il frame sia scritto: è la backpressure del websocket
+            await websocket.send_text("".join(buffer))
+            stats.messages += 1
+            buffer, buffered_chars, buffer_started = [], 0, None
+
+    try:
+        while True:
+            timeout = None
+            if coalesce_ms > 0 and buffer_started is not None:
+                timeout = max(0.0, buffer_started + coalesce_ms / 1000 - time.perf_counter())
+            try:
+                chunk = await asyncio.wait_for(queue.get(), timeout)
+            except asyncio.TimeoutError:
+                await flush()
+                continue
+
+            if chunk is _END:
+                break
+            text = transform(chunk) if transform else chunk
+            if not text:
+                continue
+
+            if stats.first_chunk_at is None:
+                stats.first_chunk_at = time.perf_counter()
+            stats.chunks += 1
+            stats.chars += len(text)
+
+            buffer.append(text)
+            buffered_chars += len(text)
+            if buffer_started is None:
+                buffer_started = time.perf_counter()
+            if not coalesce or (coalesce_chars > 0 and buffered_chars >= coalesce_chars):
+                await flush()
+
+        await flush()
+        # Propaga eventuali errori del producer (es. errore Gemini)
+        await producer
+    finally:
+        if not producer.done():
+            producer.cancel()
+        logger.info(f"Stream stats: {stats.as_dict()}")
+
+    return stats
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# I moduli si importano come "services.x", come avviando l'app da backend/
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
@@ -0,0 +1,14 @@
+from services.category_classifier import normalize_category
+
+
+def test_llm_answers_are_normalized_to_categories():
+    assert normalize_category(" Faq.\n") == "faq"
+    assert normalize_category("**bug_report**") == "bug_report"
+    assert normalize_category("Category: refund request") == "refund_request"
+    assert normalize_category("Sure! The category is: password_reset") == "password_reset"
+
+
+def test_ambiguous_or_unknown_answers_are_rejected():
+    assert normalize_category("bug_report or other") is None
+    assert normalize_category("I cannot classify this email") is None
+    assert normalize_category("") is None
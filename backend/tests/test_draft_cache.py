@@ -0,0 +1,62 @@
+import os
+import hashlib
+
+import numpy as np
+
+from services.draft_cache import DraftCache, make_template, normalize_email
+
+
+class HashEmbeddings:
+    """Same text, same vector; different texts are nearly orthogonal."""
+
+    def embed_query(self, text):
+        seed = int(hashlib.sha1(text.encode('utf-8')).hexdigest()[:8], 16)
+        return np.random.default_rng(seed).standard_normal(32).tolist()
+
+
+DRAFT = "Dear Al,\n\nAlso, we already sent the refund to al@example.com.\n\nBest regards,\nExample company"
+
+
+def test_only_the_greeting_and_address_are_adapted(tmp_path):
+    cache = DraftCache(HashEmbeddings(), cache_dir=str(tmp_path))
+    cache.add("Where is my refund?", "refund_request", DRAFT, "Al", "al@example.com")
+
+    draft = cache.lookup("Where is my refund?", "refund_request", "Bob", "bob@example.com")
+
+    assert draft == "Dear Bob,\n\nAlso, we already sent the refund to bob@example.com.\n\nBest regards,\nExample company"
+
+
+def test_drafts_naming_the_recipient_in_the_body_are_not_cached(tmp_path):
+    assert make_template("Dear Al,\nAl, your refund is on its way.", "Al", None) is None
+    cache = DraftCache(HashEmbeddings(), cache_dir=str(tmp_path))
+    cache.add("Refund?", "refund_request", "Dear Al,\nAl, your refund is on its way.", "Al", None)
+    assert cache.lookup("Refund?", "refund_request", "Bob", None) is None
+
+
+def test_least_recently_used_draft_is_evicted(tmp_path):
+    cache = DraftCache(HashEmbeddings(), cache_dir=str(tmp_path), max_entries=2)
+    cache.add("first question", "faq", "Answer one")
+    cache.add("second question", "faq", "Answer two")
+    assert cache.lookup("first question", "faq") == "Answer one"
+    cache.add("third question", "faq", "Answer three")
+
+    assert cache.lookup("second question", "faq") is None
+    assert cache.lookup("first question", "faq") == "Answer one"
+    assert cache.lookup("third question", "faq") == "Answer three"
+    assert cache._indexes["faq"].ntotal == 2
+
+
+def test_writes_are_batched_and_reloaded(tmp_path):
+    cache = DraftCache(HashEmbeddings(), cache_dir=str(tmp_path), flush_every=3, flush_seconds=3600)
+    cache.add("question 1", "faq", "Answer 1")
+    cache.add("question 2", "faq", "Answer 2")
+    assert not os.path.exists(tmp_path / "faq.json")
+    cache.add("question 3", "faq", "Answer 3")
+    assert os.path.exists(tmp_path / "faq.json")
+
+    reloaded = DraftCache(HashEmbeddings(), cache_dir=str(tmp_path))
+    assert reloaded.lookup("question 2", "faq") == "Answer 2"
+
+
+def test_normalize_email_drops_quotes_and_signature():
+    assert normalize_email("Hello\n> old reply\nThere\n--\nSignature") == "hello there"
@@ -0,0 +1,135 @@
+import re
+import time
+import hashlib
+
+import numpy as np
+import pytest
+
+from services.fake_github import FakeGitHub
+from services.issue_tracker import IssueTracker, REPORT_MARKER
+
+REPO = "acme/app"
+
+
+class BagOfWords:
+    """Hashed word counts: summaries sharing most words get a high cosine similarity."""
+
+    def embed_query(self, text):
+        vector = np.zeros(256)
+        for word in re.findall(r'\w+', text.lower()):
+            vector[int(hashlib.sha1(word.encode('utf-8')).hexdigest(), 16) % 256] += 1
+        return vector.tolist()
+
+
+@pytest.fixture
+def github(monkeypatch):
+    server = FakeGitHub().start()
+    monkeypatch.setenv("GITHUB_API_URL", server.url)
+    monkeypatch.setenv("GITHUB_TOKEN", "test-token")
+    yield server
+    server.stop()
+
+
+@pytest.fixture
+def tracker(github, tmp_path):
+    return IssueTracker(BagOfWords(), summarize=lambda content: f"Summary: {content}",
+                        db_path=str(tmp_path / "issues.db"), repo_name=REPO, api_url=github.url)
+
+
+def file_next(tracker):
+    row = tracker._claim()
+    assert row is not None
+    tracker._process(row)
+    return tracker.status(row["id"])
+
+
+def test_first_report_creates_an_issue(github, tracker):
+    report_id = tracker.enqueue("The app crashes when I upload a profile photo")
+
+    status = file_next(tracker)
+
+    assert status["status"] == "filed"
+    assert status["action"] == "created"
+    issue = github.issues[(REPO, status["issue_number"])]
+    assert issue["body"].startswith("Summary: The app crashes when I upload a profile photo")
+    assert REPORT_MARKER.format(report_id) in issue["body"]
+    assert [label["name"] for label in issue["labels"]] == ["bug", "triage"]
+
+
+def test_near_duplicate_adds_a_comment(github, tracker):
+    tracker.enqueue("The app crashes when I upload a profile photo")
+    first = file_next(tracker)
+    tracker.enqueue("The app crashes when I upload a profile photo!!! Please fix")
+    second = file_next(tracker)
+
+    assert second["action"] == "commented"
+    assert second["issue_number"] == first["issue_number"]
+    assert len(github.issues) == 1
+    comments = github.comments[(REPO, first["issue_number"])]
+    assert len(comments) == 1 and comments[0]["body"].startswith("+1, reported again")
+
+
+def test_unrelated_report_opens_a_new_issue(github, tracker):
+    tracker.enqueue("The app crashes when I upload a profile photo")
+    file_next(tracker)
+    tracker.enqueue("Invoices show the wrong currency in the billing page")
+
+    assert file_next(tracker)["action"] == "created"
+    assert len(github.issues) == 2
+
+
+def test_server_error_is_retried_with_backoff(github, tracker):
+    report_id = tracker.enqueue("The app crashes when I upload a profile photo")
+    github.fail_next(1, status=503)
+
+    status = file_next(tracker)
+
+    assert status["status"] == "queued"
+    assert status["attempts"] == 1
+    assert "503" in status["last_error"]
+    assert github.issues == {}
+    # Non ancora dovuto: il prossimo tentativo è spostato in avanti dal backoff
+    assert tracker._claim() is None
+    assert 1.0 < tracker._next_due_in() <= 2.4
+
+    with tracker._connect() as conn:
+        conn.execute("UPDATE reports SET next_attempt_at = ? WHERE id = ?", (time.time(), report_id))
+    status = file_next(tracker)
+
+    assert status["status"] == "filed"
+    assert status["attempts"] == 2
+    assert len(github.issues) == 1
+
+
+def test_crash_after_creating_the_issue_does_not_file_it_twice(github, tracker, monkeypatch):
+    report_id = tracker.enqueue("The app crashes when I upload a profile photo")
+    save_issue = tracker._save_issue
+
+    def crash(*args):
+        raise RuntimeError("process killed")
+
+    monkeypatch.setattr(tracker, "_save_issue", crash)
+    assert file_next(tracker)["status"] == "queued"
+    assert len(github.issues) == 1
+
+    monkeypatch.setattr(tracker, "_save_issue", save_issue)
+    with tracker._connect() as conn:
+        conn.execute("UPDATE reports SET next_attempt_at = ? WHERE id = ?", (time.time(), report_id))
+    status = file_next(tracker)
+
+    assert status["status"] == "filed"
+    assert status["action"] == "created"
+    assert len(github.issues) == 1
+    assert [method for method, _ in github.requests].count("POST") == 1
+
+
+def test_worker_files_queued_reports(github, tracker):
+    tracker.start()
+    try:
+        report_id = tracker.enqueue("The app crashes when I upload a profile photo")
+        deadline = time.time() + 10
+        while tracker.status(report_id)["status"] != "filed" and time.time() < deadline:
+            time.sleep(0.05)
+    finally:
+        tracker.stop()
+    assert tracker.status(report_id)["status"] == "filed"
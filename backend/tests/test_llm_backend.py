@@ -0,0 +1,98 @@
+import json
+
+import pytest
+
+from services import llm_backend
+from services.llm_backend import LLMBackend, ReplayBackend, synthetic_response
+from services.category_classifier import CLASSIFY_PROMPT
+
+
+class CountingBackend(LLMBackend):
+    model = "gemini-test"
+    temperature = 0.7
+
+    def __init__(self):
+        self.calls = 0
+
+    def invoke(self, prompt):
+        self.calls += 1
+        return f"answer to {prompt}"
+
+    def stream(self, prompt):
+        self.calls += 1
+        yield from ("streamed ", "answer")
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    recorded = []
+    monkeypatch.setattr(llm_backend.time, "sleep", recorded.append)
+    return recorded
+
+
+def test_backend_interface_is_abstract():
+    with pytest.raises(TypeError):
+        LLMBackend()
+
+
+def test_recorded_responses_are_replayed(tmp_path, sleeps):
+    path = str(tmp_path / "recordings.jsonl")
+    live = CountingBackend()
+    recorder = ReplayBackend(recordings_path=path, model=live.model, record_from=live)
+
+    assert recorder.invoke("hello") == "answer to hello"
+    assert "".join(recorder.stream("tell me")) == "streamed answer"
+    assert live.calls == 2
+    with open(path) as f:
+        assert [json.loads(line)["prompt"] for line in f] == ["hello", "tell me"]
+
+    replay = ReplayBackend(recordings_path=path, model=live.model)
+    assert replay.model == "gemini-test-replay"
+    assert replay.invoke("hello") == "answer to hello"
+    assert "".join(replay.stream("tell me")) == "streamed answer"
+    assert live.calls == 2
+
+
+@pytest.mark.parametrize("subject, content, category", [
+    ("Help", "I forgot my password", "password_reset"),
+    ("Double payment", "I was charged twice this month", "refund_request"),
+    ("App", "The app crashes when I open settings", "bug_report"),
+    ("Question", "Which plans do you offer?", "faq"),
+])
+def test_synthetic_classification_reads_only_the_email(subject, content, category):
+    prompt = CLASSIFY_PROMPT.format(subject=subject, email_content=content)
+
+    assert synthetic_response(prompt) == category
+
+
+def test_unrecorded_prompts_get_a_deterministic_synthetic_response(tmp_path, sleeps):
+    replay = ReplayBackend(recordings_path=str(tmp_path / "none.jsonl"))
+    prompt = CLASSIFY_PROMPT.format(subject="Help", email_content="I forgot my password")
+
+    assert replay.invoke(prompt) == "password_reset"
+    assert replay.invoke("Write a reply") == synthetic_response("Write a reply")
+    assert replay.invoke("Write a reply") != replay.invoke("Write another reply")
+
+
+def test_simulated_latency(tmp_path, sleeps):
+    replay = ReplayBackend(recordings_path=str(tmp_path / "none.jsonl"), first_token_ms=200, token_ms=5,
+                           chunk_tokens=2, fallback=lambda prompt: "abcdefghijkl")
+
+    chunks = list(replay.stream("prompt"))
+
+    assert chunks == ["abcdefgh", "ijkl"]
+    # 200ms al primo token, poi 5ms per token stimato (~4 caratteri)
+    assert sleeps == pytest.approx([0.2, 0.01, 0.005])
+
+
+def test_simulated_errors_and_slow_first_tokens(tmp_path, sleeps):
+    failing = ReplayBackend(recordings_path=str(tmp_path / "none.jsonl"), first_token_ms=100, error_rate=1.0)
+    with pytest.raises(RuntimeError):
+        failing.invoke("prompt")
+    assert sleeps == pytest.approx([0.05])
+
+    sleeps.clear()
+    slow = ReplayBackend(recordings_path=str(tmp_path / "none.jsonl"), first_token_ms=100, slow_rate=1.0,
+                         slow_factor=10, fallback=lambda prompt: "ok")
+    assert slow.invoke("prompt") == "ok"
+    assert sleeps == pytest.approx([1.0])
@@ -0,0 +1,29 @@
+from services.llm_cache import LLMCache, cache_key
+
+PARAMS = {"temperature": 0.7}
+
+
+def test_answers_are_stored_under_the_model_that_answered(tmp_path):
+    cache = LLMCache(db_path=str(tmp_path / "llm_cache.db"))
+    chain = ["gemini-1.5-flash", "deepseek/deepseek-chat"]
+
+    # Il primario è giù: risponde il fallback
+    assert cache.invoke(chain, "prompt", PARAMS, lambda: ("deepseek/deepseek-chat", "answer")) == "answer"
+
+    assert cache.get(cache_key("gemini-1.5-flash", "prompt", PARAMS, "invoke")) is None
+    assert cache.get(cache_key("deepseek/deepseek-chat", "prompt", PARAMS, "invoke")) == "answer"
+    # La stessa catena ritrova la risposta del fallback senza richiamare l'LLM
+    assert cache.invoke(chain, "prompt", PARAMS, lambda: ("gemini-1.5-flash", "other")) == "answer"
+
+
+def test_streams_are_stored_under_the_model_that_answered(tmp_path):
+    cache = LLMCache(db_path=str(tmp_path / "llm_cache.db"))
+    chain = ["gemini-1.5-flash", "deepseek/deepseek-chat"]
+
+    def open_stream():
+        yield "deepseek/deepseek-chat", "Dear "
+        yield "deepseek/deepseek-chat", "customer"
+
+    assert list(cache.stream(chain, "prompt", PARAMS, open_stream)) == ["Dear ", "customer"]
+    assert cache.get(cache_key("deepseek/deepseek-chat", "prompt", PARAMS, "stream")) == ["Dear ", "customer"]
+    assert list(cache.stream(chain, "prompt", PARAMS, lambda: iter(()))) == ["Dear ", "customer"]
@@ -0,0 +1,115 @@
+import logging
+import threading
+
+import pytest
+
+from services import llm_router
+from services.llm_backend import GeminiBackend
+from services.category_classifier import CLASSIFY_PROMPT
+from services.llm_router import create_fake_router, create_router, MODEL_GEMINI_1_5_FLASH, MODEL_DEEPSEEK_CHAT
+
+PROMPT = CLASSIFY_PROMPT.format(subject="Help", email_content="the app shows an error")
+
+
+@pytest.fixture(autouse=True)
+def isolated_cwd(tmp_path, monkeypatch):
+    # ReplayBackend legge le registrazioni da cache/ nella directory corrente
+    monkeypatch.chdir(tmp_path)
+
+
+def outcomes(router, spec):
+    return {k: v for k, v in router.stats()["providers"][f"{spec}-replay"].items() if k in ("won", "lost", "error")}
+
+
+def test_slow_primary_is_hedged_to_the_next_provider(monkeypatch):
+    router = create_fake_router(first_token_ms={}, hedge=True, hedge_default_ms=10)
+    release = threading.Event()
+
+    def stuck_invoke(prompt):
+        # Il primario non risponde finché il test non lo sblocca: vince per forza la richiesta hedged
+        release.wait(5)
+        return "faq"
+
+    monkeypatch.setattr(router.providers[MODEL_GEMINI_1_5_FLASH], "invoke", stuck_invoke)
+    try:
+        model, answer = router.for_task("categorize").invoke_answered(PROMPT)
+    finally:
+        release.set()
+
+    assert (model, answer) == (f"{MODEL_DEEPSEEK_CHAT}-replay", "bug_report")
+    assert outcomes(router, MODEL_DEEPSEEK_CHAT) == {"won": 1, "lost": 0, "error": 0}
+    assert outcomes(router, MODEL_GEMINI_1_5_FLASH) == {"won": 0, "lost": 1, "error": 0}
+
+
+def test_without_hedging_the_primary_answers_in_the_calling_thread(monkeypatch):
+    router = create_fake_router(first_token_ms={}, hedge=False)
+    primary = router.providers[MODEL_GEMINI_1_5_FLASH]
+    threads = []
+    replay_invoke = primary.invoke
+
+    def invoke(prompt):
+        threads.append(threading.current_thread())
+        return replay_invoke(prompt)
+
+    monkeypatch.setattr(primary, "invoke", invoke)
+
+    assert router.for_task("categorize").invoke(PROMPT) == "bug_report"
+    assert threads == [threading.current_thread()]
+    assert outcomes(router, MODEL_GEMINI_1_5_FLASH)["won"] == 1
+    assert outcomes(router, MODEL_DEEPSEEK_CHAT)["won"] == 0
+
+
+def test_failing_primary_falls_back():
+    router = create_fake_router(first_token_ms={MODEL_GEMINI_1_5_FLASH: 20, MODEL_DEEPSEEK_CHAT: 20},
+                                error_rates={MODEL_GEMINI_1_5_FLASH: 1.0}, hedge=False)
+
+    chunks = list(router.for_task("summary").stream_answered("Summarize the email content: hello"))
+
+    assert "".join(chunk for _, chunk in chunks)
+    # Cache e metriche vedono il modello che ha risposto, non il primo della catena
+    assert {model for model, _ in chunks} == {f"{MODEL_DEEPSEEK_CHAT}-replay"}
+    assert outcomes(router, MODEL_GEMINI_1_5_FLASH)["error"] == 1
+    assert outcomes(router, MODEL_DEEPSEEK_CHAT)["won"] == 1
+
+
+def test_every_provider_failing_raises():
+    router = create_fake_router(first_token_ms={}, error_rates={MODEL_GEMINI_1_5_FLASH: 1.0, MODEL_DEEPSEEK_CHAT: 1.0},
+                                hedge=False)
+
+    with pytest.raises(RuntimeError):
+        router.for_task("categorize").invoke(PROMPT)
+
+
+def test_winner_failing_mid_stream_is_not_replaced(monkeypatch):
+    router = create_fake_router(first_token_ms={}, hedge=False)
+
+    def broken_stream(prompt):
+        yield "Dear customer, "
+        raise RuntimeError("connection reset")
+
+    monkeypatch.setattr(router.providers[MODEL_GEMINI_1_5_FLASH], "stream", broken_stream)
+    chunks = []
+    with pytest.raises(RuntimeError, match="connection reset"):
+        for chunk in router.for_task("summary").stream("Summarize the email content: hello"):
+            chunks.append(chunk)
+
+    # Il testo già inviato non viene ripetuto da un altro provider
+    assert chunks == ["Dear customer, "]
+    assert outcomes(router, MODEL_GEMINI_1_5_FLASH)["error"] == 1
+    assert outcomes(router, MODEL_DEEPSEEK_CHAT) == {"won": 0, "lost": 0, "error": 0}
+
+
+def test_unknown_provider_in_configuration_is_skipped(monkeypatch, caplog):
+    monkeypatch.setattr(llm_router, "LLM_FAST_MODELS", "gemini-1.5-flash,opneai/gpt-4o")
+    with caplog.at_level(logging.WARNING, logger=llm_router.__name__):
+        backend = create_router()
+
+    assert backend is not None
+    assert "Unknown LLM provider in opneai/gpt-4o" in caplog.text
+
+
+def test_malformed_routes_fall_back_to_gemini(monkeypatch):
+    monkeypatch.setattr(llm_router, "LLM_ROUTES", '{"summary": "openai/gpt-4o"}')
+    assert isinstance(create_router(), GeminiBackend)
+    monkeypatch.setattr(llm_router, "LLM_ROUTES", '{"summary": ')
+    assert isinstance(create_router(), GeminiBackend)
@@ -0,0 +1,86 @@
+import threading
+
+import pytest
+
+from services.mail_sync import MailboxSync, parse_cursor
+
+
+def message(msg_id, internal_date):
+    return {"message_id": msg_id, "internal_date": str(internal_date), "label_ids": ["INBOX", "UNREAD"]}
+
+
+@pytest.fixture
+def mailbox(tmp_path):
+    sync = MailboxSync(cache_path=str(tmp_path / "mailbox.json"))
+    sync.messages = {m["message_id"]: m for m in (
+        message("a", 500), message("b", 400), message("c", 400), message("d", 300), message("e", 200),
+    )}
+    return sync
+
+
+def ids(page):
+    return [m["message_id"] for m in page]
+
+
+def test_pages_cover_every_message_once(mailbox):
+    first, cursor = mailbox.unread_page(page_size=2)
+    second, cursor = mailbox.unread_page(cursor, page_size=2)
+    third, last = mailbox.unread_page(cursor, page_size=2)
+
+    assert ids(first) + ids(second) + ids(third) == ["a", "c", "b", "d", "e"]
+    assert last is None
+
+
+def test_cursor_is_stable_when_the_mailbox_changes(mailbox):
+    first, cursor = mailbox.unread_page(page_size=2)
+    # Una mail della prima pagina letta e una nuova arrivata: con un offset si salterebbe "b"
+    del mailbox.messages["a"]
+    mailbox.messages["f"] = message("f", 600)
+
+    second, _ = mailbox.unread_page(cursor, page_size=2)
+
+    assert ids(first) == ["a", "c"]
+    assert ids(second) == ["b", "d"]
+
+
+@pytest.mark.parametrize("token", ["10", "abc.x", ".x", "10."])
+def test_malformed_cursor_is_rejected(token):
+    with pytest.raises(ValueError):
+        parse_cursor(token)
+
+
+class BlockingHistoryService:
+    """Gmail fake whose history.list waits until the test releases it."""
+
+    def __init__(self):
+        self.entered = threading.Event()
+        self.release = threading.Event()
+
+    def users(self):
+        return self
+
+    def history(self):
+        return self
+
+    def list(self, **kwargs):
+        return self
+
+    def execute(self):
+        self.entered.set()
+        assert self.release.wait(5)
+        return {"history": [], "historyId": "2"}
+
+
+def test_reads_are_not_blocked_by_a_sync_in_progress(mailbox):
+    mailbox.history_id = "1"
+    service = BlockingHistoryService()
+    worker = threading.Thread(target=mailbox.sync, args=(service,), kwargs={"force": True})
+    worker.start()
+    try:
+        assert service.entered.wait(5)
+        page, _ = mailbox.unread_page(page_size=2)
+        assert ids(page) == ["a", "c"]
+    finally:
+        service.release.set()
+        worker.join(5)
+    assert mailbox.history_id == "2"
@@ -0,0 +1,31 @@
+from services import metrics
+
+
+def test_unknown_label_values_are_recorded_as_other():
+    allowed = ("faq", "bug_report")
+    with metrics.labelled(route="/test"):
+        metrics.set_label("problem_type", "bug_report", allowed=allowed)
+        assert metrics.current_labels()["problem_type"] == "bug_report"
+        metrics.set_label("problem_type", "Sure! The category is: bug_report", allowed=allowed)
+        assert metrics.current_labels()["problem_type"] == "other"
+        metrics.set_label("problem_type", None, allowed=allowed)
+        assert metrics.current_labels()["problem_type"] == "other"
+    assert metrics.current_labels() == {"route": "background", "problem_type": "none"}
+
+
+def test_histogram_renders_buckets_and_quantiles():
+    histogram = metrics.Histogram("test_seconds", "Test", ("route",), buckets=(0.1, 1.0))
+    for value in (0.05, 0.5, 2.0):
+        histogram.observe(value, route="/a")
+
+    lines = histogram.render()
+
+    assert 'test_seconds_bucket{route="/a",le="0.1"} 1' in lines
+    assert 'test_seconds_bucket{route="/a",le="+Inf"} 3' in lines
+    assert 'test_seconds_count{route="/a"} 3' in lines
+    assert 'test_seconds_quantile{route="/a",quantile="0.5"} 0.5' in lines
+
+
+def test_gmail_operation_hides_ids():
+    uri = "https://gmail.googleapis.com/gmail/v1/users/me/messages/18c2f0a1b2c3d4e5?format=full"
+    assert metrics.gmail_operation(uri) == "/gmail/v1/users/me/messages/{id}"
@@ -0,0 +1,172 @@
+import json
+import time
+import base64
+import asyncio
+import threading
+from contextlib import contextmanager
+
+import pytest
+
+from services.mail_sync import MailboxSync
+from services.notifications import NotificationHub, LocalNotificationSource, WatchRenewer
+
+
+class ScriptedSync(MailboxSync):
+    """MailboxSync whose Gmail side is a list of message ids that arrive over time."""
+
+    def __init__(self, tmp_path, unread=()):
+        super().__init__(cache_path=str(tmp_path / "mailbox.json"), min_interval=0)
+        self.unread = list(unread)
+        self.calls = 0
+        self.gate = None
+
+    def _message(self, msg_id):
+        return {"message_id": msg_id, "subject": f"Subject {msg_id}", "label_ids": ["INBOX", "UNREAD"]}
+
+    def _full_sync(self, service):
+        self.messages = {msg_id: self._message(msg_id) for msg_id in self.unread}
+        self.history_id = "1"
+
+    def _incremental_sync(self, service, start_history_id, known_ids):
+        self.calls += 1
+        if self.gate is not None:
+            self.gate.wait(timeout=5)
+        with self._lock:
+            for msg_id in self.unread:
+                self.messages.setdefault(msg_id, self._message(msg_id))
+
+
+class FakeClients:
+    def __init__(self, service=None):
+        self.service_object = service
+
+    @contextmanager
+    def service(self):
+        yield self.service_object
+
+
+def next_event(stream, timeout=5):
+    return asyncio.wait_for(stream.__anext__(), timeout)
+
+
+def test_local_notification_is_delivered_as_sse_event(tmp_path):
+    sync = ScriptedSync(tmp_path, unread=["a"])
+    sync.sync(None)
+    hub = NotificationHub(sync=sync, clients=FakeClients())
+
+    async def scenario():
+        hub.bind_loop(asyncio.get_running_loop())
+        stream = hub.event_stream()
+        sync.unread.append("b")
+        await asyncio.get_running_loop().run_in_executor(None, LocalNotificationSource(hub).publish, "2")
+        text = await next_event(stream)
+        await stream.aclose()
+        return text
+
+    text = asyncio.run(scenario())
+    event_line, data_line = text.strip().split("\n")
+    assert event_line == "event: new_message"
+    event = json.loads(data_line[len("data: "):])
+    assert event["data"]["message_id"] == "b"
+    assert not hub._subscribers
+
+
+def test_initial_full_sync_is_not_broadcast(tmp_path):
+    sync = ScriptedSync(tmp_path, unread=["a", "b"])
+    hub = NotificationHub(sync=sync, clients=FakeClients())
+
+    async def scenario():
+        hub.bind_loop(asyncio.get_running_loop())
+        stream = hub.event_stream(keepalive=0.05)
+        await asyncio.get_running_loop().run_in_executor(None, hub.handle_notification)
+        text = await next_event(stream)
+        await stream.aclose()
+        return text
+
+    assert asyncio.run(scenario()) == ": keepalive\n\n"
+
+
+def test_syncs_from_other_callers_are_broadcast(tmp_path):
+    sync = ScriptedSync(tmp_path, unread=["a"])
+    sync.sync(None)
+    hub = NotificationHub(sync=sync, clients=FakeClients())
+
+    async def scenario():
+        hub.bind_loop(asyncio.get_running_loop())
+        stream = hub.event_stream()
+        sync.unread.append("c")
+        # Come /unread-mails: sync diretta, senza passare dall'hub
+        await asyncio.get_running_loop().run_in_executor(None, sync.sync, None)
+        text = await next_event(stream)
+        await stream.aclose()
+        return text
+
+    assert '"message_id": "c"' in asyncio.run(scenario())
+
+
+def test_notification_during_sync_triggers_another_sync(tmp_path):
+    sync = ScriptedSync(tmp_path)
+    sync.sync(None)
+    hub = NotificationHub(sync=sync, clients=FakeClients())
+    sync.gate = threading.Event()
+
+    first = threading.Thread(target=hub.handle_notification)
+    first.start()
+    while sync.calls == 0:
+        time.sleep(0.01)
+    # Il lock è occupato: la seconda notifica ritorna subito e lascia il giro a chi sincronizza
+    hub.handle_notification()
+    sync.gate.set()
+    first.join(timeout=5)
+    assert sync.calls == 2
+
+
+def test_watch_renewer_registers_the_topic():
+    calls = []
+
+    class Service:
+        def users(self):
+            return self
+
+        def watch(self, userId, body):
+            calls.append(body)
+            return self
+
+        def execute(self):
+            return {"historyId": "1", "expiration": str(int(time.time() * 1000))}
+
+    renewer = WatchRenewer(topic_name="projects/p/topics/gmail", clients=FakeClients(Service()), interval=60)
+    renewer.start()
+    deadline = time.time() + 5
+    while not calls and time.time() < deadline:
+        time.sleep(0.01)
+    renewer.stop()
+    assert calls[0]["topicName"] == "projects/p/topics/gmail"
+    assert calls[0]["labelIds"] == ["INBOX"]
+
+
+def test_watch_renewer_without_topic_does_nothing():
+    renewer = WatchRenewer(topic_name=None, clients=None)
+    renewer.start()
+    assert renewer._thread is None
+
+
+def push_envelope(history_id):
+    payload = json.dumps({"emailAddress": "me@example.com", "historyId": history_id}).encode('utf-8')
+    return {"message": {"data": base64.b64encode(payload).decode('ascii'), "messageId": "1"},
+            "subscription": "projects/p/subscriptions/gmail"}
+
+
+def test_gmail_push_route_triggers_a_sync(monkeypatch):
+    testclient = pytest.importorskip("fastapi.testclient")
+    main = pytest.importorskip("main")
+    received = []
+    monkeypatch.setattr(main.notification_hub, "handle_notification", received.append)
+    monkeypatch.setattr(main, "PUBSUB_VERIFICATION_TOKEN", "secret")
+    client = testclient.TestClient(main.app)
+
+    assert client.post("/gmail/push?token=wrong", json=push_envelope("7")).status_code == 403
+    response = client.post("/gmail/push?token=secret", json=push_envelope("7"))
+
+    assert response.status_code == 200
+    assert received == [{"emailAddress": "me@example.com", "historyId": "7"}]
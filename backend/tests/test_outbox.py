@@ -0,0 +1,144 @@
+import time
+import base64
+from email import message_from_bytes
+from contextlib import contextmanager
+
+import pytest
+
+from services import outbox as outbox_module
+from services import gmail_service
+from services.outbox import Outbox, OUTBOX_HEADER
+
+
+class FakeGmail:
+    """messages.send and threads.get of the Gmail API, with sent mails kept per thread."""
+
+    def __init__(self):
+        self.sent = []
+        self.fail_sends = []
+        self._call = None
+
+    def users(self):
+        return self
+
+    def messages(self):
+        return self
+
+    def threads(self):
+        return self
+
+    def send(self, userId, body):
+        self._call = ("send", body)
+        return self
+
+    def get(self, userId, id, format, metadataHeaders):
+        self._call = ("get", id)
+        return self
+
+    def execute(self):
+        kind, arg = self._call
+        if kind == "send":
+            if self.fail_sends:
+                raise self.fail_sends.pop(0)
+            mime = message_from_bytes(base64.urlsafe_b64decode(arg["raw"]))
+            message = {"id": f"sent-{len(self.sent) + 1}", "threadId": arg["threadId"],
+                       "payload": {"headers": [{"name": OUTBOX_HEADER, "value": mime[OUTBOX_HEADER]}]}}
+            self.sent.append(message)
+            return {"id": message["id"], "threadId": arg["threadId"]}
+        return {"id": arg, "messages": [m for m in self.sent if m["threadId"] == arg]}
+
+
+@pytest.fixture
+def gmail(monkeypatch):
+    fake = FakeGmail()
+
+    class Clients:
+        @contextmanager
+        def service(self):
+            yield fake
+
+    monkeypatch.setattr(outbox_module, "gmail_clients", Clients())
+    return fake
+
+
+@pytest.fixture
+def logged(monkeypatch):
+    saved = []
+    monkeypatch.setattr(gmail_service.message_store, "save_message", lambda message, reply=False: saved.append(message))
+    return saved
+
+
+@pytest.fixture
+def box(tmp_path):
+    return Outbox(db_path=str(tmp_path / "outbox.db"), sends_per_second=100)
+
+
+def send_next(box):
+    row = box._claim()
+    assert row is not None
+    box._send(row)
+    return box.status(row["id"])
+
+
+def enqueue(box):
+    return box.enqueue("customer@example.com", "Refund", "Hello", "thread-1", "<orig@example.com>")
+
+
+def test_reply_is_sent_once_and_logged(box, gmail, logged):
+    enqueue(box)
+
+    status = send_next(box)
+
+    assert status["status"] == "sent"
+    assert status["gmail_id"] == "sent-1"
+    assert [m["message_id"] for m in logged] == ["sent-1"]
+
+
+def test_log_failure_after_send_does_not_resend(box, gmail, monkeypatch):
+    def locked(message, reply=False):
+        raise RuntimeError("database is locked")
+
+    monkeypatch.setattr(gmail_service.message_store, "save_message", locked)
+    enqueue(box)
+
+    assert send_next(box)["status"] == "sent"
+    assert box._claim() is None
+    assert len(gmail.sent) == 1
+
+
+def test_transient_send_error_is_retried(box, gmail, logged):
+    outbox_id = enqueue(box)
+    gmail.fail_sends.append(TimeoutError("read timed out"))
+
+    status = send_next(box)
+    assert status["status"] == "queued"
+    assert "timed out" in status["last_error"]
+
+    with box._connect() as conn:
+        conn.execute("UPDATE outbox SET next_attempt_at = ? WHERE id = ?", (time.time(), outbox_id))
+    assert send_next(box)["status"] == "sent"
+    assert len(gmail.sent) == 1
+
+
+def test_row_left_sending_by_a_crash_is_not_sent_again(box, gmail, logged, monkeypatch):
+    outbox_id = enqueue(box)
+    row = box._claim()
+
+    # Gmail accetta la mail, poi il processo muore prima di aggiornare la riga
+    def crash(*args, **kwargs):
+        raise SystemExit
+
+    finish = box._finish
+    monkeypatch.setattr(box, "_finish", crash)
+    with pytest.raises(SystemExit):
+        box._send(row)
+    monkeypatch.setattr(box, "_finish", finish)
+    assert box.status(outbox_id)["status"] == "sending"
+
+    with box._connect() as conn:
+        conn.execute("UPDATE outbox SET status = 'queued' WHERE status = 'sending'")
+    status = send_next(box)
+
+    assert status["status"] == "sent"
+    assert status["gmail_id"] == "sent-1"
+    assert len(gmail.sent) == 1
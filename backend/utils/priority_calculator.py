@@ -0,0 +1,15 @@
+# Parole che fanno passare una mail davanti alle altre nel pre-triage
+URGENT_KEYWORDS = (
+    "urgent", "urgente", "asap", "immediately", "charged twice", "double charge",
+    "refund", "can't log in", "cannot log in", "locked out", "hacked", "not working"
+)
+
+
+def calculate_priority(message):
+    """
+    Sort key for a parsed message: lower comes first.
+    Mails with more urgent keywords in subject/snippet come first, then the newest ones.
+    """
+    text = f"{message.get('subject') or ''} {message.get('snippet') or ''}".lower()
+    urgency = sum(1 for keyword in URGENT_KEYWORDS if keyword in text)
+    return (-urgency, -int(message.get('internal_date') or 0))